@@ -0,0 +1,200 @@
+# pyncoin/address_history.py
+
+''' Implements the optional index of the transactions of each address. '''
+
+import bisect
+import collections
+import os
+from decimal import Decimal
+
+from blockchain import IBlockchainListener
+from utils import RawSerializable, BadRequestError, PrunedError, parse_json
+
+class AddressHistoryIndex(IBlockchainListener, RawSerializable):
+    ''' Keeps the history of each address as a list of `(height, tx_id, direction, amount)`
+    entries in the order of the blockchain: a transaction spending outputs of an address adds
+    a `sent` entry with their total amount, a transaction paying an address a `received` entry.
+
+    The index is updated incrementally when blocks are connected. It keeps its own copy of the
+    unspent outputs, to find the address of the spent ones, and the undo data of the last
+    `MAX_UNDO_BLOCKS` blocks: when the blockchain is replaced, only the blocks after the fork
+    point are disconnected and connected again. A deeper fork rebuilds the whole index.
+    '''
+
+    MAX_UNDO_BLOCKS = 100
+    DEFAULT_LIMIT = 50
+    MAX_LIMIT = 1000
+
+    SENT = 'sent'
+    RECEIVED = 'received'
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.block_hashes = []
+        self.history = {}
+        self.unspent = {}
+        # undo data of the last blocks: (created outpoints, spent outputs, affected addresses)
+        self.undo = collections.deque()
+
+    def track(self, blockchain):
+        ''' Brings the index up to date with the blockchain and registers it as a listener. '''
+        self.sync(blockchain)
+        blockchain.add_listener(self)
+
+    def sync(self, blockchain):
+        ''' Disconnects the indexed blocks that are not in the blockchain any more and connects
+        the new blocks. The index may be ahead of the blockchain, for example after being loaded
+        from a file while the node is still downloading the blockchain: the blocks the blockchain
+        has in common with the index are not indexed again. '''
+        blocks = blockchain.blocks
+        fork = min(len(blocks), len(self.block_hashes)) - 1
+        while fork >= 0 and blocks[fork].hash != self.block_hashes[fork]:
+            fork -= 1
+        if fork == len(blocks) - 1:
+            return
+        depth = len(self.block_hashes) - 1 - fork
+        if depth > len(self.undo):
+            print('Fork deeper than the undo data of the address history, rebuilding it')
+            self.clear()
+            fork = -1
+        else:
+            for _ in range(depth):
+                self.disconnect()
+        try:
+            for block in blocks[fork + 1:]:
+                self.connect(block)
+        except PrunedError:
+            print('The address history can not be rebuilt, the transactions of the old blocks are pruned')
+
+    def connect(self, block):
+        created = []
+        spent = []
+        addresses = set()
+        for tx in block.data:
+            amounts = {}
+            for tx_in in tx.tx_ins:
+                outpoint = (tx_in.tx_out_id, tx_in.tx_out_index)
+                output = self.unspent.pop(outpoint, None)
+                if output is None:
+                    continue
+                spent.append((outpoint, output))
+                key = (output[0], AddressHistoryIndex.SENT)
+                amounts[key] = amounts.get(key, Decimal(0)) + output[1]
+            for index, tx_out in enumerate(tx.tx_outs):
+                self.unspent[(tx.id, index)] = (tx_out.address, tx_out.amount)
+                created.append((tx.id, index))
+                key = (tx_out.address, AddressHistoryIndex.RECEIVED)
+                amounts[key] = amounts.get(key, Decimal(0)) + tx_out.amount
+            for (address, direction), amount in amounts.items():
+                self.history.setdefault(address, []).append((block.index, tx.id, direction, amount))
+                addresses.add(address)
+        self.block_hashes.append(block.hash)
+        self.undo.append((created, spent, addresses))
+        if len(self.undo) > AddressHistoryIndex.MAX_UNDO_BLOCKS:
+            self.undo.popleft()
+
+    def disconnect(self):
+        height = len(self.block_hashes) - 1
+        (created, spent, addresses) = self.undo.pop()
+        self.block_hashes.pop()
+        for address in addresses:
+            entries = self.history[address]
+            while entries and entries[-1][0] == height:
+                entries.pop()
+            if not entries:
+                del self.history[address]
+        for outpoint in created:
+            del self.unspent[outpoint]
+        for outpoint, output in spent:
+            self.unspent[outpoint] = output
+
+    def get_history(self, address, max_height, cursor=None, limit=DEFAULT_LIMIT):
+        ''' Returns a page of the history of an address, the most recent transactions first.
+        Params:
+            - address (bytes): The address.
+            - max_height (int): The index of the latest block of the blockchain. Transactions in
+                higher blocks, only indexed if the index is ahead of the blockchain, are skipped.
+            - cursor (int): The `nextCursor` returned with the previous page, None for the first page.
+            - limit (int): The maximum number of transactions of the page.
+        Returns (dict): The transactions and the cursor of the next page, None for the last page.
+        '''
+        if not 1 <= limit <= AddressHistoryIndex.MAX_LIMIT:
+            raise BadRequestError('invalid limit', {'limit': limit, 'maxLimit': AddressHistoryIndex.MAX_LIMIT})
+        entries = self.history.get(address, [])
+        end = bisect.bisect_left(entries, (max_height + 1,))
+        if cursor is not None:
+            if cursor < 0:
+                raise BadRequestError('invalid cursor', {'cursor': cursor})
+            end = min(end, cursor)
+        start = max(end - limit, 0)
+        return {
+            'address': address.hex(),
+            'transactions': [{
+                'height': height,
+                'txId': tx_id.hex(),
+                'direction': direction,
+                'amount': amount
+            } for (height, tx_id, direction, amount) in reversed(entries[start:end])],
+            'nextCursor': start if start > 0 else None
+        }
+
+    # IBlockchainListener impl
+
+    def block_added(self, blockchain, block):
+        self.sync(blockchain)
+
+    def chain_replaced(self, blockchain):
+        self.sync(blockchain)
+
+    # persistence
+
+    def to_raw(self):
+        return {
+            'blockHashes': [block_hash.hex() for block_hash in self.block_hashes],
+            'history': {address.hex(): [[height, tx_id.hex(), direction, amount]
+                                        for (height, tx_id, direction, amount) in entries]
+                        for address, entries in self.history.items()},
+            'unspent': [[tx_id.hex(), index, address.hex(), amount]
+                        for (tx_id, index), (address, amount) in self.unspent.items()],
+            'undo': [[[[tx_id.hex(), index] for (tx_id, index) in created],
+                      [[tx_id.hex(), index, address.hex(), amount] for (tx_id, index), (address, amount) in spent],
+                      [address.hex() for address in addresses]]
+                     for (created, spent, addresses) in self.undo]
+        }
+
+    @classmethod
+    def from_raw(cls, raw_obj):
+        index = cls()
+        index.block_hashes = [bytes.fromhex(block_hash) for block_hash in raw_obj['blockHashes']]
+        index.history = {bytes.fromhex(address): [(height, bytes.fromhex(tx_id), direction, Decimal(amount))
+                                                  for (height, tx_id, direction, amount) in entries]
+                         for address, entries in raw_obj['history'].items()}
+        index.unspent = {(bytes.fromhex(tx_id), tx_out_index): (bytes.fromhex(address), Decimal(amount))
+                         for (tx_id, tx_out_index, address, amount) in raw_obj['unspent']}
+        index.undo = collections.deque(
+            ([(bytes.fromhex(tx_id), tx_out_index) for (tx_id, tx_out_index) in created],
+             [((bytes.fromhex(tx_id), tx_out_index), (bytes.fromhex(address), Decimal(amount)))
+              for (tx_id, tx_out_index, address, amount) in spent],
+             {bytes.fromhex(address) for address in addresses})
+            for (created, spent, addresses) in raw_obj['undo'])
+        return index
+
+    @classmethod
+    def load(cls, path):
+        ''' Returns the index saved in the file at `path`, or a new empty index if the file
+        does not exist. '''
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'rb') as index_file:
+            index = cls.from_raw(parse_json(index_file.read()))
+        print('Loaded the address history of {} blocks'.format(len(index.block_hashes)))
+        return index
+
+    def save(self, path):
+        ''' Saves the index to a file, replacing it atomically. '''
+        with open(path + '.tmp', 'wb') as index_file:
+            index_file.write(self.to_bin())
+        os.replace(path + '.tmp', path)
+        print('Saved the address history of {} blocks'.format(len(self.block_hashes)))
@@ -0,0 +1,265 @@
+# pyncoin/block_filters.py
+
+''' Implements compact per-block filters for light clients.
+
+The filter of a block is a Golomb-coded set of the addresses of its outputs and of the
+outpoints spent by its inputs. A client tests the addresses and the outpoints it is interested
+in against the filters and downloads only the blocks that match. Filters have no false
+negatives, and a false positive rate of about 1 / `BlockFilter.M` per tested item.
+
+Each filter is committed to by a filter header, the hash of the filter and of the header of
+the previous block, so that a client can compare the filters served by different nodes.
+
+Usage:
+    python block_filters.py scan http://127.0.0.1:5000 <hex address> [<hex address> ...] [--from N]
+'''
+
+import argparse
+import hashlib
+import json
+import struct
+from urllib.request import urlopen
+
+from twisted.internet.defer import succeed
+
+from blockchain import IBlockchainListener
+from utils import BadRequestError, format_exception
+
+NO_HEADER = bytes(32)
+
+class BlockFilter:
+    ''' The filter of a block. '''
+
+    P = 19
+    M = 784931
+    COUNT = struct.Struct('>I')
+    OUTPOINT_INDEX = struct.Struct('>Q')
+
+    def __init__(self, height, block_hash, data, header):
+        ''' Initializes the filter.
+        Params:
+            - height (int): The index of the block.
+            - block_hash (bytes): The hash of the block, used as the key of the filter.
+            - data (bytes): The number of items and their Golomb-coded set.
+            - header (bytes): The filter header of the block.
+        '''
+        self.height = height
+        self.block_hash = block_hash
+        self.data = data
+        self.header = header
+
+    @staticmethod
+    def outpoint(tx_out_id, tx_out_index):
+        return tx_out_id + BlockFilter.OUTPOINT_INDEX.pack(tx_out_index)
+
+    @staticmethod
+    def block_items(block):
+        ''' Returns (list<bytes>): The output addresses and the spent outpoints of a block. '''
+        items = set()
+        for position, tx in enumerate(block.data):
+            if position > 0:
+                items.update(BlockFilter.outpoint(tx_in.tx_out_id, tx_in.tx_out_index) for tx_in in tx.tx_ins)
+            items.update(tx_out.address for tx_out in tx.tx_outs)
+        return sorted(items)
+
+    @staticmethod
+    def hash_items(key, items, count):
+        modulus = count * BlockFilter.M
+        return [(int.from_bytes(hashlib.blake2b(item, key=key[:16], digest_size=8).digest(), 'big') * modulus) >> 64
+                for item in items]
+
+    @staticmethod
+    def encode(key, items):
+        ''' Returns (bytes): The number of items and the Golomb-Rice coded deltas of their sorted hashes. '''
+        values = sorted(set(BlockFilter.hash_items(key, items, len(items))))
+        bits = 0
+        length = 0
+        previous = 0
+        mask = (1 << BlockFilter.P) - 1
+        for value in values:
+            delta = value - previous
+            previous = value
+            quotient = delta >> BlockFilter.P
+            bits = (bits << (quotient + 1)) | (((1 << quotient) - 1) << 1)
+            bits = (bits << BlockFilter.P) | (delta & mask)
+            length += quotient + 1 + BlockFilter.P
+        padding = -length % 8
+        encoded = (bits << padding).to_bytes((length + padding) // 8, 'big')
+        return BlockFilter.COUNT.pack(len(items)) + encoded
+
+    @staticmethod
+    def decode(data):
+        ''' Returns ((int, set<int>)): The number of items of a filter and their hashes. '''
+        (count,) = BlockFilter.COUNT.unpack_from(data, 0)
+        bits = ''.join(format(byte, '08b') for byte in data[BlockFilter.COUNT.size:])
+        values = set()
+        position = 0
+        value = 0
+        while len(values) < count:
+            end = bits.find('0', position)
+            if end < 0 or end + 1 + BlockFilter.P > len(bits):
+                break
+            remainder = int(bits[end + 1:end + 1 + BlockFilter.P], 2)
+            value += ((end - position) << BlockFilter.P) | remainder
+            values.add(value)
+            position = end + 1 + BlockFilter.P
+        return (count, values)
+
+    @staticmethod
+    def compute_header(data, previous_header):
+        return hashlib.sha256(hashlib.sha256(data).digest() + previous_header).digest()
+
+    @staticmethod
+    def encode_many(keyed_items):
+        ''' Encodes the filters of many blocks, in a worker process.
+        Params:
+            - keyed_items (list<(bytes, list<bytes>)>): The hash and the items of each block.
+        Returns (list<bytes>): The encoded filters.
+        '''
+        return [BlockFilter.encode(key, items) for key, items in keyed_items]
+
+    @classmethod
+    def from_block(cls, block, previous_header):
+        data = BlockFilter.encode(block.hash, BlockFilter.block_items(block))
+        return cls(block.index, block.hash, data, BlockFilter.compute_header(data, previous_header))
+
+    def match_any(self, items):
+        ''' Returns (bool): True if any of the items may be in the block, False if none is. '''
+        (count, values) = BlockFilter.decode(self.data)
+        if count == 0 or not items:
+            return False
+        return not values.isdisjoint(BlockFilter.hash_items(self.block_hash, items, count))
+
+    def to_raw(self):
+        return {
+            'height': self.height,
+            'blockHash': self.block_hash.hex(),
+            'filter': self.data.hex(),
+            'header': self.header.hex()
+        }
+
+    @classmethod
+    def from_raw(cls, raw_obj):
+        return cls(raw_obj['height'], bytes.fromhex(raw_obj['blockHash']),
+                   bytes.fromhex(raw_obj['filter']), bytes.fromhex(raw_obj['header']))
+
+class BlockFilterIndex(IBlockchainListener):
+    ''' Keeps the filters of all the blocks of the blockchain.
+
+    The filter of a connected block is computed immediately. When the blockchain is replaced,
+    the filters after the fork point are dropped and, if many blocks are missing, they are
+    backfilled in bulk: the items of the blocks are collected on the reactor thread and the
+    filters are encoded by the worker processes. The blocks connected meanwhile are indexed
+    when the backfill completes.
+    '''
+
+    MAX_FILTERS = 1000
+    BACKFILL_THRESHOLD = 10
+
+    def __init__(self, workers=None):
+        ''' Initializes the index.
+        Params:
+            - workers (workers.WorkerPool): The pool encoding the backfilled filters, or None
+                to encode them on the reactor thread.
+        '''
+        self.workers = workers
+        self.filters = []
+        self.backfill = None
+
+    def track(self, blockchain):
+        ''' Indexes the blockchain and registers the index as a listener. '''
+        blockchain.add_listener(self)
+        return self.sync(blockchain)
+
+    def sync(self, blockchain):
+        ''' Drops the filters of the blocks not in the blockchain any more and computes the filters
+        of the missing blocks.
+        Returns (Deferred): Fires when the filters are up to date.
+        '''
+        if self.backfill is not None:
+            return self.backfill
+        blocks = blockchain.blocks
+        fork = min(len(blocks), len(self.filters)) - 1
+        while fork >= 0 and blocks[fork].hash != self.filters[fork].block_hash:
+            fork -= 1
+        del self.filters[fork + 1:]
+        missing = blocks[len(self.filters):]
+        if len(missing) < BlockFilterIndex.BACKFILL_THRESHOLD:
+            for block in missing:
+                self.filters.append(BlockFilter.from_block(block, self.last_header()))
+            return succeed(len(self.filters))
+        print('Backfilling the filters of {} blocks'.format(len(missing)))
+        keyed_items = [(block.hash, BlockFilter.block_items(block)) for block in missing]
+        if self.workers is None:
+            deferred = succeed(BlockFilter.encode_many(keyed_items))
+        else:
+            deferred = self.workers.map(BlockFilter.encode_many, keyed_items)
+        self.backfill = deferred
+        deferred.addCallbacks(self.backfilled, self.backfill_failed, callbackArgs=(blockchain, missing))
+        return deferred
+
+    def backfilled(self, encoded_filters, blockchain, blocks):
+        self.backfill = None
+        if len(self.filters) == blocks[0].index:
+            for block, data in zip(blocks, encoded_filters):
+                header = BlockFilter.compute_header(data, self.last_header())
+                self.filters.append(BlockFilter(block.index, block.hash, data, header))
+        print('Backfilled the filters up to block {}'.format(len(self.filters) - 1))
+        return self.sync(blockchain)
+
+    def backfill_failed(self, failure):
+        self.backfill = None
+        print('Backfill of the filters failed: {}'.format(format_exception(failure.value)))
+        return len(self.filters)
+
+    def last_header(self):
+        return self.filters[-1].header if self.filters else NO_HEADER
+
+    def get_filters(self, start, end=None):
+        ''' Returns (list<BlockFilter>): The filters of the blocks from `start` to `end` included,
+        at most `MAX_FILTERS` of them. '''
+        if end is None:
+            end = start + BlockFilterIndex.MAX_FILTERS - 1
+        if start < 0 or end < start or end - start >= BlockFilterIndex.MAX_FILTERS:
+            raise BadRequestError('invalid range of blocks',
+                                  {'from': start, 'to': end, 'maxFilters': BlockFilterIndex.MAX_FILTERS})
+        return self.filters[start:end + 1]
+
+    # IBlockchainListener impl
+
+    def block_added(self, blockchain, block):
+        self.sync(blockchain)
+
+    def chain_replaced(self, blockchain):
+        self.sync(blockchain)
+
+def scan(node_url, items, start=0):
+    ''' Downloads the filters of a node and returns the blocks that may contain the items.
+    Returns (list<(int, bytes)>): The index and the hash of the matching blocks.
+    '''
+    matches = []
+    while True:
+        url = '{}/filters?from={}'.format(node_url.rstrip('/'), start)
+        with urlopen(url) as response:
+            filters = [BlockFilter.from_raw(raw) for raw in json.loads(response.read().decode('utf-8'))['filters']]
+        if not filters:
+            return matches
+        matches.extend((block_filter.height, block_filter.block_hash)
+                       for block_filter in filters if block_filter.match_any(items))
+        start = filters[-1].height + 1
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='finds the blocks of a node that may contain addresses')
+    commands = parser.add_subparsers(dest='command')
+    scan_parser = commands.add_parser('scan', help='tests addresses against the filters of a node')
+    scan_parser.add_argument('node_url', help='url of the web server of the node, e.g. http://127.0.0.1:5000')
+    scan_parser.add_argument('addresses', help='the hex addresses', nargs='+')
+    scan_parser.add_argument('--from', dest='start', help='index of the first block', default=0, type=int)
+    args = parser.parse_args()
+
+    if args.command == 'scan':
+        addresses = [bytes.fromhex(address) for address in args.addresses]
+        for height, block_hash in scan(args.node_url, addresses, args.start):
+            print(height, block_hash.hex())
+    else:
+        parser.print_help()
@@ -5,10 +5,12 @@ from datetime import datetime, timezone
 from decimal import Decimal
 
 from bitstring import BitArray
+from twisted.internet.defer import maybeDeferred, succeed
 
-from transaction import Transaction, TxOut
+from snapshot import UtxoSnapshot
+from transaction import Transaction, TxIn, TxOut, UnspentTxOut
 from utils import RawSerializable, hex_to_bytes, bytes_to_hex
-from utils import BadRequestError, NotFoundError
+from utils import BadRequestError, NotFoundError, PrunedError
 
 ''' Implements the business logic of the blockchain. '''
 
@@ -18,45 +20,84 @@ class Block(RawSerializable):
 
     INT_SIZE = 8
     BYTE_ORDER = 'big'
+    FIND_CHECK_INTERVAL = 4096
 
-    def __init__(self, index, previous_hash, timestamp, data, difficulty, nonce):
+    def __init__(self, index, previous_hash, timestamp, data, difficulty, nonce, block_hash=None, raw_data=None):
         '''Initializes the block.
         Params:
             - index (int): The height of the block in the blockchain
             - previous_hash (bytes): A reference to the hash of the previous block. 
                 This value explicitly defines the previous block.
             - timestamp (datetime): A timestamp
-            - data (list<Transaction>): The list of transactions to be included in the block
+            - data (list<Transaction>): The list of transactions to be included in the block,
+                None if they are given in `raw_data`
             - difficulty (int): The difficulty of the Proof of Work algorithm
             - nonce (int): The nonce of the block
+            - block_hash (bytes): The hash of the block as received from a peer. If not given, 
+                it is calculated from the other fields. A received hash is only checked by
+                `has_valid_hash`.
+            - raw_data (list<dict>): The transactions in raw format, deserialized when `data`
+                is first accessed.
         '''
         self.index = index
         self.previous_hash = previous_hash
         self.timestamp = timestamp
-        self.data = data
+        self._data = data if raw_data is None else None
+        self._raw_data = raw_data
+        self.pruned = False
         self.difficulty = difficulty
         self.nonce = nonce
-        self.hash = self.calculate_hash_for_block()
+        self.hash = block_hash if block_hash is not None else self.calculate_hash_for_block()
+
+    @property
+    def data(self):
+        ''' The transactions of the block. The transactions of a block created by `from_raw` are 
+        only deserialized when they are first accessed. Raises PrunedError if the block is pruned. '''
+        if self.pruned:
+            raise PrunedError('the transactions of the block are pruned', {'hash': self.hash.hex()})
+        if self._data is None:
+            self._data = Transaction.from_raw_list(self._raw_data)
+            self._raw_data = None
+        return self._data
+
+    def has_data(self):
+        ''' Returns True if the transactions of the block are already deserialized. '''
+        return self._data is not None
+
+    def prune(self):
+        ''' Drops the transactions of the block, keeping only its header. '''
+        self._data = None
+        self._raw_data = None
+        self.pruned = True
 
     def __eq__(self, other):
         if isinstance(self, other.__class__):
-            return self.__dict__ == other.__dict__
+            return (self.header() == other.header() 
+                and (self.pruned or other.pruned or self.data == other.data))
         return False
 
+    def header(self):
+        ''' Returns (tuple): The fields of the block except its transactions. '''
+        return (self.index, self.previous_hash, self.timestamp, self.difficulty, self.nonce, self.hash)
+
     @staticmethod
-    def calculate_hash(index, previous_hash, timestamp, data, difficulty, nonce):
-        hasher = hashlib.sha256()
-        hasher.update(index.to_bytes(Block.INT_SIZE, byteorder=Block.BYTE_ORDER))
+    def header_prefix(index, previous_hash, timestamp, data, difficulty):
+        ''' Returns (bytes): The data hashed before the nonce to calculate the hash of a block. '''
+        parts = [index.to_bytes(Block.INT_SIZE, byteorder=Block.BYTE_ORDER)]
         if previous_hash is not None:
-            hasher.update(previous_hash)
+            parts.append(previous_hash)
         ts_int = int(timestamp.timestamp())
-        hasher.update(ts_int.to_bytes(Block.INT_SIZE, byteorder=Block.BYTE_ORDER))
+        parts.append(ts_int.to_bytes(Block.INT_SIZE, byteorder=Block.BYTE_ORDER))
         if isinstance(data, list):
-            for tx in data:
-                hasher.update(tx.get_id())
+            parts.extend(tx.get_id() for tx in data)
         else:
-            hasher.update(repr(data).encode('utf-8'))
-        hasher.update(difficulty.to_bytes(Block.INT_SIZE, byteorder=Block.BYTE_ORDER))
+            parts.append(repr(data).encode('utf-8'))
+        parts.append(difficulty.to_bytes(Block.INT_SIZE, byteorder=Block.BYTE_ORDER))
+        return b''.join(parts)
+
+    @staticmethod
+    def calculate_hash(index, previous_hash, timestamp, data, difficulty, nonce):
+        hasher = hashlib.sha256(Block.header_prefix(index, previous_hash, timestamp, data, difficulty))
         hasher.update(nonce.to_bytes(Block.INT_SIZE, byteorder=Block.BYTE_ORDER))
         return hasher.digest()
 
@@ -65,13 +106,37 @@ class Block(RawSerializable):
                                     self.data, self.difficulty, self.nonce)
 
     @staticmethod
-    def find(index, previous_hash, timestamp, data, difficulty):
-        nonce = 0
-        while True:
-            hash = Block.calculate_hash(index, previous_hash, timestamp, data, difficulty, nonce)
-            if Block.hash_matches_difficulty(hash, difficulty):
-                return Block(index, previous_hash, timestamp, data, difficulty, nonce)
+    def find_nonce(prefix, difficulty, start=0, end=None, stop=None):
+        ''' Searches a range of nonces for a hash satisfying the difficulty. The prefix is hashed
+        once and its state is copied for each nonce.
+        Params:
+            - prefix (bytes): The header prefix of the block, see `header_prefix`.
+            - difficulty (int): The number of leading zero bits of the hash.
+            - start (int): The first nonce tried.
+            - end (int): The nonce after the last one tried, None to search until a nonce is found.
+            - stop (multiprocessing.Event): Stops the search early when set, checked every
+                `FIND_CHECK_INTERVAL` nonces.
+        Returns ((int, bytes)): The nonce and the hash, or None if no nonce of the range is valid.
+        '''
+        prefix_hasher = hashlib.sha256(prefix)
+        target = 1 << (256 - difficulty) if difficulty <= 256 else 0
+        nonce = start
+        while end is None or nonce < end:
+            if stop is not None and nonce % Block.FIND_CHECK_INTERVAL == 0 and stop.is_set():
+                return None
+            hasher = prefix_hasher.copy()
+            hasher.update(nonce.to_bytes(Block.INT_SIZE, byteorder=Block.BYTE_ORDER))
+            hash = hasher.digest()
+            if int.from_bytes(hash, 'big') < target:
+                return (nonce, hash)
             nonce += 1
+        return None
+
+    @staticmethod
+    def find(index, previous_hash, timestamp, data, difficulty):
+        prefix = Block.header_prefix(index, previous_hash, timestamp, data, difficulty)
+        (nonce, hash) = Block.find_nonce(prefix, difficulty)
+        return Block(index, previous_hash, timestamp, data, difficulty, nonce, block_hash=hash)
 
     @staticmethod
     def genesis_block():
@@ -84,6 +149,11 @@ class Block(RawSerializable):
         required_prefix = '0' * difficulty
         return bits.bin.startswith(required_prefix)
 
+    def has_valid_proof_of_work(self):
+        ''' Checks the difficulty of the block against its hash without deserializing its 
+        transactions. The hash itself is checked by `has_valid_hash`. '''
+        return Block.hash_matches_difficulty(self.hash, self.difficulty)
+
     def has_valid_hash(self):
         if self.calculate_hash_for_block() != self.hash:
             print('invalid hash')
@@ -98,7 +168,7 @@ class Block(RawSerializable):
         return block == Block.genesis_block()
 
     def is_valid_next(self, next_block):
-        if not next_block.has_valid_structure():
+        if not next_block.has_valid_header_structure():
             print('invalid structure')
             return False
         elif self.index + 1 != next_block.index:
@@ -110,118 +180,481 @@ class Block(RawSerializable):
         elif not Block.is_valid_timestamp(next_block, self):
             print('invalid timestamp')
             return False
+        elif not next_block.has_valid_proof_of_work():
+            print('block difficulty not satisfied')
+            return False
+        elif not next_block.has_valid_structure():
+            print('invalid structure')
+            return False
         elif not next_block.has_valid_hash():
             return False
         return True
 
     def to_raw(self):
-        return {
+        raw = {
             'index': self.index,
             'previousHash': self.previous_hash.hex() if self.previous_hash is not None else None,
             'timestamp': int(self.timestamp.timestamp()),
-            'data': Transaction.to_raw_list(self.data),
+            'data': Transaction.to_raw_list(self._data) if self.has_data() else self._raw_data,
             'difficulty': self.difficulty,
             'nonce': self.nonce,
             'hash': self.hash.hex()
         }
+        if self.pruned:
+            raw['pruned'] = True
+        return raw
 
     @classmethod
     def from_raw(cls, raw_obj):
+        ''' Returns a new Block initialized from a dictionary. Only the header of the block is 
+        deserialized, its transactions are kept in raw format until `data` is accessed. '''
         index = raw_obj['index']
         previous_hash = hex_to_bytes(raw_obj['previousHash']) if raw_obj['previousHash'] is not None else None
         timestamp = datetime.fromtimestamp(raw_obj['timestamp'], tz=timezone.utc)
-        data = Transaction.from_raw_list(raw_obj['data'])
         difficulty = raw_obj['difficulty']
         nonce = raw_obj['nonce']
-        return cls(index=index, previous_hash=previous_hash, timestamp=timestamp, 
-                   data=data, difficulty=difficulty, nonce=nonce)
-
-    def has_valid_structure(self):
+        raw_hash = raw_obj.get('hash')
+        if raw_hash is None:
+            return cls(index=index, previous_hash=previous_hash, timestamp=timestamp, 
+                       data=Transaction.from_raw_list(raw_obj['data']), difficulty=difficulty, nonce=nonce)
+        return cls(index=index, previous_hash=previous_hash, timestamp=timestamp, data=None, 
+                   difficulty=difficulty, nonce=nonce, block_hash=hex_to_bytes(raw_hash), raw_data=raw_obj['data'])
+
+    def has_valid_header_structure(self):
+        ''' Checks the types of the fields of the block except its transactions. '''
         return (isinstance(self.index, int) 
             and isinstance(self.hash, bytes) 
             and (isinstance(self.previous_hash, bytes) if self.previous_hash is not None else True)
             and isinstance(self.timestamp, datetime) 
-            and isinstance(self.data, list)
-            and all([isinstance(tx, Transaction) for tx in self.data])
             and isinstance(self.difficulty, int)
             and isinstance(self.nonce, int))
 
+    def has_valid_structure(self):
+        if not self.has_valid_header_structure():
+            return False
+        if not self.has_data() and not isinstance(self._raw_data, list):
+            return False
+        try:
+            data = self.data
+        except (KeyError, TypeError, ValueError, AttributeError, BadRequestError) as ex:
+            print('invalid block transactions: {}'.format(ex))
+            return False
+        return all([isinstance(tx, Transaction) for tx in data])
+
     @staticmethod
     def is_valid_timestamp(new_block, previous_block):
         return ((previous_block.timestamp - new_block.timestamp).total_seconds() < 60 
             and (new_block.timestamp - datetime.now(tz=timezone.utc)).total_seconds() < 60)
 
+class IBlockchainListener:
+    ''' Interface of the objects notified about the changes of the blockchain and of its 
+    transaction pool. Register them with `Blockchain.add_listener`. '''
+
+    def block_mined(self, blockchain, block):
+        ''' Called before a block mined by this node is validated and connected to the blockchain. '''
+        pass
+
+    def block_validated(self, blockchain, block):
+        ''' Called after a block was validated, just before it is connected to the blockchain. '''
+        pass
+
+    def block_added(self, blockchain, block):
+        ''' Called after a block was connected to the end of the blockchain. '''
+        pass
+
+    def chain_replaced(self, blockchain):
+        ''' Called after the whole blockchain was replaced with a received one. '''
+        pass
+
+    def transactions_added(self, transactions):
+        ''' Called after transactions were added to the transaction pool. '''
+        pass
+
+    def transactions_removed(self, transactions):
+        ''' Called after transactions were removed from the transaction pool. '''
+        pass
+
+class ValidationStats(RawSerializable):
+    ''' Counts the work done validating received blockchains. '''
+
+    def __init__(self):
+        self.blocks = 0
+        self.transactions = 0
+        self.assumed_valid_blocks = 0
+        self.signatures_verified = 0
+        self.signatures_skipped = 0
+
+    def count_block(self, block, assumed_valid):
+        signatures = sum(len(tx.tx_ins) for tx in block.data[1:])
+        self.blocks += 1
+        self.transactions += len(block.data)
+        if assumed_valid:
+            self.assumed_valid_blocks += 1
+            self.signatures_skipped += signatures
+        else:
+            self.signatures_verified += signatures
+
+    @staticmethod
+    def of_blocks(blocks):
+        ''' Returns (ValidationStats): The counters of a full validation of the given blocks. '''
+        stats = ValidationStats()
+        for block in blocks:
+            stats.count_block(block, assumed_valid=False)
+        return stats
+
+    def add(self, other):
+        ''' Adds the counters of another `ValidationStats` to this one. '''
+        self.blocks += other.blocks
+        self.transactions += other.transactions
+        self.assumed_valid_blocks += other.assumed_valid_blocks
+        self.signatures_verified += other.signatures_verified
+        self.signatures_skipped += other.signatures_skipped
+
+    def to_raw(self):
+        return {
+            'blocks': self.blocks,
+            'transactions': self.transactions,
+            'assumedValidBlocks': self.assumed_valid_blocks,
+            'signaturesVerified': self.signatures_verified,
+            'signaturesSkipped': self.signatures_skipped
+        }
+
 class Blockchain(RawSerializable):
 
     BLOCK_GENERATION_INTERVAL = 10 # in seconds
     DIFFICULTY_ADJUSTMENT_INTERVAL = 10 # in blocks
 
+    # The hash of a block of the main chain whose ancestors are assumed to have valid signatures.
+    # Set it to a block buried deep enough that replacing it would take more work than anyone can do.
+    DEFAULT_ASSUME_VALID = None
+
     def __init__(self, tx_pool):
         self.blocks = [Block.genesis_block()]
         self.p2p_application = None
+        self.workers = None
         self.tx_pool = tx_pool
+        self.listeners = []
         self.unspent_tx_outs = []
+        self.assume_valid = Blockchain.DEFAULT_ASSUME_VALID
+        self.validation_stats = ValidationStats()
+        self.snapshot = None
+        self.snapshot_status = None
+        self.prune_blocks = None
+        self.prune_bytes = None
+        # the outputs spent by each block kept by a pruning blockchain, to undo them in a reorganization
+        self.undo = {}
+        self.rebuild_indexes()
+
+    def add_listener(self, listener):
+        ''' Registers an `IBlockchainListener` for the events of the blockchain and of the
+        transaction pool. '''
+        self.listeners.append(listener)
+        self.tx_pool.listeners.append(listener)
 
     def get_latest(self):
         return self.blocks[-1]
 
     @staticmethod
-    def validate_blocks(blocks):
+    def validate_blocks(blocks, assume_valid=None, stats=None):
+        ''' Validates a blockchain from the genesis block.
+        Params:
+            - blocks (list<Block>): The blockchain.
+            - assume_valid (bytes): The hash of a block whose ancestors, and the block itself, are 
+                assumed to have valid signatures. Their proof of work, linkage, amounts and unspent 
+                outputs are still checked.
+            - stats (ValidationStats): Counts the validated blocks and signatures if given.
+        Returns (list<UnspentTxOut>): The unspent outputs of the blockchain, or None if it is not valid.
+        '''
         if not isinstance(blocks, list):
             print('blocks argument is not a list')
             return None
         elif not Block.is_genesis(blocks[0]):
             print('invalid genesis block')
             return None
+        assume_valid_index = next((i for i, block in enumerate(blocks) if block.hash == assume_valid), -1)
         unspent_tx_outs = []
         for i, block in enumerate(blocks):
             if not isinstance(blocks[i], Block) or i != 0 and not blocks[i - 1].is_valid_next(block):
                 print('block #{} is not valid'.format(i))
                 return None
-            unspent_tx_outs = Transaction.process_transactions(block.data, unspent_tx_outs, block.index)
+            assumed_valid = i <= assume_valid_index
+            unspent_tx_outs = Transaction.process_transactions(block.data, unspent_tx_outs, block.index,
+                                                               verify_signatures=not assumed_valid)
             if unspent_tx_outs is None:
                 print('invalid transactions in blockchain')
                 return None
+            if stats is not None:
+                stats.count_block(block, assumed_valid)
         return unspent_tx_outs
 
+    @staticmethod
+    def validate_blocks_from_snapshot(blocks, snapshot):
+        ''' Validates a blockchain starting from the unspent outputs of a snapshot: the blocks up 
+        to the snapshot block are only checked for proof of work and linkage, the following ones
+        are fully validated.
+        Returns ((list<UnspentTxOut>, ValidationStats)): Like `validate_blocks_with_stats`.
+        '''
+        stats = ValidationStats()
+        if (not isinstance(blocks, list) or len(blocks) <= snapshot.height 
+                or blocks[snapshot.height].hash != snapshot.block_hash):
+            print('blockchain does not contain the snapshot block')
+            return (None, stats)
+        elif not Block.is_genesis(blocks[0]):
+            print('invalid genesis block')
+            return (None, stats)
+        unspent_tx_outs = list(snapshot.unspent_tx_outs)
+        for i, block in enumerate(blocks):
+            if not isinstance(blocks[i], Block) or i != 0 and not blocks[i - 1].is_valid_next(block):
+                print('block #{} is not valid'.format(i))
+                return (None, stats)
+            if i <= snapshot.height:
+                stats.count_block(block, assumed_valid=True)
+                continue
+            unspent_tx_outs = Transaction.process_transactions(block.data, unspent_tx_outs, block.index)
+            if unspent_tx_outs is None:
+                print('invalid transactions in blockchain')
+                return (None, stats)
+            stats.count_block(block, assumed_valid=False)
+        return (unspent_tx_outs, stats)
+
+    @staticmethod
+    def snapshot_content_hash(blocks):
+        ''' Fully validates the given blocks from the genesis block.
+        Returns (bytes): The content hash of the `UtxoSnapshot` of the last block, or None if the 
+            blocks are not valid.
+        '''
+        unspent_tx_outs = Blockchain.validate_blocks(blocks)
+        if unspent_tx_outs is None:
+            return None
+        return UtxoSnapshot(blocks[-1].index, blocks[-1].hash, unspent_tx_outs).content_hash
+
+    @staticmethod
+    def validate_blocks_with_stats(blocks, assume_valid=None):
+        ''' Validates a blockchain like `validate_blocks`.
+        Returns ((list<UnspentTxOut>, ValidationStats)): The unspent outputs of the blockchain, 
+            or None if it is not valid, and the work done validating it.
+        '''
+        stats = ValidationStats()
+        unspent_tx_outs = Blockchain.validate_blocks(blocks, assume_valid, stats)
+        return (unspent_tx_outs, stats)
+
     @staticmethod
     def get_accumulated_difficulty(blocks):
         return sum([2 ** block.difficulty for block in blocks])
 
-    def add_block(self, block):
+    def add_block(self, block, verified_tx_ids=None):
+        ''' Connects a block to the end of the blockchain if it is valid.
+        Params:
+            - block (Block): The block.
+            - verified_tx_ids (set<bytes>): The ids of the transactions of the block taken from the
+                transaction pool, whose signatures are not verified again.
+        Returns (bool): True if the block was added.
+        '''
         if not isinstance(block, Block):
             raise BadRequestError('invalid block', payload=block.to_raw())
         if not self.get_latest().is_valid_next(block):
             return False
-        unspent_tx_outs = Transaction.process_transactions(block.data, self.unspent_tx_outs, block.index)
+        unspent_tx_outs = Transaction.process_transactions(block.data, self.unspent_tx_outs, block.index, 
+                                                           verified_tx_ids)
         if unspent_tx_outs is None:
             print('block is not valid in terms of transactions')
             return False
+        for listener in self.listeners:
+            listener.block_validated(self, block)
+        if self.is_pruning():
+            self.undo[block.hash] = Blockchain.spent_tx_outs(block, self.unspent_by_outpoint)
         self.blocks.append(block)
+        self.index_block(block)
         self.unspent_tx_outs = unspent_tx_outs
+        for listener in self.listeners:
+            listener.block_added(self, block)
         self.tx_pool.update(unspent_tx_outs)
+        self.prune()
         return True
 
-    def generate_raw_next_block(self, data):
+    def rebuild_indexes(self):
+        ''' Rebuilds the in-memory lookup tables from `blocks` and `unspent_tx_outs`. '''
+        self.blocks_by_hash = {}
+        self.tx_block_hashes = {}
+        self.encoded_blocks = {}
+        self.body_bytes = 0
+        self.pruned_height = max((block.index for block in self.blocks if block.pruned), default=-1)
+        for block in self.blocks:
+            self.index_block(block, update_unspent=False)
+        self.undo = {block_hash: spent for (block_hash, spent) in self.undo.items() if block_hash in self.blocks_by_hash}
+        self.unspent_by_outpoint = {}
+        self.unspent_by_address = {}
+        for uTxO in self.unspent_tx_outs:
+            self.index_unspent_tx_out(uTxO)
+
+    def index_unspent_tx_out(self, uTxO):
+        outpoint = (uTxO.tx_out_id, uTxO.tx_out_index)
+        self.unspent_by_outpoint[outpoint] = uTxO
+        self.unspent_by_address.setdefault(uTxO.address, {})[outpoint] = uTxO
+
+    def index_block(self, block, update_unspent=True):
+        ''' Adds a newly connected block to the lookup tables. '''
+        self.blocks_by_hash[block.hash] = block
+        self.encoded_blocks[block.hash] = block.to_bin()
+        if block.pruned:
+            return
+        self.body_bytes += len(self.encoded_blocks[block.hash])
+        for tx in block.data:
+            self.tx_block_hashes[tx.id] = block.hash
+            if not update_unspent:
+                continue
+            for tx_in in tx.tx_ins:
+                outpoint = (tx_in.tx_out_id, tx_in.tx_out_index)
+                uTxO = self.unspent_by_outpoint.pop(outpoint, None)
+                if uTxO is not None:
+                    del self.unspent_by_address[uTxO.address][outpoint]
+            for index, tx_out in enumerate(tx.tx_outs):
+                self.index_unspent_tx_out(UnspentTxOut(tx.id, index, tx_out.address, tx_out.amount))
+
+    def is_pruning(self):
+        return self.prune_blocks is not None or self.prune_bytes is not None
+
+    def prune(self):
+        ''' Drops the transactions of the oldest blocks, keeping their headers, until only the last
+        `prune_blocks` blocks have their transactions and they take at most `prune_bytes` bytes
+        in binary format. The transactions of the latest block are always kept. Nothing is 
+        pruned while a snapshot is being validated. '''
+        if not self.is_pruning() or self.snapshot_status in ('waiting for blocks', 'validating', 'revalidating'):
+            return
+        latest_index = self.get_latest().index
+        while self.pruned_height + 1 < latest_index:
+            block = self.blocks[self.pruned_height + 1]
+            too_old = self.prune_blocks is not None and latest_index - block.index >= self.prune_blocks
+            over_budget = self.prune_bytes is not None and self.body_bytes > self.prune_bytes
+            if not too_old and not over_budget:
+                break
+            self.body_bytes -= len(self.encoded_blocks[block.hash])
+            for tx in block.data:
+                self.tx_block_hashes.pop(tx.id, None)
+            self.undo.pop(block.hash, None)
+            block.prune()
+            self.encoded_blocks[block.hash] = block.to_bin()
+            self.pruned_height = block.index
+
+    @staticmethod
+    def spent_tx_outs(block, unspent_by_outpoint):
+        ''' Returns (list<UnspentTxOut>): The outputs spent by the transactions of a block. '''
+        outpoints = ((tx_in.tx_out_id, tx_in.tx_out_index) for tx in block.data for tx_in in tx.tx_ins)
+        return [unspent_by_outpoint[outpoint] for outpoint in outpoints if outpoint in unspent_by_outpoint]
+
+    def reorganize(self, new_blocks):
+        ''' Replaces the blocks following the parent of the first received block with the received
+        blocks if they are valid and have more accumulated difficulty. Unlike `replace`, the blocks
+        up to the parent are not validated again, so a pruning blockchain can switch to a fork of
+        the blocks whose spent outputs it kept in `undo`.
+        Params:
+            - new_blocks (list<Block>): The received blocks, the first one is a child of one of our blocks.
+        Returns (bool): True if the blockchain was reorganized.
+        '''
+        parent = self.blocks_by_hash.get(new_blocks[0].previous_hash)
+        if parent is None or self.is_snapshot_pending():
+            print('Received blocks can not be connected to our blockchain')
+            return False
+        old_blocks = self.blocks[parent.index + 1:]
+        if not all(block.hash in self.undo for block in old_blocks):
+            print('The outputs spent by the blocks after the fork are not known, can not reorganize')
+            return False
+        if Blockchain.get_accumulated_difficulty(new_blocks) <= Blockchain.get_accumulated_difficulty(old_blocks):
+            print('Received blocks are not longer than current blockchain')
+            return False
+        unspent_by_outpoint = dict(self.unspent_by_outpoint)
+        for block in reversed(old_blocks):
+            for tx in block.data:
+                for index in range(len(tx.tx_outs)):
+                    unspent_by_outpoint.pop((tx.id, index), None)
+            for uTxO in self.undo[block.hash]:
+                unspent_by_outpoint[(uTxO.tx_out_id, uTxO.tx_out_index)] = uTxO
+        unspent_tx_outs = list(unspent_by_outpoint.values())
+        undo = {}
+        previous_block = parent
+        for block in new_blocks:
+            if not previous_block.is_valid_next(block):
+                print('block #{} is not valid'.format(block.index))
+                return False
+            undo[block.hash] = Blockchain.spent_tx_outs(block, unspent_by_outpoint)
+            unspent_tx_outs = Transaction.process_transactions(block.data, unspent_tx_outs, block.index)
+            if unspent_tx_outs is None:
+                print('invalid transactions in received blocks')
+                return False
+            unspent_by_outpoint = {(uTxO.tx_out_id, uTxO.tx_out_index): uTxO for uTxO in unspent_tx_outs}
+            previous_block = block
+        print('Received blocks are valid. Replacing the {} blocks after #{}.'.format(len(old_blocks), parent.index))
+        self.blocks = self.blocks[:parent.index + 1] + new_blocks
+        self.unspent_tx_outs = unspent_tx_outs
+        self.undo.update(undo)
+        self.rebuild_indexes()
+        for listener in self.listeners:
+            listener.chain_replaced(self)
+        self.tx_pool.update(unspent_tx_outs)
+        self.prune()
+        self.broadcast_latest()
+        return True
+
+    def check_not_pruned(self, index):
+        ''' Raises PrunedError if the transactions of the block at the given index are pruned. '''
+        if index <= self.pruned_height:
+            raise PrunedError('the transactions of the blocks up to {} are pruned'.format(self.pruned_height),
+                              {'prunedHeight': self.pruned_height})
+
+    def next_block_template(self, data):
+        ''' Returns the arguments of `Block.find` for mining the next block with `data`. '''
         previous_block = self.get_latest()
         next_index = previous_block.index + 1
         next_timestamp = datetime.now(tz=timezone.utc)
         difficulty = self.get_difficulty()
         print('Blockchain.generate_next: difficulty = {}'.format(difficulty))
-        next_block = Block.find(next_index, previous_block.hash, next_timestamp, data, difficulty)
-        if self.add_block(next_block):
+        return (next_index, previous_block.hash, next_timestamp, data, difficulty)
+
+    def connect_mined_block(self, block):
+        for listener in self.listeners:
+            listener.block_mined(self, block)
+        if self.add_block(block):
             self.broadcast_latest()
-            return next_block
+            return block
         else:
             return None
 
-    def generate_next_block(self, wallet):
+    def generate_raw_next_block(self, data):
+        next_block = Block.find(*self.next_block_template(data))
+        return self.connect_mined_block(next_block)
+
+    def generate_raw_next_block_async(self, data):
+        ''' Mines the next block in a worker process of `workers`.
+
+        Params:
+            - data (list<Transaction>): The data of the block.
+
+        Returns (Deferred): Fires with the new block or None if the block could not be
+            connected, for example because the chain has changed while mining.
+        '''
+        deferred = self.workers.submit(Block.find, *self.next_block_template(data))
+        deferred.addCallback(self.connect_mined_block)
+        return deferred
+
+    def next_block_data(self, wallet):
+        ''' Returns (list<Transaction>): The data of the next block mined by the node: a coinbase
+            paying `wallet` and the transactions of the pool. When the wallet needs consolidation,
+            the consolidation transaction is admitted to the pool first, which reserves its inputs
+            until it is mined, even if the block being mined is abandoned.
+        '''
         coinbase_tx = Transaction.coinbase(wallet.get_public_key(), self.get_latest().index + 1)
+        if wallet.needs_consolidation(self.my_unspent_tx_outs(wallet), self.tx_pool):
+            consolidation_tx = wallet.create_consolidation_transaction(self.my_unspent_tx_outs(wallet), self.tx_pool)
+            if consolidation_tx is not None and self.tx_pool.add_transaction(consolidation_tx, self.unspent_by_outpoint):
+                self.broadcast_transactions([consolidation_tx])
         block_data = [coinbase_tx] + self.tx_pool.transactions
         print('block_data: {}'.format(block_data))
-        return self.generate_raw_next_block(block_data)
+        return block_data
 
-    def generate_next_with_transaction(self, wallet, receiver_address, amount):
+    def generate_next_block(self, wallet):
+        return self.generate_raw_next_block(self.next_block_data(wallet))
+
+    def next_block_data_with_transaction(self, wallet, receiver_address, amount):
         if not TxOut.is_valid_address(receiver_address):
             error_payload = {'address': bytes_to_hex(receiver_address)}
             raise BadRequestError('invalid address', payload=error_payload)
@@ -229,26 +662,134 @@ class Blockchain(RawSerializable):
             error_payload = {'amount': amount}
             raise BadRequestError('invalid amount', payload=error_payload)
         coinbase_tx = Transaction.coinbase(wallet.get_public_key(), self.get_latest().index + 1)
-        tx = wallet.create_transaction(receiver_address, amount, self.unspent_tx_outs, self.tx_pool)
-        block_data = [coinbase_tx, tx]
+        tx = wallet.create_transaction(receiver_address, amount, self.my_unspent_tx_outs(wallet), self.tx_pool)
+        return [coinbase_tx, tx]
+
+    def generate_next_with_transaction(self, wallet, receiver_address, amount):
+        block_data = self.next_block_data_with_transaction(wallet, receiver_address, amount)
         return self.generate_raw_next_block(block_data)
 
-    def send_transaction(self, wallet, receiver_address, amount):
-        tx = wallet.create_transaction(receiver_address, amount, self.unspent_tx_outs, self.tx_pool)
-        if self.tx_pool.add_transaction(tx, self.unspent_tx_outs):
-            self.broadcast_transaction_pool()
-        else:
-            raise BadRequestError('invalid transaction or transaction is already in the pool')
-        return tx
+    def send_transaction(self, wallet, receiver_address, amount, coin_selector=None):
+        tx = wallet.create_transaction(receiver_address, amount, self.my_unspent_tx_outs(wallet), self.tx_pool, 
+                                       coin_selector)
+        return self.send_created_transaction(tx)
+
+    def send_transactions(self, wallet, payments, coin_selector=None):
+        ''' Creates, validates and broadcasts a transaction for each payment.
+
+        Params:
+            - wallet (Wallet): The wallet paying.
+            - payments (list<(bytes, Decimal)>): The receiver address and amount of each payment.
+            - coin_selector (coin_selection.CoinSelector): The strategy selecting the outputs
+                to be spent. Defaults to the `coin_selector` of the wallet.
+
+        Returns ((list<Transaction>, list<(Transaction, str)>)): The transactions added to the
+            transaction pool, announced to the peers in a single message, and the rejected ones
+            with the reason of their rejection.
+        '''
+        for receiver_address, amount in payments:
+            if not TxOut.is_valid_address(receiver_address):
+                raise BadRequestError('invalid address', payload={'address': bytes_to_hex(receiver_address)})
+        txs = wallet.create_transactions(payments, self.my_unspent_tx_outs(wallet), self.tx_pool, coin_selector)
+        accepted = self.tx_pool.add_transactions(txs, self.unspent_by_outpoint)
+        if accepted:
+            self.broadcast_transactions(accepted)
+        rejected = [(tx, self.tx_pool.rejection_reason(tx, self.unspent_by_outpoint))
+                    for tx in txs if tx not in accepted]
+        return (accepted, rejected)
 
     def unspent_tx_outs_for_address(self, address):
-        return [uTxO for uTxO in self.unspent_tx_outs if uTxO.address == address]
+        return list(self.unspent_by_address.get(address, {}).values())
 
     def my_unspent_tx_outs(self, wallet):
         return self.unspent_tx_outs_for_address(wallet.get_public_key())
 
+    def send_payment(self, wallet, payments, coin_selector=None):
+        ''' Creates, validates and broadcasts a single transaction paying all the payments.
+
+        Params:
+            - wallet (Wallet): The wallet paying.
+            - payments (list<(bytes, Decimal)>): The receiver address and amount of each payment.
+            - coin_selector (coin_selection.CoinSelector): The strategy selecting the outputs
+                to be spent. Defaults to the `coin_selector` of the wallet.
+
+        Returns (Transaction): The transaction added to the transaction pool.
+        '''
+        for receiver_address, _ in payments:
+            if not TxOut.is_valid_address(receiver_address):
+                raise BadRequestError('invalid address', payload={'address': bytes_to_hex(receiver_address)})
+        tx = wallet.create_payment_transaction(payments, self.my_unspent_tx_outs(wallet), self.tx_pool, coin_selector)
+        return self.send_created_transaction(tx)
+
+    def send_consolidation(self, wallet, max_inputs=None):
+        ''' Creates, validates and broadcasts a transaction sweeping the smallest outputs of the
+        wallet into a single output.
+
+        Returns (Transaction): The transaction added to the transaction pool or None if the 
+            wallet has nothing to consolidate.
+        '''
+        tx = wallet.create_consolidation_transaction(self.my_unspent_tx_outs(wallet), self.tx_pool, max_inputs)
+        return self.send_created_transaction(tx) if tx is not None else None
+
+    def send_created_transaction(self, tx):
+        if self.tx_pool.add_transaction(tx, self.unspent_by_outpoint):
+            self.broadcast_transactions([tx])
+        else:
+            raise BadRequestError('invalid transaction or transaction is already in the pool')
+        return tx
+
+    def submit_transactions(self, transactions):
+        ''' Admits transactions signed outside of this node into the transaction pool.
+
+        The signatures of the whole batch are verified in parallel by the worker processes,
+        then the transactions with valid signatures are added to the pool one by one. The
+        accepted transactions are announced to the peers in a single message.
+
+        Params:
+            - transactions (list<Transaction>): The signed transactions.
+
+        Returns (Deferred): Fires with a (accepted, rejected) tuple: the list of the accepted 
+            transactions and a list of (transaction, reason) tuples of the rejected ones.
+        '''
+        rejected = []
+        checked = []
+        signature_checks = []
+        for tx in transactions:
+            checks = tx.signature_checks(self.unspent_by_outpoint) if tx.has_valid_structure() else None
+            if checks is None:
+                rejected.append((tx, 'invalid structure or referenced tx_out not found'))
+            else:
+                checked.append((tx, len(checks)))
+                signature_checks.extend(checks)
+        if self.workers is None:
+            deferred = succeed(TxIn.verify_signatures(signature_checks))
+        else:
+            deferred = self.workers.map(TxIn.verify_signatures, signature_checks)
+
+        def admit(results):
+            accepted = []
+            position = 0
+            for tx, check_count in checked:
+                signatures_valid = all(results[position:position + check_count])
+                position += check_count
+                if not signatures_valid:
+                    rejected.append((tx, 'invalid signature'))
+                elif self.tx_pool.add_transaction(tx, self.unspent_by_outpoint, verify_signatures=False):
+                    accepted.append(tx)
+                else:
+                    rejected.append((tx, 'invalid transaction or transaction is already in the pool'))
+            if accepted:
+                self.broadcast_transactions(accepted)
+            return (accepted, rejected)
+
+        deferred.addCallback(admit)
+        return deferred
+
     def handle_received_transaction(self, transaction):
-        return self.tx_pool.add_transaction(transaction, self.unspent_tx_outs)
+        return self.tx_pool.add_transaction(transaction, self.unspent_by_outpoint)
+
+    def handle_received_transactions(self, transactions):
+        return self.tx_pool.add_transactions(transactions, self.unspent_by_outpoint)
 
     def get_balance(self, wallet):
         return wallet.get_balance(self.unspent_tx_outs)
@@ -259,20 +800,154 @@ class Blockchain(RawSerializable):
     def broadcast_transaction_pool(self):
         self.p2p_application.broadcast_transaction_pool(self.tx_pool)
 
+    def broadcast_transactions(self, transactions):
+        self.p2p_application.broadcast_transactions(transactions)
+
     def get_block_with_hash(self, hash):
-        block = next((block for block in self.blocks if block.hash == hash), None)
+        block = self.blocks_by_hash.get(hash)
         if not block:
             raise NotFoundError('block not found', {'hash': bytes_to_hex(hash)})
         return block
 
+    def get_encoded_block_with_hash(self, hash):
+        ''' Returns the block with the given hash in binary (`Block.to_bin`) format. 
+        A pruned block only contains its header and a `pruned` flag. '''
+        return self.encoded_blocks[self.get_block_with_hash(hash).hash]
+
+    def get_encoded_blocks(self):
+        ''' Returns the blockchain in the binary format of `Blockchain.to_bin` without
+        serializing again the blocks that were already encoded. Pruned blocks only contain
+        their header and a `pruned` flag. '''
+        return b'[' + b', '.join(self.encoded_blocks[block.hash] for block in self.blocks) + b']'
+
     def get_transaction_with_id(self, transaction_id):
-        transaction = next((tx for block in self.blocks for tx in block.data if tx.id == transaction_id), None)
+        block_hash = self.tx_block_hashes.get(transaction_id)
+        transaction = None
+        if block_hash is not None:
+            transaction = next((tx for tx in self.blocks_by_hash[block_hash].data if tx.id == transaction_id), None)
         if not transaction:
+            if self.pruned_height >= 0:
+                raise PrunedError('transaction not found, the transactions of the blocks up to {} are pruned'
+                                  .format(self.pruned_height), {'id': bytes_to_hex(transaction_id)})
             raise NotFoundError('transaction not found', {'id': bytes_to_hex(transaction_id)})
         return transaction
 
-    def replace(self, new_blocks):
-        unspent_tx_outs = Blockchain.validate_blocks(new_blocks)
+    def replace_async(self, new_blocks):
+        ''' Validates the received blocks in a worker process of `workers` and replaces
+        the blockchain with them if they are valid and have more accumulated difficulty.
+
+        Returns (Deferred): Fires with the result of `replace`.
+        '''
+        if self.is_snapshot_pending():
+            validate = (Blockchain.validate_blocks_from_snapshot, new_blocks, self.snapshot)
+        else:
+            validate = (Blockchain.validate_blocks_with_stats, new_blocks, self.assume_valid)
+        if self.workers is None:
+            return succeed(self.replace_validated(validate[0](*validate[1:]), new_blocks))
+        deferred = self.workers.submit(*validate)
+        deferred.addCallback(self.replace_validated, new_blocks)
+        return deferred
+
+    def replace_validated(self, result, new_blocks):
+        (unspent_tx_outs, stats) = result
+        self.validation_stats.add(stats)
+        if unspent_tx_outs is None:
+            print('Received blockchain is invalid.')
+            return False
+        replaced = self.replace(new_blocks, unspent_tx_outs)
+        if replaced and self.is_snapshot_pending():
+            self.validate_snapshot()
+        return replaced
+
+    def load_snapshot(self, snapshot):
+        ''' Bootstraps the node from a `UtxoSnapshot`: the first received blockchain containing the 
+        snapshot block is accepted without validating the transactions up to it, which are then
+        validated in the background. '''
+        print('Loaded snapshot: {}'.format(snapshot.info()))
+        self.snapshot = snapshot
+        self.snapshot_status = 'waiting for blocks'
+
+    def is_snapshot_pending(self):
+        return self.snapshot is not None and self.snapshot_status == 'waiting for blocks'
+
+    def validate_snapshot(self):
+        ''' Validates the blockchain from the genesis block up to the snapshot block and compares
+        the resulting unspent outputs with the snapshot.
+
+        Returns (Deferred): Fires with True if the snapshot is valid.
+        '''
+        blocks = self.blocks[:self.snapshot.height + 1]
+        self.snapshot_status = 'validating'
+        if self.workers is None:
+            return maybeDeferred(self.snapshot_validated, Blockchain.snapshot_content_hash(blocks), blocks)
+        deferred = self.workers.submit(Blockchain.snapshot_content_hash, blocks)
+        deferred.addCallback(self.snapshot_validated, blocks)
+        return deferred
+
+    def snapshot_validated(self, content_hash, blocks):
+        self.validation_stats.add(ValidationStats.of_blocks(blocks))
+        if content_hash == self.snapshot.content_hash:
+            print('Snapshot is valid')
+            self.snapshot_status = 'valid'
+            self.prune()
+            return True
+        print('SNAPSHOT IS INVALID, validating the blockchain from the genesis block')
+        self.snapshot_status = 'revalidating'
+        blocks = self.blocks[:]
+        if self.workers is None:
+            deferred = succeed(Blockchain.validate_blocks(blocks))
+        else:
+            deferred = self.workers.submit(Blockchain.validate_blocks, blocks)
+        deferred.addCallback(self.snapshot_revalidated, blocks)
+        return deferred
+
+    def snapshot_revalidated(self, unspent_tx_outs, blocks):
+        ''' Replaces the blockchain accepted with an invalid snapshot with its blocks validated from
+        the genesis block. The blocks connected during the validation were checked against the
+        unspent outputs of the snapshot and are dropped, they are received again from the peers. '''
+        self.snapshot_status = 'invalid'
+        if unspent_tx_outs is None:
+            blocks = [Block.genesis_block()]
+            unspent_tx_outs = []
+        self.blocks = blocks
+        self.unspent_tx_outs = unspent_tx_outs
+        self.rebuild_indexes()
+        for listener in self.listeners:
+            listener.chain_replaced(self)
+        self.tx_pool.update(unspent_tx_outs)
+        self.prune()
+        return False
+
+    def snapshot_info(self):
+        if self.snapshot is None:
+            return None
+        return dict(self.snapshot.info(), status=self.snapshot_status)
+
+    def get_snapshot(self, height=None):
+        ''' Creates the `UtxoSnapshot` of the block at the given height.
+
+        Returns (Deferred): Fires with the snapshot.
+        '''
+        if height is None or height == self.get_latest().index:
+            return succeed(UtxoSnapshot(self.get_latest().index, self.get_latest().hash, self.unspent_tx_outs))
+        if not isinstance(height, int) or not 0 <= height < len(self.blocks):
+            raise BadRequestError('invalid height', {'height': height})
+        self.check_not_pruned(0)
+        blocks = self.blocks[:height + 1]
+        if self.workers is None:
+            return succeed(UtxoSnapshot.from_blocks(blocks))
+        return self.workers.submit(UtxoSnapshot.from_blocks, blocks)
+
+    def replace(self, new_blocks, unspent_tx_outs=None):
+        ''' Replaces the blockchain with the received blocks if they are valid and have more
+        accumulated difficulty.
+        Params:
+            - new_blocks (list<Block>): The received blockchain.
+            - unspent_tx_outs (list<UnspentTxOut>): The result of `validate_blocks(new_blocks)`
+                if the blocks were already validated.
+        '''
+        if unspent_tx_outs is None:
+            unspent_tx_outs = Blockchain.validate_blocks(new_blocks, self.assume_valid, self.validation_stats)
         valid_chain = unspent_tx_outs is not None
         if (isinstance(new_blocks, list)
             and valid_chain
@@ -280,7 +955,11 @@ class Blockchain(RawSerializable):
             print('Received blockchain is valid. Replacing current blockchain with received blockchain.')
             self.blocks = new_blocks
             self.unspent_tx_outs = unspent_tx_outs
+            self.rebuild_indexes()
+            for listener in self.listeners:
+                listener.chain_replaced(self)
             self.tx_pool.update(unspent_tx_outs)
+            self.prune()
             self.broadcast_latest()
             return True
         else:
@@ -0,0 +1,251 @@
+# pyncoin/bootstrap.py
+
+''' Implements the bootstrap files used to transfer the blockchain offline.
+
+A bootstrap file is a sequence of blocks in the binary format of `Block.to_bin`, each one
+preceded by its length as a 4 byte big endian integer. The file is written and read one
+block at a time, so neither side ever holds the whole blockchain in a single message.
+
+Usage:
+    python bootstrap.py export http://127.0.0.1:5000 bootstrap.dat [--from N]
+    python bootstrap.py info bootstrap.dat
+'''
+
+import argparse
+import struct
+from urllib.request import urlopen
+
+from twisted.internet.defer import Deferred, succeed
+from twisted.python.failure import Failure
+
+from blockchain import Block
+from transaction import TxIn
+from utils import BadRequestError, format_exception
+
+LENGTH = struct.Struct('>I')
+
+def encode_record(block_bin):
+    ''' Returns (bytes): A block in binary format prefixed by its length. '''
+    return LENGTH.pack(len(block_bin)) + block_bin
+
+def read_records(stream):
+    ''' Reads the blocks of a bootstrap file one by one.
+    Params:
+        - stream (file): The bootstrap file opened in binary mode.
+    Returns (generator<bytes>): The blocks in binary format.
+    '''
+    while True:
+        prefix = stream.read(LENGTH.size)
+        if not prefix:
+            return
+        if len(prefix) != LENGTH.size:
+            raise BadRequestError('truncated bootstrap file')
+        (length,) = LENGTH.unpack(prefix)
+        block_bin = stream.read(length)
+        if len(block_bin) != length:
+            raise BadRequestError('truncated bootstrap file')
+        yield block_bin
+
+def read_blocks(stream):
+    ''' Returns (generator<Block>): The blocks of a bootstrap file, deserialized lazily. '''
+    for block_bin in read_records(stream):
+        yield Block.from_bin(block_bin)
+
+class BlockImporter:
+    ''' Connects the blocks of a bootstrap file to the blockchain in a pipeline of three stages:
+    the blocks are decoded in batches on the reactor thread, the signatures of each batch are
+    verified by the worker processes and the blocks are connected serially in the order of the
+    file. At most `max_batches` batches are in memory at any time.
+    '''
+
+    BATCH_SIZE = 100
+    MAX_BATCHES = 4
+
+    def __init__(self, blockchain, workers, batch_size=BATCH_SIZE, max_batches=MAX_BATCHES):
+        ''' Initializes the importer.
+        Params:
+            - blockchain (blockchain.Blockchain): The blockchain the blocks are connected to.
+            - workers (workers.WorkerPool): The pool verifying the signatures, or None to verify
+                them on the reactor thread.
+            - batch_size (int): The number of blocks decoded and verified together.
+            - max_batches (int): The maximum number of batches being verified or waiting to be
+                connected.
+        '''
+        self.blockchain = blockchain
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.blocks = None
+        self.in_flight = []
+        self.pending_addresses = {}
+        self.connected = 0
+        self.skipped = 0
+        self.done = None
+        self.failed = False
+        self.pumping = False
+
+    def import_file(self, path):
+        ''' Imports the blocks of a bootstrap file.
+
+        Returns (Deferred): Fires with the number of connected blocks when the whole file is
+            imported, or errbacks if a block can not be connected.
+        '''
+        stream = open(path, 'rb')
+        self.done = Deferred()
+        self.done.addBoth(lambda result: (stream.close(), result)[1])
+        self.blocks = read_blocks(stream)
+        self.pump()
+        return self.done
+
+    def pump(self):
+        ''' Decodes new batches until `max_batches` are in flight and connects the oldest 
+        batches whose signatures are verified. '''
+        if self.pumping or self.failed:
+            return
+        self.pumping = True
+        try:
+            while True:
+                self.fill()
+                if self.failed or not self.in_flight or self.in_flight[0][1] is None:
+                    break
+                (batch, verified_tx_ids) = self.in_flight.pop(0)
+                self.connect(batch, verified_tx_ids)
+        except Exception as ex:
+            self.fail(ex)
+        finally:
+            self.pumping = False
+        if not self.failed and not self.in_flight and self.blocks is None and not self.done.called:
+            print('Imported {} blocks, skipped {} known blocks'.format(self.connected, self.skipped))
+            self.done.callback(self.connected)
+
+    def fill(self):
+        while self.blocks is not None and len(self.in_flight) < self.max_batches:
+            batch = self.next_batch()
+            if not batch:
+                self.blocks = None
+                return
+            entry = [batch, None]
+            self.in_flight.append(entry)
+            self.verify(batch).addCallbacks(self.verified, self.fail, callbackArgs=(entry,))
+
+    def verified(self, verified_tx_ids, entry):
+        entry[1] = verified_tx_ids
+        self.pump()
+
+    def next_batch(self):
+        batch = []
+        for block in self.blocks:
+            if block.index < len(self.blockchain.blocks) and not batch and not self.in_flight:
+                if self.blockchain.blocks[block.index].hash != block.hash:
+                    raise BadRequestError('bootstrap file does not match the blockchain', {'index': block.index})
+                self.skipped += 1
+                continue
+            batch.append(block)
+            if len(batch) == self.batch_size:
+                break
+        return batch
+
+    def verify(self, batch):
+        ''' Starts the verification of the signatures of a batch of blocks.
+
+        The addresses of the spent outputs are looked up among the unspent outputs of the
+        blockchain and the outputs created by the batches not connected yet.
+
+        Returns (Deferred): Fires with the set of the ids of the transactions whose signatures
+            are all valid.
+        '''
+        checks = []
+        owners = []
+        for block in batch:
+            for tx in block.data:
+                for index, tx_out in enumerate(tx.tx_outs):
+                    self.pending_addresses[(tx.id, index)] = tx_out.address
+            for tx in block.data[1:]:
+                tx_checks = []
+                for tx_in in tx.tx_ins:
+                    address = self.find_address(tx_in.tx_out_id, tx_in.tx_out_index)
+                    if address is None:
+                        break
+                    tx_checks.append((address, tx_in.signature, tx.id))
+                else:
+                    checks.extend(tx_checks)
+                    owners.extend([tx.id] * len(tx_checks))
+        if self.workers is None:
+            deferred = succeed(TxIn.verify_signatures(checks))
+        else:
+            deferred = self.workers.map(TxIn.verify_signatures, checks)
+        deferred.addCallback(BlockImporter.verified_ids, owners)
+        return deferred
+
+    def find_address(self, tx_out_id, tx_out_index):
+        address = self.pending_addresses.get((tx_out_id, tx_out_index))
+        if address is None:
+            uTxO = self.blockchain.unspent_by_outpoint.get((tx_out_id, tx_out_index))
+            address = uTxO.address if uTxO is not None else None
+        return address
+
+    @staticmethod
+    def verified_ids(results, owners):
+        failed = {owner for owner, valid in zip(owners, results) if not valid}
+        return {owner for owner in owners if owner not in failed}
+
+    def connect(self, batch, verified_tx_ids):
+        ''' Connects a batch of blocks. The signatures of the transactions in `verified_tx_ids`
+        are not verified again. '''
+        for block in batch:
+            if not self.blockchain.add_block(block, verified_tx_ids):
+                raise BadRequestError('invalid block in bootstrap file', {'index': block.index})
+            self.connected += 1
+        for block in batch:
+            for tx in block.data:
+                for index in range(len(tx.tx_outs)):
+                    self.pending_addresses.pop((tx.id, index), None)
+        print('Imported blocks up to {}'.format(batch[-1].index))
+
+    def fail(self, ex):
+        if isinstance(ex, Failure):
+            ex = ex.value
+        if self.failed:
+            return
+        print('Block import failed: {}'.format(format_exception(ex)))
+        self.failed = True
+        self.in_flight = []
+        self.blocks = None
+        self.done.errback(ex)
+
+def export_blocks(node_url, path, start=0):
+    ''' Downloads the blockchain of a running node to a bootstrap file, without holding it in memory.
+    Returns (int): The number of bytes written.
+    '''
+    url = '{}/bootstrap?from={}'.format(node_url.rstrip('/'), start)
+    written = 0
+    with urlopen(url) as response, open(path, 'wb') as bootstrap_file:
+        while True:
+            chunk = response.read(64 * 1024)
+            if not chunk:
+                return written
+            bootstrap_file.write(chunk)
+            written += len(chunk)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='exports and inspects bootstrap files')
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser('export', help='downloads the blockchain from a running node')
+    export_parser.add_argument('node_url', help='url of the web server of the node, e.g. http://127.0.0.1:5000')
+    export_parser.add_argument('path', help='file the blocks are written to')
+    export_parser.add_argument('--from', dest='start', help='index of the first exported block', default=0, type=int)
+    info_parser = commands.add_parser('info', help='prints the range of the blocks of a bootstrap file')
+    info_parser.add_argument('path', help='the bootstrap file')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        print('Written {} bytes'.format(export_blocks(args.node_url, args.path, args.start)))
+    elif args.command == 'info':
+        with open(args.path, 'rb') as bootstrap_file:
+            blocks = [(block.index, block.hash.hex()) for block in read_blocks(bootstrap_file)]
+        if blocks:
+            print({'blocks': len(blocks), 'first': blocks[0][0], 'last': blocks[-1][0], 'lastHash': blocks[-1][1]})
+        else:
+            print({'blocks': 0})
+    else:
+        parser.print_help()
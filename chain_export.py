@@ -0,0 +1,235 @@
+# pyncoin/chain_export.py
+
+''' Exports the blockchain to columnar files for offline analysis.
+
+The blocks are read one by one from a bootstrap file or from the `/bootstrap` service of a
+running node, and their blocks, transactions, inputs and outputs are written as NumPy arrays
+to one `.npz` file per chunk of blocks, so that at most one chunk is in memory. A `manifest.json`
+file lists the chunks and the arrays they contain. Running the export again on the same
+directory appends only the blocks after the last exported one.
+
+The arrays of a chunk (all the rows of a table have the same length):
+
+    - blocks: `height`, `timestamp`, `difficulty`, `nonce`, `hash` and `previous_hash`
+        (32 bytes per row, zeros for the genesis block), `tx_count`.
+    - txs: `height`, `index` (position in the block), `id`, `input_count`, `output_count`.
+    - inputs: `height`, `tx_index`, `index`, `tx_out_id` (zeros for coinbase inputs), `tx_out_index`.
+    - outputs: `height`, `tx_index`, `index`, `amount` (integer units of 1e-8 coins),
+        `address_offsets` and `address_data`: the address of output `i` is
+        `address_data[address_offsets[i]:address_offsets[i + 1]]`.
+
+Usage:
+    python chain_export.py export bootstrap.dat chain_export [--chunk-size N]
+    python chain_export.py export http://127.0.0.1:5000 chain_export
+    python chain_export.py info chain_export
+'''
+
+import argparse
+import itertools
+import json
+import os
+from urllib.request import urlopen
+
+import numpy
+
+from bootstrap import read_blocks
+from utils import BadRequestError
+from utxo_stats import UtxoColumns
+
+HASH_SIZE = 32
+NO_HASH = bytes(HASH_SIZE)
+
+class ChunkWriter:
+    ''' Collects the columns of a chunk of blocks. '''
+
+    def __init__(self):
+        self.columns = {}
+        self.address_data = []
+        self.address_size = 0
+        self.first_height = None
+        self.last_block = None
+
+    def append(self, table, **values):
+        for name, value in values.items():
+            self.columns.setdefault('{}_{}'.format(table, name), []).append(value)
+
+    def __len__(self):
+        return len(self.columns.get('blocks_height', []))
+
+    def add_block(self, block):
+        if self.first_height is None:
+            self.first_height = block.index
+        self.last_block = block
+        transactions = block.data
+        self.append('blocks', height=block.index, timestamp=int(block.timestamp.timestamp()),
+                    difficulty=block.difficulty, nonce=block.nonce, hash=block.hash,
+                    previous_hash=block.previous_hash or NO_HASH, tx_count=len(transactions))
+        for tx_index, tx in enumerate(transactions):
+            self.append('txs', height=block.index, index=tx_index, id=tx.id,
+                        input_count=len(tx.tx_ins), output_count=len(tx.tx_outs))
+            for index, tx_in in enumerate(tx.tx_ins):
+                self.append('inputs', height=block.index, tx_index=tx_index, index=index,
+                            tx_out_id=tx_in.tx_out_id or NO_HASH, tx_out_index=tx_in.tx_out_index)
+            for index, tx_out in enumerate(tx.tx_outs):
+                self.append('outputs', height=block.index, tx_index=tx_index, index=index,
+                            amount=int(tx_out.amount * UtxoColumns.AMOUNT_UNITS),
+                            address_offsets=self.address_size)
+                self.address_data.append(tx_out.address)
+                self.address_size += len(tx_out.address)
+
+    def to_arrays(self):
+        arrays = {}
+        for name, values in self.columns.items():
+            if name.endswith(('hash', '_id')):
+                arrays[name] = numpy.frombuffer(b''.join(values), dtype=numpy.uint8).reshape(-1, HASH_SIZE)
+            elif name.endswith(('nonce', 'amount', 'timestamp', 'offsets')):
+                arrays[name] = numpy.array(values, dtype=numpy.int64)
+            else:
+                arrays[name] = numpy.array(values, dtype=numpy.int32)
+        arrays['outputs_address_offsets'] = numpy.append(
+            arrays.get('outputs_address_offsets', numpy.zeros(0, dtype=numpy.int64)), self.address_size)
+        arrays['outputs_address_data'] = numpy.frombuffer(b''.join(self.address_data), dtype=numpy.uint8)
+        return arrays
+
+class ChainExport:
+    ''' A directory of exported chunks and its manifest. '''
+
+    MANIFEST = 'manifest.json'
+    CHUNK_SIZE = 1000
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, ChainExport.MANIFEST)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as manifest_file:
+                self.chunks = json.load(manifest_file)['chunks']
+        else:
+            self.chunks = []
+
+    def next_height(self):
+        return self.chunks[-1]['lastHeight'] + 1 if self.chunks else 0
+
+    def last_hash(self):
+        return bytes.fromhex(self.chunks[-1]['lastHash']) if self.chunks else None
+
+    def save_manifest(self):
+        with open(self.manifest_path + '.tmp', 'w') as manifest_file:
+            json.dump({'chunks': self.chunks}, manifest_file, indent=1)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def write_chunk(self, writer):
+        name = 'chunk-{:09d}-{:09d}.npz'.format(writer.first_height, writer.last_block.index)
+        arrays = writer.to_arrays()
+        numpy.savez(os.path.join(self.directory, name), **arrays)
+        self.chunks.append({
+            'file': name,
+            'firstHeight': writer.first_height,
+            'lastHeight': writer.last_block.index,
+            'lastHash': writer.last_block.hash.hex(),
+            'rows': {table: len(arrays[table + '_height']) for table in ('blocks', 'txs', 'inputs', 'outputs')
+                     if table + '_height' in arrays}
+        })
+        self.save_manifest()
+        print('Exported blocks {} to {}'.format(writer.first_height, writer.last_block.index))
+
+    def drop_last_chunk(self):
+        chunk = self.chunks.pop()
+        os.remove(os.path.join(self.directory, chunk['file']))
+        self.save_manifest()
+        print('Dropped the chunk of blocks {} to {}'.format(chunk['firstHeight'], chunk['lastHeight']))
+
+    def export(self, open_source, chunk_size=CHUNK_SIZE):
+        ''' Appends the blocks after the last exported one. If the source forked from the exported
+        blocks, the last chunks are dropped and exported again.
+        Params:
+            - open_source (function): Returns a binary stream of bootstrap records starting at the
+                given height or before it.
+            - chunk_size (int): The number of blocks of each chunk.
+        Returns (int): The number of exported blocks.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            start = self.next_height()
+            # the last exported block is read again to check that the source did not fork
+            begin = max(start - 1, 0)
+            with open_source(begin) as stream:
+                blocks = (block for block in read_blocks(stream) if block.index >= begin)
+                first = next(blocks, None)
+                if first is None or first.index != begin:
+                    raise BadRequestError('the source does not contain the block', {'index': begin})
+                if start > 0 and first.hash != self.last_hash():
+                    print('The source forked from the exported blocks')
+                    self.drop_last_chunk()
+                    continue
+                if start == 0:
+                    blocks = itertools.chain([first], blocks)
+                return self.export_blocks(blocks, chunk_size)
+
+    def export_blocks(self, blocks, chunk_size):
+        exported = 0
+        writer = ChunkWriter()
+        for block in blocks:
+            writer.add_block(block)
+            exported += 1
+            if len(writer) == chunk_size:
+                self.write_chunk(writer)
+                writer = ChunkWriter()
+        if len(writer):
+            self.write_chunk(writer)
+        return exported
+
+    def load(self, table):
+        ''' Returns (dict<str, numpy.ndarray>): The columns of a table (`blocks`, `txs`, `inputs` or
+        `outputs`) concatenated over all the chunks. The address offsets of the outputs are
+        adjusted to the concatenated address data. '''
+        columns = {}
+        address_base = 0
+        for chunk in self.chunks:
+            with numpy.load(os.path.join(self.directory, chunk['file'])) as arrays:
+                for name in arrays.files:
+                    if not name.startswith(table + '_'):
+                        continue
+                    values = arrays[name]
+                    if name == 'outputs_address_offsets':
+                        values = values[:-1] + address_base
+                    columns.setdefault(name[len(table) + 1:], []).append(values)
+                if table == 'outputs':
+                    address_base += len(arrays['outputs_address_data'])
+        result = {name: numpy.concatenate(values) for name, values in columns.items()}
+        if table == 'outputs' and 'address_offsets' in result:
+            result['address_offsets'] = numpy.append(result['address_offsets'], address_base)
+        return result
+
+def source_opener(source):
+    ''' Returns (function): Opens the bootstrap records of a bootstrap file or of the node at the
+    url `source` from a given height. '''
+    if source.startswith(('http://', 'https://')):
+        return lambda start: urlopen('{}/bootstrap?from={}'.format(source.rstrip('/'), start))
+    return lambda start: open(source, 'rb')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='exports the blockchain to columnar NumPy files')
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser('export', help='appends the new blocks to an export directory')
+    export_parser.add_argument('source', help='a bootstrap file or the url of the web server of a node, '
+                                              'e.g. http://127.0.0.1:5000')
+    export_parser.add_argument('directory', help='the export directory')
+    export_parser.add_argument('--chunk-size', help='number of blocks of each chunk file',
+                               default=ChainExport.CHUNK_SIZE, type=int)
+    info_parser = commands.add_parser('info', help='prints the chunks of an export directory')
+    info_parser.add_argument('directory', help='the export directory')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        chain_export = ChainExport(args.directory)
+        exported = chain_export.export(source_opener(args.source), args.chunk_size)
+        print('Exported {} blocks, next height {}'.format(exported, chain_export.next_height()))
+    elif args.command == 'info':
+        chain_export = ChainExport(args.directory)
+        rows = {}
+        for chunk in chain_export.chunks:
+            for table, count in chunk['rows'].items():
+                rows[table] = rows.get(table, 0) + count
+        print({'chunks': len(chain_export.chunks), 'nextHeight': chain_export.next_height(), 'rows': rows})
+    else:
+        parser.print_help()
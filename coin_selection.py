@@ -0,0 +1,129 @@
+# pyncoin/coin_selection.py
+
+''' Implements the strategies used by the wallet to select the unspent outputs of a transaction. '''
+
+from decimal import Decimal
+
+from utils import UnauthorizedError, BadRequestError
+
+class CoinSelector:
+    ''' Base class of the coin selection strategies. '''
+
+    MAX_INPUTS = 100
+
+    def __init__(self, max_inputs=MAX_INPUTS):
+        ''' Initializes the coin selector.
+        Params:
+            - max_inputs (int): The maximum number of inputs of a transaction.
+        '''
+        self.max_inputs = max_inputs
+
+    def select(self, amount, unspent_tx_outs):
+        ''' Selects the unspent outputs to be spent.
+        Params:
+            - amount (Decimal): The amount to be payed.
+            - unspent_tx_outs (list<transaction.UnspentTxOut>): The spendable outputs of the wallet.
+        Returns ((list<transaction.UnspentTxOut>, Decimal)): The selected outputs and the left over
+            amount that should be payed back to the wallet.
+        '''
+        raise AssertionError('CoinSelector.select abstract method called.')
+
+    def largest_first(self, amount, unspent_tx_outs):
+        selected = []
+        current_amount = Decimal(0)
+        for uTxO in sorted(unspent_tx_outs, key=lambda uTxO: uTxO.amount, reverse=True)[:self.max_inputs]:
+            selected.append(uTxO)
+            current_amount += uTxO.amount
+            if current_amount >= amount:
+                return (selected, current_amount - amount)
+        if sum(uTxO.amount for uTxO in unspent_tx_outs) >= amount:
+            raise UnauthorizedError('the amount can not be payed with at most {} inputs'.format(self.max_inputs))
+        raise UnauthorizedError('not enough coins to send transaction ' +
+                                'or there are pending transactions from this address')
+
+class LargestFirstSelector(CoinSelector):
+    ''' Spends the largest outputs first, minimizing the number of inputs. '''
+
+    NAME = 'largestFirst'
+
+    def select(self, amount, unspent_tx_outs):
+        return self.largest_first(Decimal(amount), unspent_tx_outs)
+
+class BranchAndBoundSelector(CoinSelector):
+    ''' Searches for a set of outputs matching the amount exactly, so that no change output
+    is created. Falls back to largest first if no exact match is found within `max_tries` steps. '''
+
+    NAME = 'branchAndBound'
+
+    MAX_TRIES = 100000
+
+    def __init__(self, max_inputs=CoinSelector.MAX_INPUTS, max_tries=MAX_TRIES):
+        CoinSelector.__init__(self, max_inputs)
+        self.max_tries = max_tries
+
+    def select(self, amount, unspent_tx_outs):
+        amount = Decimal(amount)
+        exact_match = self.find_exact_match(amount, unspent_tx_outs)
+        if exact_match is not None:
+            return (exact_match, Decimal(0))
+        return self.largest_first(amount, unspent_tx_outs)
+
+    def find_exact_match(self, amount, unspent_tx_outs):
+        candidates = sorted(unspent_tx_outs, key=lambda uTxO: uTxO.amount, reverse=True)
+        remaining = [Decimal(0)] * (len(candidates) + 1)
+        for i in range(len(candidates) - 1, -1, -1):
+            remaining[i] = remaining[i + 1] + candidates[i].amount
+        selected = []
+        tries = 0
+        # each stack item is (candidate index, sum of the selected outputs, include the candidate)
+        stack = [(0, Decimal(0), True), (0, Decimal(0), False)]
+        while stack and tries < self.max_tries:
+            tries += 1
+            index, current_amount, include = stack.pop()
+            del selected[index:]
+            if include:
+                selected.append(candidates[index])
+                current_amount += candidates[index].amount
+            else:
+                selected.append(None)
+            if current_amount == amount:
+                return [uTxO for uTxO in selected if uTxO is not None]
+            if (current_amount > amount
+                    or current_amount + remaining[index + 1] < amount
+                    or index + 1 == len(candidates)
+                    or len(selected) - selected.count(None) >= self.max_inputs):
+                continue
+            stack.append((index + 1, current_amount, False))
+            stack.append((index + 1, current_amount, True))
+        return None
+
+class ConsolidatingSelector(CoinSelector):
+    ''' Pays with the largest outputs first, then adds the smallest outputs of the wallet as extra
+    inputs up to `max_inputs`, sweeping dust into the change output. '''
+
+    NAME = 'consolidate'
+
+    def select(self, amount, unspent_tx_outs):
+        (selected, left_over_amount) = self.largest_first(Decimal(amount), unspent_tx_outs)
+        selected_ids = {id(uTxO) for uTxO in selected}
+        dust = sorted((uTxO for uTxO in unspent_tx_outs if id(uTxO) not in selected_ids),
+                      key=lambda uTxO: uTxO.amount)
+        for uTxO in dust[:self.max_inputs - len(selected)]:
+            selected.append(uTxO)
+            left_over_amount += uTxO.amount
+        return (selected, left_over_amount)
+
+COIN_SELECTORS = {selector.NAME: selector 
+                  for selector in [LargestFirstSelector, BranchAndBoundSelector, ConsolidatingSelector]}
+
+def get_coin_selector(name, max_inputs=CoinSelector.MAX_INPUTS):
+    ''' Returns a new coin selector.
+    Params:
+        - name (str): The name of the strategy, one of the keys of `COIN_SELECTORS`.
+        - max_inputs (int): The maximum number of inputs of a transaction.
+    Returns (CoinSelector): The coin selector.
+    '''
+    if name not in COIN_SELECTORS:
+        raise BadRequestError('invalid coin selection strategy',
+                              {'strategy': name, 'strategies': list(COIN_SELECTORS)})
+    return COIN_SELECTORS[name](max_inputs)
@@ -0,0 +1,300 @@
+# pyncoin/loadtest.py
+
+''' Implements a load generator for the REST services of one or more nodes.
+
+Requests are sent at exponentially distributed intervals with the given mean rate, whether or
+not the previous ones were answered (an open-loop load, like the one of many independent
+users), and each one goes to a random endpoint of the mix and a random node. The latency of a
+request is measured from the time it was scheduled, so a client falling behind shows up in the
+latency instead of silently lowering the load. When `--max-in-flight` requests are waiting
+for their response, the new ones are skipped and counted.
+
+The endpoints of the mix:
+
+    - `sendTransaction`: `POST /sendTransaction` paying `--amount` to a random node.
+    - `mineBlock`: `POST /mineBlock`.
+    - `balance`: `GET /balance`.
+    - `block`: `GET /block/<hash>` of a random known block.
+    - `transaction`: `GET /transaction/<id>` of a random known transaction.
+
+The known blocks and transactions are read from `/blocks` at startup and updated with the
+blocks mined during the test.
+
+Usage:
+    python loadtest.py http://127.0.0.1:5000 [http://127.0.0.1:5001 ...] --rate 50 --duration 60 \\
+        --mix sendTransaction=2,mineBlock=1,balance=5,block=5,transaction=5
+'''
+
+import argparse
+import json
+import random
+import sys
+import warnings
+from io import BytesIO
+
+from twisted.internet import defer, reactor
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+
+from utils import format_exception, percentile
+
+DEFAULT_MIX = 'sendTransaction=2,mineBlock=1,balance=5,block=5,transaction=5'
+
+def parse_mix(mix):
+    ''' Returns (dict<str, float>): The weight of each endpoint of a `name=weight,...` mix. '''
+    weights = {}
+    for item in mix.split(','):
+        (name, _, weight) = item.partition('=')
+        if name not in LoadGenerator.ENDPOINTS:
+            raise ValueError('unknown endpoint {}, valid endpoints: {}'.format(name, ', '.join(LoadGenerator.ENDPOINTS)))
+        weights[name] = float(weight or 1)
+    return weights
+
+def error_reason(code, content):
+    ''' Returns (str): The status code of an error response followed by the message of the node,
+        if the body is a serialized `utils.HttpError`.
+    '''
+    try:
+        return '{} {}'.format(code, json.loads(content.decode('utf-8'))['message'])
+    except (ValueError, KeyError, TypeError):
+        return str(code)
+
+class LoadTestError(Exception):
+    ''' Raised when a node can not be prepared for the test. '''
+
+class EndpointStats:
+    ''' The results of the requests sent to an endpoint. '''
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = {}
+        self.skipped = 0
+
+    def add_error(self, reason, count=1):
+        self.errors[reason] = self.errors.get(reason, 0) + count
+
+    @classmethod
+    def merge(cls, all_stats):
+        ''' Returns (EndpointStats): The results of the requests to all the given endpoints. '''
+        total = cls()
+        for stats in all_stats:
+            total.latencies.extend(stats.latencies)
+            total.skipped += stats.skipped
+            for reason, count in stats.errors.items():
+                total.add_error(reason, count)
+        return total
+
+    def to_raw(self, seconds):
+        latencies = [latency * 1000 for latency in self.latencies]
+        return {
+            'ok': len(self.latencies),
+            'errors': self.errors,
+            'skipped': self.skipped,
+            'throughput': len(self.latencies) / seconds if seconds else None,
+            'latencyMs': {
+                'p50': percentile(latencies, 0.5),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+                'max': max(latencies) if latencies else None
+            }
+        }
+
+class LoadGenerator:
+    ''' Sends an open-loop load to the nodes and collects the latency of each endpoint. '''
+
+    ENDPOINTS = ('sendTransaction', 'mineBlock', 'balance', 'block', 'transaction')
+
+    def __init__(self, node_urls, mix, rate, duration, max_in_flight=1000, amount='0.01', seed=None):
+        ''' Initializes the load generator.
+        Params:
+            - node_urls (list<str>): The urls of the web servers of the nodes.
+            - mix (dict<str, float>): The weight of each endpoint, see `parse_mix`.
+            - rate (float): The mean number of requests per second.
+            - duration (float): The number of seconds during which requests are sent.
+            - max_in_flight (int): The maximum number of requests waiting for their response.
+            - amount (str): The amount of the transactions.
+            - seed (int): The seed of the random generator, None for a random one.
+        '''
+        self.node_urls = [url.rstrip('/') for url in node_urls]
+        self.endpoints = list(mix)
+        self.weights = [mix[name] for name in self.endpoints]
+        self.rate = rate
+        self.duration = duration
+        self.max_in_flight = max_in_flight
+        self.amount = amount
+        self.rng = random.Random(seed)
+        self.pool = HTTPConnectionPool(reactor)
+        self.pool.maxPersistentPerHost = max_in_flight
+        self.agent = Agent(reactor, pool=self.pool)
+        self.addresses = []
+        self.block_hashes = {url: [] for url in self.node_urls}
+        self.tx_ids = {url: [] for url in self.node_urls}
+        self.stats = {name: EndpointStats() for name in self.endpoints}
+        self.in_flight = 0
+        self.pending = set()
+        self.started_at = None
+
+    def request(self, method, url, params=None):
+        ''' Returns (Deferred): Fires with the status code and the body of the response. '''
+        body = FileBodyProducer(BytesIO(json.dumps(params).encode('utf-8'))) if params is not None else None
+        headers = Headers({b'Content-Type': [b'application/json']})
+        deferred = self.agent.request(method, url.encode('utf-8'), headers, body)
+        deferred.addCallback(lambda response: readBody(response).addCallback(
+            lambda content: (response.code, content)))
+        return deferred
+
+    @defer.inlineCallbacks
+    def get_json(self, url):
+        ''' Returns (Deferred): Fires with the decoded json body of the response to a GET request,
+            or fails with a `LoadTestError` if the node does not answer with a 200 status code.
+        '''
+        (code, content) = yield self.request(b'GET', url)
+        if code != 200:
+            raise LoadTestError('GET {} failed with status {}'.format(url, error_reason(code, content)))
+        return json.loads(content.decode('utf-8'))
+
+    @defer.inlineCallbacks
+    def setup(self):
+        ''' Reads the address, the blocks and the transactions of each node. '''
+        for url in self.node_urls:
+            self.addresses.append((yield self.get_json(url + '/address'))['address'])
+            for raw_block in (yield self.get_json(url + '/blocks')):
+                self.add_block(url, raw_block)
+
+    def add_block(self, node_url, raw_block):
+        self.block_hashes[node_url].append(raw_block['hash'])
+        self.tx_ids[node_url].extend(raw_tx['id'] for raw_tx in raw_block.get('data') or [])
+
+    def next_request(self, name, node_url):
+        ''' Returns ((bytes, str, dict)): The method, url and parameters of a request to an
+        endpoint, or None if it can not be sent yet. '''
+        if name == 'sendTransaction':
+            params = {'address': self.rng.choice(self.addresses), 'amount': self.amount}
+            return (b'POST', node_url + '/sendTransaction', params)
+        elif name == 'mineBlock':
+            return (b'POST', node_url + '/mineBlock', {})
+        elif name == 'balance':
+            return (b'GET', node_url + '/balance', None)
+        elif name == 'block':
+            return (b'GET', node_url + '/block/' + self.rng.choice(self.block_hashes[node_url]), None)
+        elif self.tx_ids[node_url]:
+            return (b'GET', node_url + '/transaction/' + self.rng.choice(self.tx_ids[node_url]), None)
+        return None
+
+    def schedule(self, at):
+        ''' Schedules the request at time `at` and the following one, until the end of the test. '''
+        if at - self.started_at >= self.duration:
+            return
+        reactor.callLater(max(0, at - reactor.seconds()), self.fire, at)
+
+    def fire(self, scheduled_at):
+        self.schedule(scheduled_at + self.rng.expovariate(self.rate))
+        name = self.rng.choices(self.endpoints, self.weights)[0]
+        stats = self.stats[name]
+        node_url = self.rng.choice(self.node_urls)
+        request = self.next_request(name, node_url)
+        if request is None or self.in_flight >= self.max_in_flight:
+            stats.skipped += 1
+            return
+        self.in_flight += 1
+        deferred = self.request(*request)
+        deferred.addCallbacks(self.answered, self.failed, callbackArgs=(name, node_url, scheduled_at), errbackArgs=(name,))
+        deferred.addBoth(self.done, deferred)
+        self.pending.add(deferred)
+
+    def answered(self, result, name, node_url, scheduled_at):
+        (code, content) = result
+        stats = self.stats[name]
+        if code >= 400:
+            stats.add_error(error_reason(code, content))
+            return
+        stats.latencies.append(reactor.seconds() - scheduled_at)
+        if name == 'mineBlock':
+            raw_block = json.loads(content.decode('utf-8'))
+            if raw_block is not None:
+                self.add_block(node_url, raw_block)
+
+    def failed(self, failure, name):
+        self.stats[name].add_error(failure.type.__name__)
+
+    def done(self, _, deferred):
+        self.in_flight -= 1
+        self.pending.discard(deferred)
+
+    @defer.inlineCallbacks
+    def run(self):
+        ''' Runs the test and waits for the pending responses.
+        Returns (Deferred): Fires with the report of the test.
+        '''
+        yield self.setup()
+        self.started_at = reactor.seconds()
+        self.schedule(self.started_at + self.rng.expovariate(self.rate))
+        finished = defer.Deferred()
+        reactor.callLater(self.duration, finished.callback, None)
+        yield finished
+        yield defer.DeferredList(list(self.pending))
+        seconds = reactor.seconds() - self.started_at
+        yield self.pool.closeCachedConnections()
+        return self.report(seconds)
+
+    def report(self, seconds):
+        return {
+            'seconds': seconds,
+            'rate': self.rate,
+            'nodes': self.node_urls,
+            'total': EndpointStats.merge(self.stats.values()).to_raw(seconds),
+            'endpoints': {name: stats.to_raw(seconds) for name, stats in self.stats.items()}
+        }
+
+def print_report(report):
+    print('{:<16} {:>8} {:>8} {:>8} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+        'endpoint', 'ok', 'errors', 'skipped', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    rows = list(report['endpoints'].items()) + [('total', report['total'])]
+    for name, row in rows:
+        errors = sum(row['errors'].values())
+        latency = row['latencyMs']
+        print('{:<16} {:>8} {:>8} {:>8} {:>10.1f} {:>9} {:>9} {:>9} {:>9}'.format(
+            name, row['ok'], errors, row['skipped'], row['throughput'] or 0,
+            *('{:.1f}'.format(latency[key]) if latency[key] is not None else '-'
+              for key in ('p50', 'p95', 'p99', 'max'))))
+    for name, row in report['endpoints'].items():
+        if row['errors']:
+            print('{} errors: {}'.format(name, row['errors']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='sends an open-loop load to the REST services of nodes')
+    parser.add_argument('node_urls', help='urls of the web servers of the nodes, e.g. http://127.0.0.1:5000',
+                        nargs='+')
+    parser.add_argument('-r', '--rate', help='mean number of requests per second', default=10, type=float)
+    parser.add_argument('-d', '--duration', help='duration of the test in seconds', default=30, type=float)
+    parser.add_argument('-m', '--mix', help='weight of each endpoint, e.g. "{}"'.format(DEFAULT_MIX),
+                        default=DEFAULT_MIX)
+    parser.add_argument('--max-in-flight', help='maximum number of requests waiting for their response',
+                        default=1000, type=int)
+    parser.add_argument('--amount', help='amount of the transactions', default='0.01')
+    parser.add_argument('--seed', help='seed of the random generator', default=None, type=int)
+    parser.add_argument('--json', help='print the report in json format', action='store_true')
+    args = parser.parse_args()
+    # raised by readBody for the responses of pooled connections
+    warnings.filterwarnings('ignore', 'Using readBody', DeprecationWarning)
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as ex:
+        parser.error(str(ex))
+    generator = LoadGenerator(args.node_urls, mix, args.rate, args.duration, args.max_in_flight, args.amount,
+                              args.seed)
+
+    def finish(report):
+        if args.json:
+            print(json.dumps(report, indent=1))
+        else:
+            print_report(report)
+        reactor.stop()
+
+    def fail(failure):
+        print(format_exception(failure.value), file=sys.stderr)
+        reactor.stop()
+
+    reactor.callWhenRunning(lambda: generator.run().addCallbacks(finish, fail))
+    reactor.run()
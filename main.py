@@ -7,14 +7,25 @@ import sys
 
 from twisted.internet import reactor
 from twisted.web.server import Site
-from twisted.web.wsgi import WSGIResource
 
 from webserver import app as web_app
+from web_resource import ReactorResource
+from workers import WorkerPool
 from p2p import Application as P2PApplication
 from blockchain import Blockchain
 from wallet import Wallet
 from transaction_pool import TransactionPool
-from utils import bytes_to_hex
+from snapshot import UtxoSnapshot
+from address_history import AddressHistoryIndex
+from block_filters import BlockFilterIndex
+from bootstrap import BlockImporter
+from mining import WorkServer
+from profiling import NodeProfiler
+from tracing import BlockTracer
+from subscriptions import SubscriptionHub, start_subscription_server
+from utxo_stats import UtxoStats
+from coin_selection import COIN_SELECTORS, CoinSelector, LargestFirstSelector, get_coin_selector
+from utils import bytes_to_hex, hex_to_bytes
 
 from twisted.internet.defer import setDebugging
 from twisted.logger import globalLogPublisher, textFileLogObserver
@@ -32,16 +43,101 @@ if __name__ == '__main__':
     parser.add_argument('-k', '--key_location', 
                         help='location of wallet private key (defaults to "wallet/pk.pem")', 
                         default='wallet/pk.pem', type=str)
+    parser.add_argument('-w', '--workers',
+                        help='number of worker processes for mining and validation (defaults to the number of CPUs)',
+                        default=None, type=int)
+    parser.add_argument('--coin-selection', help='strategy selecting the outputs spent by the wallet',
+                        choices=list(COIN_SELECTORS), default=LargestFirstSelector.NAME)
+    parser.add_argument('--max-inputs', help='maximum number of inputs of the transactions of the wallet',
+                        default=CoinSelector.MAX_INPUTS, type=int)
+    parser.add_argument('--consolidate-above', 
+                        help='include a consolidation transaction in the mined blocks if the wallet has more '
+                             'spendable outputs than this',
+                        default=None, type=int)
+    parser.add_argument('--assume-valid',
+                        help='hash of a block whose ancestors are assumed to have valid signatures during the '
+                             'initial sync, "0" to verify all the signatures',
+                        default=None, type=str)
+    parser.add_argument('--load-snapshot',
+                        help='bootstrap the node from a UTXO snapshot file created by "snapshot.py export"',
+                        default=None, type=str)
+    parser.add_argument('--import-blocks',
+                        help='connect the blocks of a bootstrap file created by "bootstrap.py export" at startup',
+                        default=None, type=str)
+    parser.add_argument('--prune-blocks', 
+                        help='keep the transactions of the last N blocks only, and the headers of all the blocks',
+                        default=None, type=int)
+    parser.add_argument('--prune-bytes',
+                        help='keep the transactions of the most recent blocks taking at most this many bytes only',
+                        default=None, type=int)
+    parser.add_argument('--subscription-port',
+                        help='port of the websocket server pushing new blocks, transactions and address activity '
+                             'to the subscribed clients (disabled by default)',
+                        default=None, type=int)
+    parser.add_argument('--address-history', help='keep an index of the transactions of each address',
+                        action='store_true')
+    parser.add_argument('--address-history-file', 
+                        help='file the address history index is loaded from at startup and saved to at shutdown '
+                             '(implies --address-history)',
+                        default=None, type=str)
+    parser.add_argument('--block-filters', help='compute and serve the address filters of the blocks for light clients',
+                        action='store_true')
+    parser.add_argument('--debug-endpoints',
+                        help='enable the /debug profiling and memory tracing services, for local clients only',
+                        action='store_true')
+    parser.add_argument('--trace-blocks',
+                        help='trace the propagation of the blocks and the latency of their validation, '
+                             'the clocks of the nodes must be synchronized',
+                        action='store_true')
     args = parser.parse_args()
 
     tx_pool = TransactionPool()
     blockchain = Blockchain(tx_pool)
+    if args.assume_valid is not None:
+        blockchain.assume_valid = None if args.assume_valid == '0' else hex_to_bytes(args.assume_valid)
+    blockchain.prune_blocks = args.prune_blocks
+    blockchain.prune_bytes = args.prune_bytes
+    if args.load_snapshot is not None:
+        blockchain.load_snapshot(UtxoSnapshot.read(args.load_snapshot))
     wallet = Wallet(args.key_location)
+    wallet.coin_selector = get_coin_selector(args.coin_selection, args.max_inputs)
+    wallet.consolidation_threshold = args.consolidate_above
+    wallet.track(blockchain)
+    if args.address_history or args.address_history_file is not None:
+        if args.address_history_file is not None:
+            address_history = AddressHistoryIndex.load(args.address_history_file)
+            reactor.addSystemEventTrigger('before', 'shutdown', address_history.save, args.address_history_file)
+        else:
+            address_history = AddressHistoryIndex()
+        address_history.track(blockchain)
+        web_app.address_history = address_history
     p2p_application = P2PApplication(blockchain)
     blockchain.p2p_application = p2p_application
     web_app.blockchain = blockchain
     web_app.p2p_application = p2p_application
     web_app.wallet = wallet
+    utxo_stats = UtxoStats()
+    utxo_stats.track(blockchain)
+    web_app.utxo_stats = utxo_stats
+    web_app.work_server = WorkServer(blockchain, wallet)
+    workers = WorkerPool(args.workers)
+    blockchain.workers = workers
+    reactor.addSystemEventTrigger('before', 'shutdown', workers.shutdown)
+    if args.debug_endpoints:
+        web_app.profiler = NodeProfiler(workers)
+    if args.block_filters:
+        block_filters = BlockFilterIndex(workers)
+        block_filters.track(blockchain)
+        web_app.block_filters = block_filters
+        p2p_application.engine.block_filters = block_filters
+    if args.trace_blocks:
+        block_tracer = BlockTracer()
+        block_tracer.track(blockchain)
+        web_app.block_tracer = block_tracer
+        p2p_application.engine.tracer = block_tracer
+    if args.import_blocks is not None:
+        importer = BlockImporter(blockchain, workers)
+        reactor.callWhenRunning(importer.import_file, args.import_blocks)
 
     print('My pubblic address is: {}'.format(bytes_to_hex(wallet.get_public_key())))
 
@@ -49,9 +145,14 @@ if __name__ == '__main__':
     print('Starting p2p server at {}'.format(server_url))
     p2p_application.start_server(server_url)
     
-    # pylint: disable=maybe-no-member
-    resource = WSGIResource(reactor, reactor.getThreadPool(), web_app)
-    site = Site(resource)
+    if args.subscription_port is not None:
+        subscription_hub = SubscriptionHub(blockchain)
+        web_app.subscription_hub = subscription_hub
+        subscription_url = 'ws://127.0.0.1:{}'.format(args.subscription_port)
+        print('Starting subscription server at {}'.format(subscription_url))
+        start_subscription_server(subscription_url, subscription_hub)
+
+    site = Site(ReactorResource(web_app))
     print('Starting web server at http://127.0.0.1:{}'.format(args.web_port))
     reactor.listenTCP(args.web_port, site)
     reactor.run()
@@ -0,0 +1,220 @@
+# pyncoin/mining.py
+
+''' Implements the distribution of mining work to remote workers.
+
+A worker asks the node for work with `POST /getWork` and receives a template of the next block:
+its header prefix, the data hashed before the nonce, the difficulty and a range of nonces
+assigned to the worker only. The hash of the block with nonce `n` is
+`sha256(headerPrefix + n.to_bytes(8, 'big'))`, and it is valid if it has `difficulty` leading
+zero bits, i.e. if it is not greater than `target`. The worker sends a valid nonce back with
+`POST /submitWork` and the node connects the block immediately.
+
+All the templates are invalidated when the latest block changes: their solutions are rejected
+as stale and the workers must ask for new work.
+
+Usage:
+    python mining.py work http://127.0.0.1:5000 [--processes N] [--nonce-range N]
+'''
+
+import argparse
+import json
+import multiprocessing
+import time
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from blockchain import Block, IBlockchainListener
+from utils import BadRequestError, ConflictError
+
+class WorkTemplate:
+    ''' The template of the next block handed out to the workers. '''
+
+    def __init__(self, work_id, index, previous_hash, timestamp, data, difficulty):
+        self.work_id = work_id
+        self.index = index
+        self.previous_hash = previous_hash
+        self.timestamp = timestamp
+        self.data = data
+        self.difficulty = difficulty
+        self.prefix = Block.header_prefix(index, previous_hash, timestamp, data, difficulty)
+        self.next_nonce = 0
+        self.created = time.monotonic()
+
+    def assign(self, count):
+        ''' Returns ((int, int)): A range of `count` nonces not assigned to any other worker. '''
+        start = self.next_nonce
+        self.next_nonce = min(start + count, WorkServer.MAX_NONCE)
+        return (start, self.next_nonce)
+
+    def to_raw(self, start, end):
+        return {
+            'workId': self.work_id,
+            'index': self.index,
+            'previousHash': self.previous_hash.hex(),
+            'headerPrefix': self.prefix.hex(),
+            'difficulty': self.difficulty,
+            'target': '{:064x}'.format((1 << max(256 - self.difficulty, 0)) - 1),
+            'nonceStart': start,
+            'nonceEnd': end
+        }
+
+class WorkServer(IBlockchainListener):
+    ''' Hands out work templates and connects the blocks solved by the workers.
+
+    The template of the latest block is shared by all the workers, each one receiving a
+    different range of nonces, and it is replaced by a new one, including the transactions
+    received meanwhile, when it is `TEMPLATE_TTL` seconds old. The older templates of the same
+    latest block stay valid until it changes.
+    '''
+
+    NONCE_RANGE = 2 ** 20
+    MAX_NONCE = 2 ** (8 * Block.INT_SIZE)
+    # the timestamp of a block must be less than 60 seconds older than the time it is connected
+    TEMPLATE_TTL = 30
+    MAX_TEMPLATES = 10
+
+    def __init__(self, blockchain, wallet):
+        ''' Initializes the server and registers it as a listener of the blockchain.
+        Params:
+            - blockchain (Blockchain): The blockchain the blocks are mined on.
+            - wallet (Wallet): The wallet receiving the coinbase of the mined blocks.
+        '''
+        self.blockchain = blockchain
+        self.wallet = wallet
+        self.templates = {}
+        self.current = None
+        self.last_work_id = 0
+        self.stats = {'assigned': 0, 'accepted': 0, 'stale': 0, 'invalid': 0}
+        blockchain.add_listener(self)
+
+    def new_template(self):
+        (index, previous_hash, timestamp, data, difficulty) = self.blockchain.next_block_template(
+            self.blockchain.next_block_data(self.wallet))
+        self.last_work_id += 1
+        template = WorkTemplate(self.last_work_id, index, previous_hash, timestamp, data, difficulty)
+        self.templates[template.work_id] = template
+        if len(self.templates) > WorkServer.MAX_TEMPLATES:
+            del self.templates[min(self.templates)]
+        return template
+
+    def get_work(self, nonce_range=NONCE_RANGE):
+        ''' Returns (dict): A template of the next block and the range of nonces assigned to the worker.
+        Params:
+            - nonce_range (int): The number of nonces requested.
+        '''
+        if not isinstance(nonce_range, int) or not 1 <= nonce_range <= WorkServer.MAX_NONCE:
+            raise BadRequestError('invalid nonce range', {'nonceRange': nonce_range})
+        template = self.current
+        if (template is None or template.next_nonce >= WorkServer.MAX_NONCE
+                or time.monotonic() - template.created > WorkServer.TEMPLATE_TTL):
+            template = self.current = self.new_template()
+        (start, end) = template.assign(nonce_range)
+        self.stats['assigned'] += 1
+        return template.to_raw(start, end)
+
+    def submit(self, work_id, nonce):
+        ''' Connects the block of a template solved by a worker.
+        Params:
+            - work_id (int): The `workId` of the template.
+            - nonce (int): The nonce found by the worker.
+        Returns (Block): The connected block.
+        '''
+        if not isinstance(nonce, int) or not 0 <= nonce < WorkServer.MAX_NONCE:
+            raise BadRequestError('invalid nonce', {'nonce': nonce})
+        template = self.templates.get(work_id)
+        if template is None:
+            self.stats['stale'] += 1
+            raise ConflictError('stale work, the latest block changed', {'workId': work_id})
+        solution = Block.find_nonce(template.prefix, template.difficulty, nonce, nonce + 1)
+        if solution is None:
+            self.stats['invalid'] += 1
+            raise BadRequestError('block difficulty not satisfied', {'workId': work_id, 'nonce': nonce})
+        block = Block(template.index, template.previous_hash, template.timestamp, template.data,
+                      template.difficulty, nonce, block_hash=solution[1])
+        if self.blockchain.connect_mined_block(block) is None:
+            self.stats['invalid'] += 1
+            raise ConflictError('the block could not be connected', {'workId': work_id})
+        self.stats['accepted'] += 1
+        return block
+
+    def clear(self):
+        self.templates.clear()
+        self.current = None
+
+    # IBlockchainListener impl
+
+    def block_added(self, blockchain, block):
+        self.clear()
+
+    def chain_replaced(self, blockchain):
+        self.clear()
+
+# reference worker
+
+stop_event = None
+
+def init_worker_process(event):
+    global stop_event
+    stop_event = event
+
+def search(prefix, difficulty, start, end):
+    ''' Searches a range of nonces in a worker process, until a nonce is found by any process. '''
+    solution = Block.find_nonce(prefix, difficulty, start, end, stop_event)
+    if solution is not None:
+        stop_event.set()
+        return solution[0]
+    return None
+
+def post(node_url, path, params):
+    request = Request(node_url.rstrip('/') + path, data=json.dumps(params).encode('utf-8'),
+                      headers={'Content-Type': 'application/json'})
+    try:
+        with urlopen(request) as response:
+            return (response.status, json.loads(response.read().decode('utf-8')))
+    except HTTPError as ex:
+        return (ex.code, json.loads(ex.read().decode('utf-8')))
+
+def work(node_url, processes, nonce_range):
+    ''' Mines on the node forever, splitting each range of nonces between `processes` processes. '''
+    event = multiprocessing.Event()
+    with multiprocessing.Pool(processes, init_worker_process, (event,)) as pool:
+        while True:
+            (status, template) = post(node_url, '/getWork', {'nonceRange': nonce_range * processes})
+            if status != 200:
+                print('getWork failed: {}'.format(template))
+                time.sleep(1)
+                continue
+            event.clear()
+            start = template['nonceStart']
+            end = template['nonceEnd']
+            step = -(-(end - start) // processes)
+            prefix = bytes.fromhex(template['headerPrefix'])
+            ranges = [(prefix, template['difficulty'], first, min(first + step, end))
+                      for first in range(start, end, step)]
+            nonces = [nonce for nonce in pool.starmap(search, ranges) if nonce is not None]
+            if not nonces:
+                continue
+            (status, result) = post(node_url, '/submitWork', {'workId': template['workId'], 'nonce': nonces[0]})
+            if status == 200:
+                print('Mined block {} {}'.format(result['index'], result['hash']))
+            else:
+                print('Solution of block {} rejected: {}'.format(template['index'], result.get('message')))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='mines blocks with the work templates of a node')
+    commands = parser.add_subparsers(dest='command')
+    work_parser = commands.add_parser('work', help='mines on a node until interrupted')
+    work_parser.add_argument('node_url', help='url of the web server of the node, e.g. http://127.0.0.1:5000')
+    work_parser.add_argument('-p', '--processes', help='number of mining processes (defaults to the number of CPUs)',
+                             default=multiprocessing.cpu_count(), type=int)
+    work_parser.add_argument('--nonce-range', help='number of nonces searched by each process per template',
+                             default=WorkServer.NONCE_RANGE // 4, type=int)
+    args = parser.parse_args()
+
+    if args.command == 'work':
+        try:
+            work(args.node_url, args.processes, args.nonce_range)
+        except KeyboardInterrupt:
+            pass
+    else:
+        parser.print_help()
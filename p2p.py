@@ -2,9 +2,21 @@
 
 ''' Implements the p2p node of the blockchain. '''
 
+import collections
+import hashlib
+import heapq
+import itertools
+import time
+from datetime import datetime, timezone
+
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+
 from blockchain import Block, Blockchain
-from utils import RawSerializable, format_exception
+from utils import BadRequestError, HttpError, RawSerializable, RecentlySeen, ExpiringCache
+from utils import format_exception, hex_to_bytes
 from transaction import Transaction
+from transaction_pool import TransactionPool
 
 from autobahn.twisted.websocket import WebSocketAdapterProtocol
 from autobahn.websocket.protocol import WebSocketProtocol
@@ -20,27 +32,74 @@ class Message(RawSerializable):
     RESPONSE_BLOCKCHAIN = 2
     QUERY_TRANSACTION_POOL = 3
     RESPONSE_TRANSACTION_POOL = 4
+    QUERY_BLOCK = 5
+    COMPACT_BLOCK = 6
+    QUERY_BLOCK_TRANSACTIONS = 7
+    RESPONSE_BLOCK_TRANSACTIONS = 8
+    QUERY_FILTERS = 9
+    RESPONSE_FILTERS = 10
+    BLOCK_NOT_AVAILABLE = 11
+
+    # Send priorities, lower values are sent first:
+    PRIORITY_CONTROL = 0
+    PRIORITY_BLOCK = 1
+    PRIORITY_TRANSACTIONS = 2
+    PRIORITY_CHAIN = 3
 
-    def __init__(self, message_type, data):
+    # The trace is serialized last, so that the payloads of messages differing only by their
+    # trace have the same digest once it is stripped, see `untraced_payload`.
+    TRACE_MARKER = b', "trace": '
+
+    def __init__(self, message_type, data, coalesce_key=None, trace=None):
         ''' Initializes the Message.
         Parameters:
             - message_type (int): The message type.
             - data (any): A json serializable data object
+            - coalesce_key (str): Messages with the same coalesce key supersede each other: 
+                if a message is still waiting in the send queue of a peer when a new one with 
+                the same key is sent, only the new one is delivered. Not sent on the wire.
+            - trace (dict): The optional propagation trace of the announced block, its `origin`
+                time in seconds since the epoch and the number of `hops` from its origin, see 
+                `tracing.BlockTracer`.
         '''
         self.message_type = message_type
         self.data = data
+        self.coalesce_key = coalesce_key
+        self.trace = trace
 
     def to_raw(self):
         ''' Converts the Message to a dictionary. '''
-        return {
+        raw_obj = {
             'type': self.message_type,
             'data': self.data
         }
+        if self.trace is not None:
+            raw_obj['trace'] = self.trace
+        return raw_obj
 
     @classmethod
     def from_raw(cls, raw_obj):
         ''' Returns a new Message initialized from a dictionary. '''
-        return cls(raw_obj['type'], raw_obj['data'])
+        return cls(raw_obj['type'], raw_obj['data'], trace=raw_obj.get('trace'))
+
+    @staticmethod
+    def untraced_payload(payload):
+        ''' Returns (bytes): The payload of a message without its trace. '''
+        position = payload.rfind(Message.TRACE_MARKER)
+        return payload[:position] + b'}' if position >= 0 else payload
+
+    def priority(self):
+        ''' Returns (int): The send priority of this message. '''
+        if self.message_type == Message.RESPONSE_BLOCKCHAIN:
+            is_chain = isinstance(self.data, list) and len(self.data) > 1
+            return Message.PRIORITY_CHAIN if is_chain else Message.PRIORITY_BLOCK
+        elif self.message_type in (Message.COMPACT_BLOCK, Message.RESPONSE_BLOCK_TRANSACTIONS):
+            return Message.PRIORITY_BLOCK
+        elif self.message_type == Message.RESPONSE_TRANSACTION_POOL:
+            return Message.PRIORITY_TRANSACTIONS
+        elif self.message_type == Message.RESPONSE_FILTERS:
+            return Message.PRIORITY_CHAIN
+        return Message.PRIORITY_CONTROL
 
     @staticmethod
     def query_chain_length_message():
@@ -54,57 +113,489 @@ class Message(RawSerializable):
 
     @staticmethod
     def response_chain_message(blockchain):
-        ''' Creates a new "blockchain response" message. '''
-        return Message(Message.RESPONSE_BLOCKCHAIN, blockchain.to_raw())
+        ''' Creates a new "blockchain response" message. A pruned blockchain only sends the
+        blocks following its pruned height, which still have their transactions. '''
+        return Message(Message.RESPONSE_BLOCKCHAIN, Block.to_raw_list(blockchain.blocks[blockchain.pruned_height + 1:]))
 
     @staticmethod 
     def response_latest_message(blockchain):
         ''' Creates a new "latest block response" message. '''
-        return Message(Message.RESPONSE_BLOCKCHAIN, [blockchain.get_latest().to_raw()])
+        return Message(Message.RESPONSE_BLOCKCHAIN, [blockchain.get_latest().to_raw()], coalesce_key='latest')
 
     @staticmethod
     def response_transaction_pool_message(tx_pool):
         ''' Creates a new "transaction pool response" message. '''
         return Message(Message.RESPONSE_TRANSACTION_POOL, tx_pool.to_raw())
 
+    @staticmethod
+    def response_transactions_message(transactions):
+        ''' Creates a new "transaction pool response" message announcing only the given transactions. '''
+        return Message(Message.RESPONSE_TRANSACTION_POOL, Transaction.to_raw_list(transactions))
+
     @staticmethod
     def query_transaction_pool_message():
         ''' Creates a new "query transaction pool" message. '''
         return Message(Message.QUERY_TRANSACTION_POOL, None)
 
+    @staticmethod
+    def query_block_message(block_hash):
+        ''' Creates a new "query block" message asking for the block with the given hash. '''
+        return Message(Message.QUERY_BLOCK, block_hash.hex())
+
+    @staticmethod
+    def response_block_message(block):
+        ''' Creates a new "blockchain response" message containing a single block. '''
+        return Message(Message.RESPONSE_BLOCKCHAIN, [block.to_raw()])
+
+    @staticmethod
+    def compact_latest_message(blockchain, trace=None):
+        ''' Creates a new "compact block" message announcing the latest block. '''
+        return Message(Message.COMPACT_BLOCK, CompactBlock.from_block(blockchain.get_latest()).to_raw(),
+                       coalesce_key='latest', trace=trace)
+
+    @staticmethod
+    def query_block_transactions_message(block_hash, indexes):
+        ''' Creates a new "query block transactions" message asking for the transactions 
+        of a block at the given positions. '''
+        return Message(Message.QUERY_BLOCK_TRANSACTIONS, {'hash': block_hash.hex(), 'indexes': indexes})
+
+    @staticmethod
+    def response_block_transactions_message(block_hash, transactions):
+        ''' Creates a new "block transactions response" message. '''
+        return Message(Message.RESPONSE_BLOCK_TRANSACTIONS, 
+                       {'hash': block_hash.hex(), 'transactions': Transaction.to_raw_list(transactions)})
+
+    @staticmethod
+    def query_filters_message(start, end):
+        ''' Creates a new "query filters" message asking for the filters of the blocks from
+        `start` to `end` included. '''
+        return Message(Message.QUERY_FILTERS, {'from': start, 'to': end})
+
+    @staticmethod
+    def response_filters_message(filters):
+        ''' Creates a new "filters response" message. '''
+        return Message(Message.RESPONSE_FILTERS, [block_filter.to_raw() for block_filter in filters])
+
+    @staticmethod
+    def block_not_available_message(raw_hash, pruned_height):
+        ''' Creates a new "block not available" message, the answer to the query of a pruned block. '''
+        return Message(Message.BLOCK_NOT_AVAILABLE, {'hash': raw_hash, 'prunedHeight': pruned_height})
+
+# ----------------------------
+
+class CompactBlock(RawSerializable):
+    ''' A block announcement carrying the header of the block and a short id for each of its 
+    transactions instead of the transactions themselves. The receiver rebuilds the block from 
+    its transaction pool and asks only for the transactions it is missing. The coinbase 
+    transaction is always sent in full. '''
+
+    SHORT_ID_SIZE = 6
+
+    def __init__(self, index, previous_hash, timestamp, difficulty, nonce, block_hash, short_ids, coinbase):
+        self.index = index
+        self.previous_hash = previous_hash
+        self.timestamp = timestamp
+        self.difficulty = difficulty
+        self.nonce = nonce
+        self.hash = block_hash
+        self.short_ids = short_ids
+        self.coinbase = coinbase
+
+    @staticmethod
+    def short_id(tx_id):
+        return tx_id[:CompactBlock.SHORT_ID_SIZE]
+
+    @classmethod
+    def from_block(cls, block):
+        coinbase = block.data[0] if block.data else None
+        short_ids = [CompactBlock.short_id(tx.id) for tx in block.data[1:]]
+        return cls(block.index, block.previous_hash, block.timestamp, block.difficulty, block.nonce,
+                   block.hash, short_ids, coinbase)
+
+    def to_raw(self):
+        return {
+            'index': self.index,
+            'previousHash': self.previous_hash.hex() if self.previous_hash is not None else None,
+            'timestamp': int(self.timestamp.timestamp()),
+            'difficulty': self.difficulty,
+            'nonce': self.nonce,
+            'hash': self.hash.hex(),
+            'shortIds': [short_id.hex() for short_id in self.short_ids],
+            'coinbase': self.coinbase.to_raw() if self.coinbase is not None else None
+        }
+
+    @classmethod
+    def from_raw(cls, raw_obj):
+        previous_hash = hex_to_bytes(raw_obj['previousHash']) if raw_obj['previousHash'] is not None else None
+        timestamp = datetime.fromtimestamp(raw_obj['timestamp'], tz=timezone.utc)
+        short_ids = [hex_to_bytes(short_id) for short_id in raw_obj['shortIds']]
+        coinbase = Transaction.from_raw(raw_obj['coinbase']) if raw_obj['coinbase'] is not None else None
+        return cls(raw_obj['index'], previous_hash, timestamp, raw_obj['difficulty'], raw_obj['nonce'],
+                   hex_to_bytes(raw_obj['hash']), short_ids, coinbase)
+
+    def match_transactions(self, transactions):
+        ''' Finds the transactions of the block among the given ones.
+        Params:
+            - transactions (list<Transaction>): The candidate transactions, usually the transaction pool.
+        Returns (list<Transaction>): The transactions of the block, None for the ones not found 
+            or whose short id is ambiguous. The coinbase transaction is not included.
+        '''
+        candidates = {}
+        for tx in transactions:
+            short_id = CompactBlock.short_id(tx.id)
+            candidates[short_id] = None if short_id in candidates else tx
+        return [candidates.get(short_id) for short_id in self.short_ids]
+
+    def to_block(self, transactions):
+        ''' Rebuilds the block.
+        Params:
+            - transactions (list<Transaction>): The transactions of the block, without the coinbase.
+        Returns (Block): The block, or None if its hash does not match the announced one because 
+            the short ids matched the wrong transactions.
+        '''
+        data = [self.coinbase] + transactions if self.coinbase is not None else transactions
+        block = Block(self.index, self.previous_hash, self.timestamp, data, self.difficulty, self.nonce)
+        return block if block.hash == self.hash else None
+
+# ----------------------------
+
+class OrphanPool:
+    ''' Holds the received blocks whose parent is not known yet, indexed by the hash of 
+    their parent. When the pool is full the oldest blocks are evicted. '''
+
+    MAX_ORPHANS = 100
+
+    def __init__(self, max_orphans=MAX_ORPHANS):
+        self.max_orphans = max_orphans
+        self.blocks = collections.OrderedDict()
+        self.children = {}
+
+    def __contains__(self, block_hash):
+        return block_hash in self.blocks
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def add(self, block):
+        ''' Adds a block to the pool.
+        Returns (bool): True if the block was not in the pool.
+        '''
+        if block.hash in self.blocks:
+            return False
+        self.blocks[block.hash] = block
+        self.children.setdefault(block.previous_hash, []).append(block)
+        if len(self.blocks) > self.max_orphans:
+            self.remove(next(iter(self.blocks.values())))
+        return True
+
+    def remove(self, block):
+        del self.blocks[block.hash]
+        siblings = self.children[block.previous_hash]
+        siblings.remove(block)
+        if not siblings:
+            del self.children[block.previous_hash]
+
+    def is_missing_parent(self, block_hash):
+        ''' Returns True if some blocks of the pool are waiting for the block with the given hash. '''
+        return block_hash in self.children
+
+    def pop_children(self, block_hash):
+        ''' Removes and returns the blocks whose parent is the block with the given hash. '''
+        children = self.children.get(block_hash, [])[:]
+        for child in children:
+            self.remove(child)
+        return children
+
+    def root(self, block):
+        ''' Returns (Block): The oldest ancestor of `block` in the pool, that is the block 
+        whose parent is missing. '''
+        while block.previous_hash in self.blocks:
+            block = self.blocks[block.previous_hash]
+        return block
+
+class PeerScore:
+    ''' The misbehavior score of a peer. Each known-bad block or transaction sent by the peer
+    adds points to the score, which decays linearly over time. '''
+
+    DECAY_PER_SECOND = 1
+
+    def __init__(self, clock=time.monotonic):
+        ''' Initializes the score.
+        Params:
+            - clock (function): Returns the current time in seconds.
+        '''
+        self.clock = clock
+        self.score = 0
+        self.updated_at = clock()
+
+    def current(self):
+        now = self.clock()
+        self.score = max(0, self.score - (now - self.updated_at) * PeerScore.DECAY_PER_SECOND)
+        self.updated_at = now
+        return self.score
+
+    def add(self, points):
+        ''' Returns (float): The new score. '''
+        self.score = self.current() + points
+        return self.score
+
 # ----------------------------
 
 class Engine:
     ''' The business logic of the p2p client that interacts with the 
     current copy of the blockchain.'''
 
-    def __init__(self, blockchain):
+    SEEN_CACHE_SIZE = 10000
+    # Fetch the whole chain instead of the missing blocks one by one when we are this far behind:
+    MAX_ORPHAN_GAP = 20
+    MAX_PENDING_COMPACT_BLOCKS = 10
+
+    # Rejected blocks and transactions are not validated again until their entry expires:
+    REJECTED_CACHE_SIZE = 10000
+    REJECTED_INVALID_SECONDS = 600
+    REJECTED_TRANSIENT_SECONDS = 30
+    INVALID_BLOCK = 'invalid block'
+
+    # Misbehavior points and the scores at which peers are ignored or disconnected:
+    INVALID_TRANSACTION_POINTS = 10
+    INVALID_BLOCK_POINTS = 50
+    THROTTLE_SCORE = 100
+    DISCONNECT_SCORE = 200
+
+    def __init__(self, blockchain, clock=time.monotonic, wall_clock=time.time):
+        ''' Initializes the engine.
+        Params:
+            - blockchain (Blockchain): The blockchain of the node.
+            - clock (function): Returns the current time in seconds, used for the expiration of
+                the caches and the decay of the misbehavior scores.
+            - wall_clock (function): Returns the current time in seconds since the epoch, 
+                compared to the timestamps of the blocks.
+        '''
         self.blockchain = blockchain
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.orphans = OrphanPool()
+        self.pending_compact_blocks = collections.OrderedDict()
+        self.seen_payloads = RecentlySeen(Engine.SEEN_CACHE_SIZE)
+        self.seen_transactions = RecentlySeen(Engine.SEEN_CACHE_SIZE)
+        self.rejected_transactions = ExpiringCache(Engine.REJECTED_CACHE_SIZE, Engine.REJECTED_INVALID_SECONDS, clock)
+        self.rejected_blocks = ExpiringCache(Engine.REJECTED_CACHE_SIZE, Engine.REJECTED_INVALID_SECONDS, clock)
+        self.peer_scores = {}
+        self.block_filters = None
+        self.tracer = None
+
+    def handle_payload(self, channel, payload):
+        ''' Handles a message received from a peer in binary format.
+
+        Messages whose payload is identical to an already processed one whose blocks and 
+        transactions are all known are dropped without being parsed, as well as all the 
+        messages of throttled peers.
+        '''
+        if self.is_throttled(channel):
+            print('Ignoring message from misbehaving peer {}'.format(channel.peer))
+            return
+        received = time.time()
+        digest = hashlib.sha256(Message.untraced_payload(payload)).digest()
+        if digest in self.seen_payloads:
+            print('Dropping already seen message')
+            return
+        message = Message.from_bin(payload)
+        print('Received message: {}'.format(message.to_raw()))
+        if self.tracer is not None:
+            self.tracer.message_received(channel, message, received, time.time())
+            try:
+                self.handle_message(channel, message)
+            finally:
+                self.tracer.message_handled()
+        else:
+            self.handle_message(channel, message)
+        if self.is_known(message):
+            self.seen_payloads.add(digest)
+
+    def latest_trace(self):
+        ''' Returns (dict): The trace of the latest block announced to the peers, None if disabled. '''
+        return self.tracer.outgoing_trace(self.blockchain.get_latest()) if self.tracer is not None else None
+
+    def is_known(self, message):
+        ''' Returns True if the message announces only blocks and transactions already known. '''
+        if message.message_type == Message.COMPACT_BLOCK:
+            return self.is_known_block(message.data)
+        if not isinstance(message.data, list):
+            return False
+        if message.message_type == Message.RESPONSE_BLOCKCHAIN:
+            return all(self.is_known_block(raw_block) for raw_block in message.data)
+        elif message.message_type == Message.RESPONSE_TRANSACTION_POOL:
+            return all(self.is_known_transaction(raw_tx) for raw_tx in message.data)
+        return False
+
+    @staticmethod
+    def raw_hash(raw_obj, key):
+        ''' Returns (bytes): The hash stored in a field of a raw block or transaction, or None 
+        if it is missing or invalid. '''
+        try:
+            return hex_to_bytes(raw_obj[key])
+        except (TypeError, KeyError, BadRequestError):
+            return None
+
+    def is_known_block(self, raw_block):
+        ''' Checks the hash of a block in raw format against the blockchain without deserializing it. '''
+        return Engine.raw_hash(raw_block, 'hash') in self.blockchain.blocks_by_hash
+
+    def is_known_transaction(self, raw_tx):
+        ''' Checks the id of a transaction in raw format against the recently accepted ones 
+        without deserializing it. '''
+        return Engine.raw_hash(raw_tx, 'id') in self.seen_transactions
+
+    @staticmethod
+    def block_digest(block):
+        ''' Returns (bytes): The digest of a whole block. Unlike its hash, it covers the signatures
+        of its transactions, so a copy of a valid block with invalid signatures has another one. '''
+        return hashlib.sha256(block.to_bin()).digest()
+
+    def is_rejected_block(self, channel, block):
+        ''' Checks a block against the recently rejected blocks without deserializing its 
+        transactions. Penalizes the peer if the block is known to be invalid, the blocks 
+        rejected for a transient reason are only skipped. '''
+        reason = self.rejected_blocks.get(Engine.block_digest(block))
+        if reason is None:
+            return False
+        print('Received block was already rejected: {}'.format(reason))
+        if reason == Engine.INVALID_BLOCK:
+            self.penalize(channel, Engine.INVALID_BLOCK_POINTS, reason)
+        return True
+
+    @staticmethod
+    def transaction_digest(tx):
+        ''' Returns (bytes): The digest of a whole transaction. Unlike its id, it covers the 
+        signatures, so a copy of a valid transaction with invalid signatures has another one. '''
+        return hashlib.sha256(tx.to_bin()).digest()
+
+    def filter_rejected_transactions(self, channel, transactions):
+        ''' Returns (list<Transaction>): The transactions that were not recently rejected. 
+        Penalizes the peer for the ones known to be invalid. '''
+        result = []
+        for tx in transactions:
+            reason = self.rejected_transactions.get(Engine.transaction_digest(tx))
+            if reason is None:
+                result.append(tx)
+            elif reason == TransactionPool.REJECTED_INVALID:
+                self.penalize(channel, Engine.INVALID_TRANSACTION_POINTS, reason)
+        if len(result) != len(transactions):
+            print('Skipped {} already rejected transactions'.format(len(transactions) - len(result)))
+        return result
+
+    def reject_transactions(self, channel, transactions):
+        ''' Remembers why the given transactions were not added to the pool. '''
+        for tx in transactions:
+            reason = self.blockchain.tx_pool.rejection_reason(tx, self.blockchain.unspent_by_outpoint)
+            if reason == TransactionPool.REJECTED_INVALID:
+                self.rejected_transactions.set(Engine.transaction_digest(tx), reason)
+                self.penalize(channel, Engine.INVALID_TRANSACTION_POINTS, reason)
+            elif reason != TransactionPool.REJECTED_DUPLICATE:
+                self.rejected_transactions.set(Engine.transaction_digest(tx), reason, Engine.REJECTED_TRANSIENT_SECONDS)
+
+    def reject_block(self, channel, block):
+        ''' Remembers that a block could not be connected to our latest block, its parent. 
+        Blocks with a timestamp in the future may become valid later and are only remembered
+        for a short time. Blocks whose hash does not match their content are not remembered, 
+        only the peer is penalized. Blocks that are only invalid because of the signatures of
+        their transactions are neither remembered nor penalized. '''
+        if not block.has_valid_structure() or block.calculate_hash_for_block() != block.hash:
+            if channel is not None:
+                self.penalize(channel, Engine.INVALID_BLOCK_POINTS, 'block hash does not match its content')
+            return
+        if block.timestamp.timestamp() >= self.wall_clock():
+            self.rejected_blocks.set(Engine.block_digest(block), 'block timestamp is in the future',
+                                     Engine.REJECTED_TRANSIENT_SECONDS)
+            return
+        if self.has_invalid_signatures_only(block):
+            print('block is invalid because of the signatures of its transactions')
+            return
+        self.rejected_blocks.set(Engine.block_digest(block), Engine.INVALID_BLOCK)
+        if channel is not None:
+            self.penalize(channel, Engine.INVALID_BLOCK_POINTS, Engine.INVALID_BLOCK)
+
+    def has_invalid_signatures_only(self, block):
+        ''' Returns True if a block that could not be connected to our latest block would be 
+        valid without checking the signatures of its transactions. '''
+        latest_block_held = self.blockchain.get_latest()
+        return (latest_block_held.hash == block.previous_hash 
+                and latest_block_held.is_valid_next(block)
+                and Transaction.process_transactions(block.data, self.blockchain.unspent_tx_outs, block.index,
+                                                     verify_signatures=False) is not None)
+
+    def penalize(self, channel, points, reason):
+        ''' Adds misbehavior points to a peer, disconnecting it if its score gets too high. '''
+        if channel not in self.peer_scores:
+            self.peer_scores[channel] = PeerScore(self.clock)
+        score = self.peer_scores[channel].add(points)
+        print('Peer {} misbehaving ({}), score: {:.1f}'.format(channel.peer, reason, score))
+        if score >= Engine.DISCONNECT_SCORE:
+            print('Disconnecting misbehaving peer {}'.format(channel.peer))
+            channel.drop()
+
+    def is_throttled(self, channel):
+        return self.misbehavior_score(channel) >= Engine.THROTTLE_SCORE
+
+    def misbehavior_score(self, channel):
+        peer_score = self.peer_scores.get(channel)
+        return peer_score.current() if peer_score is not None else 0
 
     def handle_socket_open(self, channel):
         channel.send_message(Message.query_chain_length_message())
 
     def handle_socket_close(self, channel):
-        pass
+        self.peer_scores.pop(channel, None)
+        for key in [key for key in self.pending_compact_blocks if key[0] is channel]:
+            del self.pending_compact_blocks[key]
 
     def handle_message(self, channel, message):
         if message.message_type == Message.QUERY_LATEST:
             channel.send_message(Message.response_latest_message(self.blockchain))
         elif message.message_type == Message.QUERY_ALL:
+            if self.blockchain.pruned_height >= 0:
+                print('Blockchain is pruned, sending the blocks after #{}'.format(self.blockchain.pruned_height))
             channel.send_message(Message.response_chain_message(self.blockchain))
         elif message.message_type == Message.RESPONSE_BLOCKCHAIN:
             if not isinstance(message.data, list):
                 print('Invalid blocks received: {}'.format(message.data))
+            elif len(message.data) == 1 and self.is_known(message):
+                print('Received block is already known')
+            elif len(message.data) == 1 and self.is_rejected_block(channel, Block.from_raw(message.data[0])):
+                pass
             else:
                 received_blocks = Block.from_raw_list(message.data)
                 self.handle_blockchain_response(channel, received_blocks)
+        elif message.message_type == Message.QUERY_BLOCK:
+            self.handle_block_query(channel, message.data)
+        elif message.message_type == Message.COMPACT_BLOCK:
+            if self.is_known(message):
+                print('Received compact block is already known')
+            else:
+                self.handle_compact_block(channel, CompactBlock.from_raw(message.data))
+        elif message.message_type == Message.QUERY_BLOCK_TRANSACTIONS:
+            self.handle_block_transactions_query(channel, message.data)
+        elif message.message_type == Message.RESPONSE_BLOCK_TRANSACTIONS:
+            self.handle_block_transactions_response(channel, message.data)
+        elif message.message_type == Message.QUERY_FILTERS:
+            self.handle_filters_query(channel, message.data)
+        elif message.message_type == Message.RESPONSE_FILTERS:
+            print('Received the filters of {} blocks, ignored by full nodes'.format(len(message.data)))
+        elif message.message_type == Message.BLOCK_NOT_AVAILABLE:
+            self.handle_block_not_available(channel, message.data)
         elif message.message_type == Message.QUERY_TRANSACTION_POOL:
             channel.send_message(Message.response_transaction_pool_message(self.blockchain.tx_pool))
         elif message.message_type == Message.RESPONSE_TRANSACTION_POOL:
-            transactions = Transaction.from_raw_list(message.data)
-            for transaction in transactions:
-                if self.blockchain.handle_received_transaction(transaction):
-                    channel.broadcast(Message.response_transaction_pool_message(self.blockchain.tx_pool))
+            raw_txs = [raw_tx for raw_tx in message.data if not self.is_known_transaction(raw_tx)]
+            transactions = self.filter_rejected_transactions(channel, Transaction.from_raw_list(raw_txs))
+            accepted = self.blockchain.handle_received_transactions(transactions)
+            for tx in accepted:
+                self.seen_transactions.add(tx.id)
+            if len(accepted) != len(transactions):
+                accepted_ids = {id(tx) for tx in accepted}
+                self.reject_transactions(channel, [tx for tx in transactions if id(tx) not in accepted_ids])
+            if accepted:
+                channel.relay(Message.response_transactions_message(accepted))
         else:
             print('Unknown message type: {}'.format(message.message_type))
 
@@ -113,26 +604,211 @@ class Engine:
             print('received block chain size of 0')
             return
         latest_block_received = received_blocks[-1]
-        if not latest_block_received.has_valid_structure():
+        if not latest_block_received.has_valid_header_structure():
             print('block structure is not valid')
             return
         latest_block_held = self.blockchain.get_latest()
-        if latest_block_received.index > latest_block_held.index:
+        if len(received_blocks) == 1 and self.orphans.is_missing_parent(latest_block_received.hash):
+            print('Received the missing parent of orphan blocks')
+            self.handle_orphan_block(channel, latest_block_received)
+        elif latest_block_received.index > latest_block_held.index:
             print('blockchain possibly behind. We got: {} Peer got: {}'
                     .format(latest_block_held.index, latest_block_received.index))
             if latest_block_held.hash == latest_block_received.previous_hash:
                 if self.blockchain.add_block(latest_block_received):
                     print('We are behind just one block, add it to our blockchain')
-                    channel.broadcast(Message.response_latest_message(self.blockchain))
+                    self.connect_orphans(latest_block_received)
+                    channel.relay(Message.compact_latest_message(self.blockchain, self.latest_trace()))
+                else:
+                    self.reject_block(channel, latest_block_received)
             elif len(received_blocks) == 1:
-                print('We have to query the chain from our peer')
-                channel.broadcast(Message.query_all_message())
+                self.handle_orphan_block(channel, latest_block_received)
             else:
                 print('Received blockchain is longer than current blockchain')
-                self.blockchain.replace(received_blocks)
+                self.connect_received_blocks(channel, received_blocks)
         else:
             print('received blockchain is not longer than current blockchain. Do nothing')
 
+    def connect_received_blocks(self, channel, received_blocks):
+        ''' Connects a received blockchain longer than ours. Pruned peers only send the blocks they
+        kept: the ones we already have are skipped, the following ones are connected one by one if
+        they extend our latest block, or replace the blocks after the fork. A pruned blockchain 
+        can not switch to a fork branching below its pruned height. '''
+        if received_blocks[0].index == 0:
+            self.blockchain.replace_async(received_blocks)
+            return
+        known = 0
+        while known < len(received_blocks) and received_blocks[known].hash in self.blockchain.blocks_by_hash:
+            known += 1
+        new_blocks = received_blocks[known:]
+        parent = self.blockchain.blocks_by_hash.get(new_blocks[0].previous_hash)
+        if parent is None or parent.index != new_blocks[0].index - 1:
+            print('Received blocks do not connect to our blockchain')
+        elif parent.hash == self.blockchain.get_latest().hash:
+            for block in new_blocks:
+                if not self.blockchain.add_block(block):
+                    self.reject_block(channel, block)
+                    break
+            print('Connected the received blocks up to #{}'.format(self.blockchain.get_latest().index))
+            self.connect_orphans(self.blockchain.get_latest())
+            channel.relay(Message.compact_latest_message(self.blockchain, self.latest_trace()))
+        elif self.blockchain.pruned_height < 0:
+            self.blockchain.replace_async(self.blockchain.blocks[:parent.index + 1] + new_blocks)
+        elif parent.index < self.blockchain.pruned_height:
+            print('Received blocks fork from our blockchain below its pruned height')
+        else:
+            self.blockchain.reorganize(new_blocks)
+
+    def handle_block_query(self, channel, raw_hash):
+        try:
+            block = self.blockchain.get_block_with_hash(hex_to_bytes(raw_hash))
+        except HttpError:
+            print('Queried block not found: {}'.format(raw_hash))
+            return
+        if block.pruned:
+            print('Queried block is pruned: {}'.format(raw_hash))
+            channel.send_message(Message.block_not_available_message(raw_hash, self.blockchain.pruned_height))
+            return
+        channel.send_message(Message.response_block_message(block))
+
+    def handle_block_not_available(self, channel, data):
+        ''' Falls back to fetching the blocks kept by a pruned peer when it can not send the
+        missing parent of orphan blocks. '''
+        if not isinstance(data, dict) or not isinstance(data.get('hash'), str):
+            print('Invalid block not available message: {}'.format(data))
+            return
+        print('Queried block is pruned by our peer: {}'.format(data['hash']))
+        try:
+            block_hash = hex_to_bytes(data['hash'])
+        except HttpError:
+            return
+        if self.orphans.is_missing_parent(block_hash):
+            channel.send_message(Message.query_all_message())
+
+    def handle_orphan_block(self, channel, block):
+        ''' Stores a block whose parent is not our latest block and asks the peer for the 
+        first missing ancestor. Falls back to fetching the whole chain if the block is on a 
+        fork of our chain or too far ahead. '''
+        if not block.has_valid_proof_of_work():
+            print('orphan block difficulty is not satisfied')
+            return
+        if block.hash not in self.orphans and not (block.has_valid_structure() and block.has_valid_hash()):
+            print('orphan block hash is not valid')
+            return
+        if not self.orphans.add(block):
+            print('Orphan block is already known')
+        root = self.orphans.root(block)
+        latest_block_held = self.blockchain.get_latest()
+        if root.previous_hash == latest_block_held.hash:
+            self.connect_orphans(latest_block_held)
+            channel.relay(Message.compact_latest_message(self.blockchain, self.latest_trace()))
+        elif root.previous_hash in self.blockchain.blocks_by_hash or root.index <= latest_block_held.index:
+            print('Received block is on a fork of our chain, we have to query the chain from our peer')
+            channel.send_message(Message.query_all_message())
+        elif root.index - latest_block_held.index > Engine.MAX_ORPHAN_GAP:
+            print('We are far behind, we have to query the chain from our peer')
+            channel.send_message(Message.query_all_message())
+        else:
+            print('Block parent is missing, querying it from our peer')
+            channel.send_message(Message.query_block_message(root.previous_hash))
+
+    def handle_compact_block(self, channel, compact_block):
+        ''' Rebuilds an announced block from the transaction pool, asking the peer for the
+        missing transactions. Blocks not extending our latest block are fetched in full. '''
+        latest_block_held = self.blockchain.get_latest()
+        if compact_block.index <= latest_block_held.index:
+            print('received compact block is not longer than current blockchain. Do nothing')
+            return
+        if compact_block.previous_hash != latest_block_held.hash:
+            print('Compact block does not extend our blockchain, querying the full block')
+            channel.send_message(Message.query_block_message(compact_block.hash))
+            return
+        transactions = compact_block.match_transactions(self.blockchain.tx_pool.transactions)
+        missing = [i for i, tx in enumerate(transactions) if tx is None]
+        if missing:
+            print('Missing {} of {} transactions of compact block'.format(len(missing), len(transactions)))
+            # the hash can only be checked once the block is rebuilt, so each peer's announcement
+            # is rebuilt separately
+            trace_context = self.tracer.context if self.tracer is not None else None
+            self.pending_compact_blocks[(channel, compact_block.hash)] = (compact_block, transactions, missing, trace_context)
+            if len(self.pending_compact_blocks) > Engine.MAX_PENDING_COMPACT_BLOCKS:
+                self.pending_compact_blocks.popitem(last=False)
+            channel.send_message(Message.query_block_transactions_message(compact_block.hash, missing))
+            return
+        self.connect_compact_block(channel, compact_block, transactions, {tx.id for tx in transactions})
+
+    def handle_block_transactions_query(self, channel, data):
+        block = self.blockchain.blocks_by_hash.get(hex_to_bytes(data['hash']))
+        if block is None or block.pruned:
+            print('Queried block not found or pruned: {}'.format(data['hash']))
+            return
+        transactions = block.data[1:]
+        indexes = [i for i in data['indexes'] if isinstance(i, int) and 0 <= i < len(transactions)]
+        channel.send_message(Message.response_block_transactions_message(
+            block.hash, [transactions[i] for i in indexes]))
+
+    def handle_filters_query(self, channel, data):
+        if self.block_filters is None:
+            print('Block filters queried, but they are disabled')
+            return
+        try:
+            filters = self.block_filters.get_filters(data['from'], data.get('to'))
+        except (HttpError, KeyError, TypeError, AttributeError):
+            print('Invalid filters query: {}'.format(data))
+            return
+        channel.send_message(Message.response_filters_message(filters))
+
+    def handle_block_transactions_response(self, channel, data):
+        block_hash = hex_to_bytes(data['hash'])
+        pending = self.pending_compact_blocks.pop((channel, block_hash), None)
+        if pending is None:
+            print('Received transactions of a block that is not pending')
+            return
+        (compact_block, transactions, missing, trace_context) = pending
+        received = Transaction.from_raw_list(data['transactions'])
+        if len(received) != len(missing):
+            print('Received wrong number of block transactions, querying the full block')
+            channel.send_message(Message.query_block_message(block_hash))
+            return
+        verified_tx_ids = {tx.id for tx in transactions if tx is not None}
+        for (i, tx) in zip(missing, received):
+            transactions[i] = tx
+        if compact_block.previous_hash != self.blockchain.get_latest().hash:
+            channel.send_message(Message.query_block_message(block_hash))
+            return
+        if self.tracer is not None:
+            self.tracer.message_resumed(trace_context)
+        self.connect_compact_block(channel, compact_block, transactions, verified_tx_ids)
+
+    def connect_compact_block(self, channel, compact_block, transactions, verified_tx_ids):
+        block = compact_block.to_block(transactions)
+        if block is None:
+            print('Compact block reconstruction failed, querying the full block')
+            channel.send_message(Message.query_block_message(compact_block.hash))
+        elif self.is_rejected_block(channel, block):
+            pass
+        elif self.blockchain.add_block(block, verified_tx_ids):
+            print('Connected compact block {}'.format(block.index))
+            self.connect_orphans(block)
+            channel.relay(Message.compact_latest_message(self.blockchain, self.latest_trace()))
+        else:
+            self.reject_block(channel, block)
+
+    def connect_orphans(self, block):
+        ''' Connects the orphan blocks waiting for the given block, then their own waiting 
+        children and so on. The orphans that lose against a sibling are discarded. '''
+        parents = [block]
+        while parents:
+            parent = parents.pop()
+            for child in self.orphans.pop_children(parent.hash):
+                if self.blockchain.get_latest() is not parent:
+                    continue
+                if self.blockchain.add_block(child):
+                    print('Connected orphan block {}'.format(child.index))
+                    parents.append(child)
+                else:
+                    self.reject_block(None, child)
+
 class Broadcaster:
     ''' Administers the clients connected to this node and broadcasts messages to all of them.'''
 
@@ -142,6 +818,11 @@ class Broadcaster:
     def peers(self):
         return [client.peer for client in self.clients]
 
+    def peer_stats(self):
+        return [dict(client.outbound_queue.stats(), 
+                     misbehaviorScore=client.factory.engine.misbehavior_score(client))
+                for client in self.clients]
+
     def register_client(self, client):
         if client.peer not in self.peers():
             print("registered client {}".format(client.peer))
@@ -152,14 +833,135 @@ class Broadcaster:
             print("unregistered remote client {}".format(client.peer))
             self.clients.remove(client)
 
-    def broadcast(self, message):
+    def broadcast(self, message, exclude=None):
+        ''' Sends a message to all clients.
+        Params:
+            - message (Message): The message.
+            - exclude (IChannel): A client not to send the message to, for example the one
+                the announced data was received from.
+        '''
         print("broadcasting message:\n{}".format(message))
-        if not self.clients:
+        clients = [client for client in self.clients if client is not exclude]
+        if not clients:
             return
-        preparedMsg = self.clients[0].factory.prepareMessage(message.to_bin())
-        for client in self.clients:
-            client.send_prepared_message(preparedMsg)
-            print("message sent to client {}".format(client.peer))
+        payload = message.to_bin()
+        prepared_messages = {}
+        for client in clients:
+            # client and server connections frame the messages differently
+            if client.factory not in prepared_messages:
+                prepared_messages[client.factory] = client.factory.prepareMessage(payload)
+            client.send_prepared_message(prepared_messages[client.factory], message, len(payload))
+            print("message queued to client {}".format(client.peer))
+
+@implementer(IPushProducer)
+class PeerQueue:
+    ''' The bounded, prioritized queue of the messages to be sent to a peer.
+
+    The queue is registered as the producer of the transport of the peer, so it stops sending
+    when the transport buffers are full and resumes when they were flushed. Messages with 
+    a lower priority value (see `Message.priority`) are sent first. When the queue is over its 
+    soft limit, transaction and chain messages are dropped instead of being queued. If the 
+    queue reaches its hard limit or the peer does not accept data for `MAX_STALL_SECONDS`,
+    the connection to the peer is dropped.
+    '''
+
+    SOFT_LIMIT_BYTES = 4 * 1024 * 1024
+    HARD_LIMIT_BYTES = 16 * 1024 * 1024
+    MAX_STALL_SECONDS = 30
+
+    def __init__(self, channel, clock=time.monotonic):
+        ''' Initializes the queue.
+        Params:
+            - channel (BlockchainPrototocol): The connection to the peer.
+            - clock (function): Returns the current time in seconds.
+        '''
+        self.channel = channel
+        self.clock = clock
+        self.entries = []
+        self.counter = itertools.count()
+        self.coalesced = {}
+        self.queued_bytes = 0
+        self.queued_messages = 0
+        self.dropped_messages = 0
+        self.paused_since = None
+
+    def enqueue(self, payload, message, size):
+        ''' Queues a message and sends as much of the queue as the transport accepts.
+        Params:
+            - payload (bytes or autobahn PreparedMessage): The message to be sent.
+            - message (Message or subscriptions.Event): The message, used for its priority and
+                coalesce key.
+            - size (int): The size of the payload in bytes.
+        '''
+        priority = message.priority()
+        if self.queued_bytes > PeerQueue.SOFT_LIMIT_BYTES and priority >= Message.PRIORITY_TRANSACTIONS:
+            print('peer {} is behind, dropping message of priority {} ({} bytes)'.format(self.channel.peer, priority, size))
+            self.dropped_messages += 1
+            return
+        if message.coalesce_key is not None and message.coalesce_key in self.coalesced:
+            self.cancel(self.coalesced.pop(message.coalesce_key))
+        entry = [priority, next(self.counter), payload, size, message.coalesce_key]
+        heapq.heappush(self.entries, entry)
+        self.queued_bytes += size
+        self.queued_messages += 1
+        if message.coalesce_key is not None:
+            self.coalesced[message.coalesce_key] = entry
+        if self.queued_bytes > PeerQueue.HARD_LIMIT_BYTES or self.is_stalled():
+            print('peer {} is too slow, dropping connection'.format(self.channel.peer))
+            self.clear()
+            self.channel.drop()
+            return
+        self.flush()
+
+    def cancel(self, entry):
+        self.queued_bytes -= entry[3]
+        self.queued_messages -= 1
+        self.dropped_messages += 1
+        entry[2] = None
+
+    def flush(self):
+        while self.entries and self.paused_since is None:
+            entry = heapq.heappop(self.entries)
+            payload, size, coalesce_key = entry[2:]
+            if payload is None:
+                continue
+            if coalesce_key is not None:
+                self.coalesced.pop(coalesce_key, None)
+            self.queued_bytes -= size
+            self.queued_messages -= 1
+            self.channel.write_payload(payload)
+
+    def is_stalled(self):
+        return (self.paused_since is not None 
+            and self.clock() - self.paused_since > PeerQueue.MAX_STALL_SECONDS)
+
+    def clear(self):
+        self.entries = []
+        self.coalesced = {}
+        self.queued_bytes = 0
+        self.queued_messages = 0
+
+    def stats(self):
+        return {
+            'peer': self.channel.peer,
+            'queuedMessages': self.queued_messages,
+            'queuedBytes': self.queued_bytes,
+            'droppedMessages': self.dropped_messages,
+            'paused': self.paused_since is not None
+        }
+
+    # IPushProducer impl
+
+    def pauseProducing(self):
+        if self.paused_since is None:
+            self.paused_since = self.clock()
+
+    def resumeProducing(self):
+        self.paused_since = None
+        self.flush()
+
+    def stopProducing(self):
+        self.clear()
 
 class IChannel:
     ''' Abstract interface of a websocket communication channel. '''
@@ -167,15 +969,23 @@ class IChannel:
     def send_message(self, message):
         raise AssertionError('IBlockchainTransport.sendMessage abstract method called.')
 
-    def send_prepared_message(self, message):
+    def send_prepared_message(self, prepared_message, message, size):
         raise AssertionError('IBlockchainTransport.send_prepared_message abstract method called.')
 
     def broadcast(self, message):
         raise AssertionError('IBlockchainTransport.broadcast abstract method called.')
 
+    def relay(self, message):
+        ''' Broadcasts a message to all peers except this one. '''
+        raise AssertionError('IBlockchainTransport.relay abstract method called.')
+
     def peer(self):
         raise AssertionError('IBlockchainTransport.broadcast abstract method called.')
 
+    def drop(self):
+        ''' Closes the connection with this peer. '''
+        raise AssertionError('IBlockchainTransport.drop abstract method called.')
+
 # ---------
 
 class BlockchainFactory:
@@ -195,6 +1005,8 @@ class BlockchainPrototocol(WebSocketAdapterProtocol, WebSocketProtocol, IChannel
 
     def onOpen(self):
         print("WebSocket connection open.")
+        self.outbound_queue = PeerQueue(self)
+        self.transport.registerProducer(self.outbound_queue, True)
         # pylint: disable=maybe-no-member
         self.factory.broadcaster.register_client(self)
         self.factory.engine.handle_socket_open(self)
@@ -203,11 +1015,9 @@ class BlockchainPrototocol(WebSocketAdapterProtocol, WebSocketProtocol, IChannel
         if not payload:
             print('Empty message received')
             return
-        message = Message.from_bin(payload)
-        print('Received message: {}'.format(message.to_raw()))
         # pylint: disable=maybe-no-member
         try:
-            self.factory.engine.handle_message(self, message)
+            self.factory.engine.handle_payload(self, payload)
         except Exception as ex:
             print(format_exception(ex))
 
@@ -216,19 +1026,36 @@ class BlockchainPrototocol(WebSocketAdapterProtocol, WebSocketProtocol, IChannel
         # pylint: disable=maybe-no-member
         self.factory.engine.handle_socket_close(self)
         self.factory.broadcaster.unregister_client(self)
+        if getattr(self, 'outbound_queue', None) is not None:
+            self.outbound_queue.clear()
+
+    def write_payload(self, payload):
+        ''' Sends a payload dequeued by the `PeerQueue` of this peer. '''
+        if isinstance(payload, bytes):
+            self.sendMessage(payload)
+        else:
+            self.sendPreparedMessage(payload)
+
+    def drop(self):
+        self.dropConnection(abort=True)
 
     # IChannel impl
 
     def send_message(self, message):
-        self.sendMessage(message.to_bin())
+        payload = message.to_bin()
+        self.outbound_queue.enqueue(payload, message, len(payload))
 
-    def send_prepared_message(self, message):
-        self.sendPreparedMessage(message)
+    def send_prepared_message(self, prepared_message, message, size):
+        self.outbound_queue.enqueue(prepared_message, message, size)
 
     def broadcast(self, message):
         # pylint: disable=maybe-no-member
         self.factory.broadcaster.broadcast(message)
 
+    def relay(self, message):
+        # pylint: disable=maybe-no-member
+        self.factory.broadcaster.broadcast(message, exclude=self)
+
 
 class ServerFactory(BlockchainFactory, WebSocketServerFactory):
 
@@ -250,8 +1077,9 @@ class ClientProtocol(BlockchainPrototocol, WebSocketClientProtocol):
 class Application:
     ''' The external interface of the p2p node. '''
 
-    def __init__(self, blockchain):
-        self.engine = Engine(blockchain)
+    def __init__(self, blockchain, clock=time.monotonic, wall_clock=time.time):
+        ''' Initializes the p2p node, see `Engine` for the clocks. '''
+        self.engine = Engine(blockchain, clock, wall_clock)
         self.broadcaster = Broadcaster()
 
     def start_server(self, url):
@@ -268,11 +1096,17 @@ class Application:
     def peers(self):
         return self.broadcaster.peers()
 
+    def peer_stats(self):
+        return self.broadcaster.peer_stats()
+
     def broadcast_blockchain(self, blockchain):
         self.broadcaster.broadcast(Message.response_chain_message(blockchain))
 
     def broadcast_latest(self, blockchain):
-        self.broadcaster.broadcast(Message.response_latest_message(blockchain))
+        self.broadcaster.broadcast(Message.compact_latest_message(blockchain, self.engine.latest_trace()))
 
     def broadcast_transaction_pool(self, tx_pool):
         self.broadcaster.broadcast(Message.response_transaction_pool_message(tx_pool))
+
+    def broadcast_transactions(self, transactions):
+        self.broadcaster.broadcast(Message.response_transactions_message(transactions))
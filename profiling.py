@@ -0,0 +1,183 @@
+# pyncoin/profiling.py
+
+''' Implements the on-demand profiling of a running node.
+
+Three kinds of measurements, each one running for a given number of seconds while the node
+keeps working:
+
+    - `sample`: a sampling profiler recording the stacks of all the threads of the node process
+        at a fixed interval. Its overhead is low enough for a loaded node. The result is in the
+        collapsed stacks format of flame graph tools, one `thread;outer;...;inner count` line
+        per distinct stack.
+    - `profile`: the deterministic `cProfile` profiler on the reactor thread and on the worker
+        processes, where the calls submitted during the measurement run under their own
+        profiler. The result is the merged `pstats` report.
+    - `memory`: a `tracemalloc` snapshot of the memory allocated during the measurement and
+        still alive at its end, grouped by line, by file or by stack of the allocation.
+
+Only one measurement can run at a time.
+'''
+
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+from twisted.internet import reactor, threads
+from twisted.internet.defer import Deferred
+
+from utils import BadRequestError, ConflictError
+
+class ProfileData:
+    ''' The statistics of a `cProfile.Profile` in the format accepted by `pstats.Stats`, which
+    can be pickled and sent from a worker process. '''
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+def run_profiled(fn, *args):
+    ''' Runs `fn(*args)` under `cProfile` in a worker process.
+    Returns ((any, ProfileData)): The result of the call and its profile.
+    '''
+    profiler = cProfile.Profile()
+    result = profiler.runcall(fn, *args)
+    profiler.create_stats()
+    return (result, ProfileData(profiler.stats))
+
+class StackSampler:
+    ''' Samples the stacks of the threads of the process from a background thread. '''
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.counts = {}
+        self.samples = 0
+
+    def run(self, seconds):
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own_ident = threading.get_ident()
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(code.co_filename.rsplit('/', 1)[-1], code.co_name))
+                    frame = frame.f_back
+                stack.append(thread_names.get(ident, str(ident)))
+                key = ';'.join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+            time.sleep(self.interval)
+        return self
+
+    def collapsed(self):
+        ''' Returns (str): The sampled stacks in collapsed format, the most frequent first. '''
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in sorted(self.counts.items(), key=lambda item: -item[1]))
+
+class NodeProfiler:
+    ''' Runs the measurements requested by the debug endpoints of the web server. '''
+
+    MAX_SECONDS = 300
+    SORT_KEYS = ('cumulative', 'tottime', 'calls', 'ncalls')
+    GROUP_BY = ('lineno', 'filename', 'traceback')
+
+    def __init__(self, workers=None):
+        ''' Initializes the profiler.
+        Params:
+            - workers (workers.WorkerPool): The pool whose calls are profiled by `profile`.
+        '''
+        self.workers = workers
+        self.running = None
+
+    def start(self, kind, seconds):
+        if not 0 < seconds <= NodeProfiler.MAX_SECONDS:
+            raise BadRequestError('invalid seconds', {'seconds': seconds, 'max': NodeProfiler.MAX_SECONDS})
+        if self.running is not None:
+            raise ConflictError('a measurement is already running', {'running': self.running})
+        self.running = kind
+
+    def finished(self, result):
+        self.running = None
+        return result
+
+    def sample(self, seconds, interval=0.005):
+        ''' Samples the stacks of the threads of the node for some seconds.
+        Returns (Deferred): Fires with the stacks in collapsed format.
+        '''
+        if not 0 < interval <= 1:
+            raise BadRequestError('invalid interval', {'interval': interval})
+        self.start('sample', seconds)
+        deferred = threads.deferToThread(StackSampler(interval).run, seconds)
+        deferred.addCallback(lambda sampler: sampler.collapsed())
+        deferred.addBoth(self.finished)
+        return deferred
+
+    def profile(self, seconds, sort='cumulative', limit=50):
+        ''' Profiles the reactor thread and the calls of the worker processes for some seconds.
+        Returns (Deferred): Fires with the `pstats` report of the most expensive functions.
+        '''
+        if sort not in NodeProfiler.SORT_KEYS:
+            raise BadRequestError('invalid sort key', {'sort': sort, 'valid': list(NodeProfiler.SORT_KEYS)})
+        self.start('profile', seconds)
+        profiler = cProfile.Profile()
+        if self.workers is not None:
+            self.workers.start_profiling()
+        profiler.enable()
+        deferred = Deferred()
+
+        def stop():
+            profiler.disable()
+            profiler.create_stats()
+            stats = pstats.Stats(ProfileData(profiler.stats), stream=io.StringIO())
+            worker_profiles = self.workers.stop_profiling() if self.workers is not None else []
+            if worker_profiles:
+                stats.add(*worker_profiles)
+            stats.sort_stats(sort).print_stats(limit)
+            deferred.callback(stats.stream.getvalue())
+
+        reactor.callLater(seconds, stop)
+        deferred.addBoth(self.finished)
+        return deferred
+
+    def memory(self, seconds, group_by='lineno', limit=25):
+        ''' Traces the memory allocations for some seconds.
+        Returns (Deferred): Fires with the traced memory and the largest allocation sites.
+        '''
+        if group_by not in NodeProfiler.GROUP_BY:
+            raise BadRequestError('invalid grouping', {'groupBy': group_by, 'valid': list(NodeProfiler.GROUP_BY)})
+        self.start('memory', seconds)
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start(25 if group_by == 'traceback' else 1)
+        deferred = Deferred()
+
+        def stop():
+            (current, peak) = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>')
+            ])
+            if not was_tracing:
+                tracemalloc.stop()
+            deferred.callback({
+                'tracedBytes': current,
+                'peakBytes': peak,
+                'top': [{
+                    'location': [str(frame) for frame in stat.traceback],
+                    'sizeBytes': stat.size,
+                    'count': stat.count
+                } for stat in snapshot.statistics(group_by)[:limit]]
+            })
+
+        reactor.callLater(seconds, stop)
+        deferred.addBoth(self.finished)
+        return deferred
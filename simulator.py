@@ -0,0 +1,431 @@
+# pyncoin/simulator.py
+
+''' Implements an in-process simulation of a network of nodes for protocol measurements.
+
+Every simulated node has its own `Blockchain`, `TransactionPool`, wallet and p2p `Application`,
+exactly as a real node, but its peers are `SimChannel`s instead of websocket connections.
+The messages go through the `PeerQueue` of the sender, like on a real connection, and are
+delivered by a virtual clock after the transmission time on the link (its bandwidth), its
+latency and a random jitter, or lost with a given probability. The expiration of the caches,
+the decay of the misbehavior scores and the stall checks of the queues follow the same clock.
+Nothing is sent on sockets and nothing waits for real time, so a network of 50 nodes runs for
+hours of virtual time in a few seconds, and a scenario with the same seed always takes the
+same course.
+
+Blocks are found by a random node at exponentially distributed intervals, each time on the
+latest block of that node, so blocks found before the previous one reached the miner become
+stale. The scenario reports:
+
+    - the propagation time of the blocks, from the time they were found to the time 50%, 90%
+        and 100% of the nodes connected them,
+    - the stale blocks, found but not in the final blockchain, and the reorganizations,
+    - the bytes and messages sent on the wire, by message type.
+
+Usage:
+    python simulator.py --nodes 50 --degree 4 --latency 0.05 --bandwidth 1000000 --duration 3600
+'''
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import re
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+
+import ecdsa
+from twisted.internet.task import Clock
+
+from blockchain import Block, Blockchain, IBlockchainListener
+from p2p import Application, BlockchainFactory, IChannel, PeerQueue
+from transaction_pool import TransactionPool
+from utils import HttpError, format_exception, percentile
+from wallet import Wallet
+
+MESSAGE_TYPE = re.compile(rb'\{"type": ?(\d+)')
+
+def summary(values):
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else None,
+        'p50': percentile(values, 0.5),
+        'p90': percentile(values, 0.9),
+        'max': max(values) if values else None
+    }
+
+class Link:
+    ''' One direction of a simulated connection. The messages are transmitted one after the
+    other at the bandwidth of the link and delivered in order. '''
+
+    # The sender is paused when more than this many bytes are waiting to be transmitted:
+    BUFFER_BYTES = 64 * 1024
+
+    def __init__(self, network, latency, jitter, bandwidth, loss):
+        ''' Initializes the link.
+        Params:
+            - network (Network): The network, providing the clock, the random generator and
+                the traffic statistics.
+            - latency (float): The propagation delay in seconds.
+            - jitter (float): The maximum random delay added to the latency, in seconds.
+            - bandwidth (float): The transmission rate in bytes per second, None for unlimited.
+            - loss (float): The probability of a message to be lost.
+        '''
+        self.network = network
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.busy_until = 0
+        self.last_arrival = 0
+
+    def backlog_seconds(self):
+        return max(0, self.busy_until - self.network.clock.seconds())
+
+    def transmit(self, payload, deliver):
+        ''' Schedules the delivery of a payload. Returns (bool): False if the sender must pause. '''
+        now = self.network.clock.seconds()
+        size = len(payload)
+        start = max(now, self.busy_until)
+        self.busy_until = start + (size / self.bandwidth if self.bandwidth else 0)
+        match = MESSAGE_TYPE.match(payload)
+        self.network.count_message(int(match.group(1)) if match else None, size)
+        if self.network.rng.random() < self.loss:
+            self.network.lost_messages += 1
+        else:
+            arrival = self.busy_until + self.latency + self.network.rng.uniform(0, self.jitter)
+            self.last_arrival = max(arrival, self.last_arrival)
+            self.network.clock.callLater(self.last_arrival - now, deliver, payload)
+        return not self.bandwidth or self.backlog_seconds() * self.bandwidth <= Link.BUFFER_BYTES
+
+class SimFactory(BlockchainFactory):
+    ''' The factory of the channels of a simulated node. Messages are not framed, so a
+    prepared message is the payload itself. '''
+
+    def prepareMessage(self, payload):
+        return payload
+
+class SimChannel(IChannel):
+    ''' One end of a simulated connection between two nodes. '''
+
+    def __init__(self, network, node, link, peer):
+        self.network = network
+        self.node = node
+        self.factory = node.factory
+        self.link = link
+        self.peer = peer
+        self.remote = None
+        self.open = True
+        self.outbound_queue = PeerQueue(self, network.clock.seconds)
+
+    def receive(self, payload):
+        if not self.open:
+            return
+        try:
+            self.factory.engine.handle_payload(self, payload)
+        except Exception as ex:
+            print(format_exception(ex))
+
+    def close(self):
+        if not self.open:
+            return
+        self.open = False
+        self.factory.engine.handle_socket_close(self)
+        self.factory.broadcaster.unregister_client(self)
+        self.outbound_queue.clear()
+
+    # used by PeerQueue
+
+    def write_payload(self, payload):
+        if not self.open:
+            return
+        if not self.link.transmit(payload, self.remote.receive):
+            self.outbound_queue.pauseProducing()
+            self.network.clock.callLater(self.link.backlog_seconds(), self.outbound_queue.resumeProducing)
+
+    def drop(self):
+        self.close()
+        self.remote.close()
+
+    # IChannel impl
+
+    def send_message(self, message):
+        payload = message.to_bin()
+        self.outbound_queue.enqueue(payload, message, len(payload))
+
+    def send_prepared_message(self, prepared_message, message, size):
+        self.outbound_queue.enqueue(prepared_message, message, size)
+
+    def broadcast(self, message):
+        self.factory.broadcaster.broadcast(message)
+
+    def relay(self, message):
+        self.factory.broadcaster.broadcast(message, exclude=self)
+
+class SimNode(IBlockchainListener):
+    ''' A simulated node, recording when it connects each block. '''
+
+    def __init__(self, network, name, wallet):
+        self.network = network
+        self.name = name
+        self.blockchain = Blockchain(TransactionPool())
+        self.application = Application(self.blockchain, network.clock.seconds,
+                                       lambda: network.timestamp().timestamp())
+        self.blockchain.p2p_application = self.application
+        self.factory = SimFactory(self.application.engine, self.application.broadcaster)
+        self.wallet = wallet
+        wallet.track(self.blockchain)
+        self.chain = [block.hash for block in self.blockchain.blocks]
+        self.blockchain.add_listener(self)
+
+    # IBlockchainListener impl
+
+    def block_added(self, blockchain, block):
+        self.chain.append(block.hash)
+        self.network.block_connected(self, block.hash)
+
+    def chain_replaced(self, blockchain):
+        new_chain = [block.hash for block in blockchain.blocks]
+        fork = 0
+        while fork < min(len(self.chain), len(new_chain)) and self.chain[fork] == new_chain[fork]:
+            fork += 1
+        self.network.reorganized(self, len(self.chain) - fork)
+        self.chain = new_chain
+        for block_hash in new_chain[fork:]:
+            self.network.block_connected(self, block_hash)
+
+class Network:
+    ''' A simulated network of nodes sharing a virtual clock. '''
+
+    PAYMENT_AMOUNT = Decimal(1)
+
+    def __init__(self, key_directory, seed=0):
+        ''' Initializes an empty network.
+        Params:
+            - key_directory (str): The directory of the private keys of the wallets of the nodes.
+            - seed (int): The seed of the random generator of the network.
+        '''
+        self.clock = Clock()
+        self.rng = random.Random(seed)
+        self.key_directory = key_directory
+        # the timestamps of the blocks follow the virtual clock, in the past so that they are valid
+        self.epoch = Block.genesis_block().timestamp + timedelta(days=1)
+        self.nodes = []
+        self.found = {}
+        self.connected = {}
+        self.reorgs = []
+        self.bytes_by_type = {}
+        self.messages_by_type = {}
+        self.lost_messages = 0
+        self.payments = {'sent': 0, 'failed': 0}
+
+    def add_node(self):
+        name = 'sim://node-{}'.format(len(self.nodes))
+        private_key = ecdsa.SigningKey.generate(entropy=lambda size: self.rng.getrandbits(8 * size).to_bytes(size, 'big'))
+        key_location = os.path.join(self.key_directory, 'node-{}.pem'.format(len(self.nodes)))
+        with open(key_location, 'wb') as key_file:
+            key_file.write(private_key.to_pem())
+        node = SimNode(self, name, Wallet(key_location))
+        self.nodes.append(node)
+        return node
+
+    def connect(self, node, other, latency=0.05, jitter=0, bandwidth=None, loss=0):
+        ''' Connects two nodes with a link with the same properties in both directions. '''
+        channel = SimChannel(self, node, Link(self, latency, jitter, bandwidth, loss), other.name)
+        other_channel = SimChannel(self, other, Link(self, latency, jitter, bandwidth, loss), node.name)
+        channel.remote = other_channel
+        other_channel.remote = channel
+        for (end, sim_node) in ((channel, node), (other_channel, other)):
+            sim_node.factory.broadcaster.register_client(end)
+            sim_node.factory.engine.handle_socket_open(end)
+
+    def timestamp(self):
+        return self.epoch + timedelta(seconds=self.clock.seconds())
+
+    def mine(self, node):
+        ''' Mines a block on the latest block of a node and announces it to its peers. '''
+        blockchain = node.blockchain
+        template = blockchain.next_block_template(blockchain.next_block_data(node.wallet))
+        (index, previous_hash, _, data, difficulty) = template
+        block = Block.find(index, previous_hash, self.timestamp(), data, difficulty)
+        self.found[block.hash] = (self.clock.seconds(), node.name)
+        blockchain.connect_mined_block(block)
+
+    def pay(self, node, receiver):
+        try:
+            node.blockchain.send_transaction(node.wallet, receiver.wallet.get_public_key(), Network.PAYMENT_AMOUNT)
+            self.payments['sent'] += 1
+        except HttpError:
+            self.payments['failed'] += 1
+
+    def run(self, until):
+        ''' Runs the scheduled events in order of time until the virtual time `until`. '''
+        while True:
+            calls = self.clock.getDelayedCalls()
+            if not calls or calls[0].getTime() > until:
+                break
+            self.clock.advance(calls[0].getTime() - self.clock.seconds())
+        self.clock.advance(max(0, until - self.clock.seconds()))
+
+    # statistics
+
+    def block_connected(self, node, block_hash):
+        self.connected.setdefault(block_hash, {}).setdefault(node.name, self.clock.seconds())
+
+    def reorganized(self, node, depth):
+        self.reorgs.append(depth)
+
+    def count_message(self, message_type, size):
+        self.bytes_by_type[message_type] = self.bytes_by_type.get(message_type, 0) + size
+        self.messages_by_type[message_type] = self.messages_by_type.get(message_type, 0) + 1
+
+    def best_chain(self):
+        ''' Returns (list<bytes>): The blockchain of most nodes at the end of the simulation. '''
+        tips = {}
+        for node in self.nodes:
+            tips[node.chain[-1]] = tips.get(node.chain[-1], 0) + 1
+        best_tip = max(tips, key=tips.get)
+        return next(node.chain for node in self.nodes if node.chain[-1] == best_tip)
+
+    def report(self):
+        nodes = len(self.nodes)
+        delays = {fraction: [] for fraction in (0.5, 0.9, 1.0)}
+        for block_hash, (found_at, _) in self.found.items():
+            times = sorted(self.connected.get(block_hash, {}).values())
+            for fraction, values in delays.items():
+                needed = max(1, int(-(-fraction * nodes // 1)))
+                if len(times) >= needed:
+                    values.append(times[needed - 1] - found_at)
+        best_chain = set(self.best_chain())
+        stale = [block_hash for block_hash in self.found if block_hash not in best_chain]
+        total_bytes = sum(self.bytes_by_type.values())
+        return {
+            'nodes': nodes,
+            'virtualSeconds': self.clock.seconds(),
+            'blocksFound': len(self.found),
+            'height': len(best_chain) - 1,
+            'converged': len({node.chain[-1] for node in self.nodes}) == 1,
+            'propagation': {
+                'to50Percent': summary(delays[0.5]),
+                'to90Percent': summary(delays[0.9]),
+                'toAllNodes': summary(delays[1.0])
+            },
+            'staleBlocks': len(stale),
+            'staleRate': len(stale) / len(self.found) if self.found else 0,
+            'reorgs': len(self.reorgs),
+            'reorgDepth': summary(self.reorgs),
+            'wire': {
+                'bytes': total_bytes,
+                'messages': sum(self.messages_by_type.values()),
+                'lostMessages': self.lost_messages,
+                'bytesPerBlock': total_bytes / len(self.found) if self.found else None,
+                'bytesByType': {str(key): value for key, value in sorted(self.bytes_by_type.items(), key=str)},
+                'messagesByType': {str(key): value for key, value in sorted(self.messages_by_type.items(), key=str)}
+            },
+            'payments': self.payments
+        }
+
+class Scenario:
+    ''' A random network of nodes finding blocks and sending payments for a given virtual time. '''
+
+    def __init__(self, nodes=50, degree=4, latency=0.05, jitter=0.02, bandwidth=1000000, loss=0,
+                 block_interval=Blockchain.BLOCK_GENERATION_INTERVAL, tx_rate=0, duration=3600, drain=60, seed=0):
+        ''' Initializes the scenario.
+        Params:
+            - nodes (int): The number of nodes.
+            - degree (int): The minimum number of peers of each node.
+            - latency, jitter, bandwidth, loss: The properties of every link, see `Link`.
+            - block_interval (float): The mean time between two blocks found in the network.
+            - tx_rate (float): The mean number of payments per second sent in the network.
+            - duration (float): The virtual time during which blocks are found, in seconds.
+            - drain (float): The virtual time given to the network to converge after that.
+            - seed (int): The seed of the random generator.
+        '''
+        self.nodes = nodes
+        self.degree = degree
+        self.link = {'latency': latency, 'jitter': jitter, 'bandwidth': bandwidth, 'loss': loss}
+        self.block_interval = block_interval
+        self.tx_rate = tx_rate
+        self.duration = duration
+        self.drain = drain
+        self.seed = seed
+
+    def build(self, key_directory):
+        ''' Returns (Network): The nodes, each one connected to its predecessor, so that the
+        network is connected, and to random nodes until it has `degree` peers. '''
+        network = Network(key_directory, self.seed)
+        for _ in range(self.nodes):
+            network.add_node()
+        links = set()
+        for i in range(1, self.nodes):
+            links.add((i - 1, i))
+        for i in range(self.nodes):
+            candidates = [j for j in range(self.nodes) if j != i]
+            network.rng.shuffle(candidates)
+            for j in candidates:
+                if sum(1 for link in links if i in link) >= self.degree:
+                    break
+                links.add((min(i, j), max(i, j)))
+        for (i, j) in sorted(links):
+            network.connect(network.nodes[i], network.nodes[j], **self.link)
+        return network
+
+    def schedule_blocks(self, network):
+        if network.clock.seconds() >= self.duration:
+            return
+        network.clock.callLater(network.rng.expovariate(1 / self.block_interval), self.find_block, network)
+
+    def find_block(self, network):
+        network.mine(network.rng.choice(network.nodes))
+        self.schedule_blocks(network)
+
+    def schedule_payments(self, network):
+        if network.clock.seconds() >= self.duration:
+            return
+        network.clock.callLater(network.rng.expovariate(self.tx_rate), self.send_payment, network)
+
+    def send_payment(self, network):
+        (payer, receiver) = network.rng.sample(network.nodes, 2)
+        network.pay(payer, receiver)
+        self.schedule_payments(network)
+
+    def run(self):
+        ''' Runs the scenario. Returns (dict): The report of the network. '''
+        with tempfile.TemporaryDirectory(prefix='pyncoin-sim-') as key_directory:
+            network = self.build(key_directory)
+            self.schedule_blocks(network)
+            if self.tx_rate > 0:
+                self.schedule_payments(network)
+            network.run(self.duration + self.drain)
+            return network.report()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='simulates a network of nodes in a single process')
+    parser.add_argument('--nodes', help='number of nodes', default=50, type=int)
+    parser.add_argument('--degree', help='minimum number of peers of each node', default=4, type=int)
+    parser.add_argument('--latency', help='latency of the links in seconds', default=0.05, type=float)
+    parser.add_argument('--jitter', help='maximum random delay added to the latency in seconds',
+                        default=0.02, type=float)
+    parser.add_argument('--bandwidth', help='bandwidth of the links in bytes per second, 0 for unlimited',
+                        default=1000000, type=float)
+    parser.add_argument('--loss', help='probability of a message to be lost', default=0, type=float)
+    parser.add_argument('--block-interval', help='mean time between two blocks in seconds',
+                        default=Blockchain.BLOCK_GENERATION_INTERVAL, type=float)
+    parser.add_argument('--tx-rate', help='mean number of payments per second', default=0, type=float)
+    parser.add_argument('--duration', help='virtual time during which blocks are found, in seconds',
+                        default=3600, type=float)
+    parser.add_argument('--drain', help='virtual time given to the network to converge at the end, in seconds',
+                        default=60, type=float)
+    parser.add_argument('--seed', help='seed of the random generator', default=0, type=int)
+    parser.add_argument('-v', '--verbose', help='print the log of the nodes', action='store_true')
+    args = parser.parse_args()
+
+    scenario = Scenario(args.nodes, args.degree, args.latency, args.jitter, args.bandwidth or None, args.loss,
+                        args.block_interval, args.tx_rate, args.duration, args.drain, args.seed)
+    if args.verbose:
+        report = scenario.run()
+    else:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            report = scenario.run()
+    print(json.dumps(report, indent=1))
@@ -0,0 +1,131 @@
+# pyncoin/snapshot.py
+
+''' Implements the snapshots of the unspent transaction outputs used to bootstrap new nodes.
+
+A snapshot contains the unspent outputs of the blockchain at a given height. A node started
+with a snapshot accepts a blockchain containing the snapshot block after checking only the
+proof of work and the linkage of the blocks up to it, so that it is usable at the tip
+immediately. The whole blockchain is then validated from the genesis block in the background
+and the unspent outputs are compared with the snapshot by their content hash.
+
+Usage:
+    python snapshot.py export http://127.0.0.1:5000 utxo.snapshot [--height N]
+    python snapshot.py info utxo.snapshot
+'''
+
+import argparse
+import hashlib
+import struct
+from decimal import Decimal
+from urllib.request import urlopen
+
+from transaction import UnspentTxOut
+from utils import BadRequestError
+
+class UtxoSnapshot:
+    ''' The unspent transaction outputs of the blockchain at a given height. '''
+
+    MAGIC = b'PYNUTXO1'
+    HEADER = struct.Struct('>8sQ32sQ')
+    OUTPOINT = struct.Struct('>32sQ')
+
+    def __init__(self, height, block_hash, unspent_tx_outs):
+        ''' Initializes the snapshot.
+        Params:
+            - height (int): The index of the last block whose transactions are included.
+            - block_hash (bytes): The hash of that block.
+            - unspent_tx_outs (list<UnspentTxOut>): The unspent outputs after that block.
+        '''
+        self.height = height
+        self.block_hash = block_hash
+        self.unspent_tx_outs = sorted(unspent_tx_outs, key=lambda uTxO: (uTxO.tx_out_id, uTxO.tx_out_index))
+        self.content_hash = hashlib.sha256(self.encode_content()).digest()
+
+    def encode_content(self):
+        parts = [UtxoSnapshot.HEADER.pack(UtxoSnapshot.MAGIC, self.height, self.block_hash,
+                                          len(self.unspent_tx_outs))]
+        for uTxO in self.unspent_tx_outs:
+            amount = str(uTxO.amount).encode('ascii')
+            parts.append(UtxoSnapshot.OUTPOINT.pack(uTxO.tx_out_id, uTxO.tx_out_index))
+            parts.append(bytes([len(uTxO.address)]) + uTxO.address)
+            parts.append(bytes([len(amount)]) + amount)
+        return b''.join(parts)
+
+    def to_bin(self):
+        ''' Returns (bytes): The snapshot in binary format, followed by its content hash. '''
+        return self.encode_content() + self.content_hash
+
+    @classmethod
+    def from_bin(cls, data):
+        ''' Returns a new snapshot read from its binary format.
+        Raises BadRequestError if the data is malformed or does not match its content hash. '''
+        try:
+            (magic, height, block_hash, count) = UtxoSnapshot.HEADER.unpack_from(data, 0)
+            if magic != UtxoSnapshot.MAGIC:
+                raise BadRequestError('invalid snapshot format')
+            offset = UtxoSnapshot.HEADER.size
+            unspent_tx_outs = []
+            for _ in range(count):
+                (tx_out_id, tx_out_index) = UtxoSnapshot.OUTPOINT.unpack_from(data, offset)
+                offset += UtxoSnapshot.OUTPOINT.size
+                address = data[offset + 1:offset + 1 + data[offset]]
+                offset += 1 + len(address)
+                amount = Decimal(data[offset + 1:offset + 1 + data[offset]].decode('ascii'))
+                offset += 1 + data[offset]
+                unspent_tx_outs.append(UnspentTxOut(tx_out_id, tx_out_index, address, amount))
+        except (struct.error, IndexError, ArithmeticError, UnicodeDecodeError) as ex:
+            raise BadRequestError('invalid snapshot format', {'cause': str(ex)})
+        snapshot = cls(height, block_hash, unspent_tx_outs)
+        if data[offset:] != snapshot.content_hash:
+            raise BadRequestError('snapshot content hash mismatch')
+        return snapshot
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as snapshot_file:
+            return cls.from_bin(snapshot_file.read())
+
+    def write(self, path):
+        with open(path, 'wb') as snapshot_file:
+            snapshot_file.write(self.to_bin())
+
+    @staticmethod
+    def from_blocks(blocks):
+        ''' Creates the snapshot of the last of the given blocks replaying their transactions.
+        The blocks must be already validated: the transactions are not checked again. '''
+        unspent_tx_outs = []
+        for block in blocks:
+            unspent_tx_outs = UnspentTxOut.update_unspent_tx_outs(block.data, unspent_tx_outs)
+        return UtxoSnapshot(blocks[-1].index, blocks[-1].hash, unspent_tx_outs)
+
+    def info(self):
+        return {
+            'height': self.height,
+            'blockHash': self.block_hash.hex(),
+            'contentHash': self.content_hash.hex(),
+            'unspentTxOuts': len(self.unspent_tx_outs)
+        }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='exports and inspects UTXO snapshots')
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser('export', help='downloads a snapshot from a running node')
+    export_parser.add_argument('node_url', help='url of the web server of the node, e.g. http://127.0.0.1:5000')
+    export_parser.add_argument('path', help='file the snapshot is written to')
+    export_parser.add_argument('--height', help='height of the snapshot (defaults to the tip)', type=int)
+    info_parser = commands.add_parser('info', help='checks a snapshot file and prints its header')
+    info_parser.add_argument('path', help='the snapshot file')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        url = args.node_url.rstrip('/') + '/utxoSnapshot'
+        if args.height is not None:
+            url += '?height={}'.format(args.height)
+        with urlopen(url) as response:
+            snapshot = UtxoSnapshot.from_bin(response.read())
+        snapshot.write(args.path)
+        print(snapshot.info())
+    elif args.command == 'info':
+        print(UtxoSnapshot.read(args.path).info())
+    else:
+        parser.print_help()
@@ -0,0 +1,295 @@
+# pyncoin/subscriptions.py
+
+''' Implements the WebSocket interface pushing the events of the node to its clients.
+
+A client subscribes sending a json command, for example:
+
+    {"subscribe": ["blocks", "transactions"], "addresses": ["<hex address>"]}
+
+and then receives json events in the `{"event": <type>, "data": <data>}` format:
+
+    - `block`: the header of a block connected to the end of the blockchain (topic `blocks`).
+    - `chainReplaced`: the header of the new latest block after the blockchain was replaced with
+        a received one. Sent to the subscribers of `blocks` and of any address, which should fetch
+        again the state they keep.
+    - `transactions`: the transactions accepted in the transaction pool (topic `transactions`).
+    - `address`: the outputs received and spent by a subscribed address in a new block, and its
+        new balance.
+
+Every event is serialized and framed once, whatever the number of its subscribers.
+'''
+
+import json
+from decimal import Decimal
+
+from autobahn.twisted.websocket import WebSocketServerProtocol, WebSocketServerFactory, listenWS
+
+from blockchain import IBlockchainListener
+from p2p import Message, PeerQueue
+from transaction import Transaction, UnspentTxOut
+from utils import BadRequestError, HttpError, RawSerializable, format_exception, hex_to_bytes
+
+class Event(RawSerializable):
+    ''' An event pushed to the subscribers. Events are queued in the `p2p.PeerQueue` of each
+    subscriber like the p2p messages, so slow subscribers drop transaction events first and
+    are disconnected when they fall too far behind. '''
+
+    BLOCK = 'block'
+    CHAIN_REPLACED = 'chainReplaced'
+    TRANSACTIONS = 'transactions'
+    ADDRESS = 'address'
+    SUBSCRIBED = 'subscribed'
+    ERROR = 'error'
+
+    def __init__(self, event_type, data, coalesce_key=None):
+        ''' Initializes the event.
+        Params:
+            - event_type (str): One of the event types above.
+            - data (any): A json serializable data object.
+            - coalesce_key (str): See `p2p.Message`.
+        '''
+        self.event_type = event_type
+        self.data = data
+        self.coalesce_key = coalesce_key
+
+    def to_raw(self):
+        return {
+            'event': self.event_type,
+            'data': self.data
+        }
+
+    @classmethod
+    def from_raw(cls, raw_obj):
+        return cls(raw_obj['event'], raw_obj['data'])
+
+    def priority(self):
+        ''' Returns (int): The send priority of this event, see `p2p.Message.priority`. '''
+        if self.event_type == Event.TRANSACTIONS:
+            return Message.PRIORITY_TRANSACTIONS
+        elif self.event_type in (Event.SUBSCRIBED, Event.ERROR):
+            return Message.PRIORITY_CONTROL
+        return Message.PRIORITY_BLOCK
+
+    @staticmethod
+    def block_header(block):
+        return {
+            'index': block.index,
+            'hash': block.hash.hex(),
+            'previousHash': block.previous_hash.hex() if block.previous_hash is not None else None,
+            'timestamp': int(block.timestamp.timestamp()),
+            'difficulty': block.difficulty,
+            'transactions': len(block.data)
+        }
+
+class SubscriptionHub(IBlockchainListener):
+    ''' Keeps the subscriptions of the clients and publishes the events of the blockchain to them.
+
+    The hub keeps the unspent outputs of the subscribed addresses, so that the outputs spent by
+    a new block are matched to their address without looking them up in the blockchain.
+    '''
+
+    TOPICS = ('blocks', 'transactions')
+    MAX_ADDRESSES = 100
+
+    def __init__(self, blockchain):
+        ''' Initializes the hub and registers it as a listener of the blockchain. '''
+        self.blockchain = blockchain
+        self.topics = {topic: set() for topic in SubscriptionHub.TOPICS}
+        self.address_subscribers = {}
+        self.address_outputs = {}
+        self.owners = {}
+        self.subscribers = set()
+        blockchain.add_listener(self)
+
+    def add(self, subscriber):
+        self.subscribers.add(subscriber)
+
+    def remove(self, subscriber):
+        self.subscribers.discard(subscriber)
+        for subscribers in self.topics.values():
+            subscribers.discard(subscriber)
+        for address in list(self.address_subscribers):
+            self.unsubscribe_address(subscriber, address)
+
+    def handle_command(self, subscriber, command):
+        ''' Applies a subscription command received from a client.
+        Params:
+            - subscriber (Subscriber): The client.
+            - command (dict): The `subscribe` and `unsubscribe` lists of topics and the
+                `addresses` and `removeAddresses` lists of hex addresses, all optional.
+        '''
+        lists = ('subscribe', 'unsubscribe', 'addresses', 'removeAddresses')
+        if not isinstance(command, dict) or not all(isinstance(command.get(key, []), list) for key in lists):
+            raise BadRequestError('invalid subscription command')
+        topics = command.get('subscribe', [])
+        removed_topics = command.get('unsubscribe', [])
+        addresses = [hex_to_bytes(address) for address in command.get('addresses', [])]
+        removed_addresses = [hex_to_bytes(address) for address in command.get('removeAddresses', [])]
+        invalid_topics = [topic for topic in topics + removed_topics if topic not in self.topics]
+        if invalid_topics:
+            raise BadRequestError('invalid topics', {'topics': invalid_topics, 'validTopics': list(self.topics)})
+        subscribed_addresses = {address for address, subscribers in self.address_subscribers.items()
+                                if subscriber in subscribers}
+        if len(subscribed_addresses.union(addresses)) > SubscriptionHub.MAX_ADDRESSES:
+            raise BadRequestError('too many addresses', {'maxAddresses': SubscriptionHub.MAX_ADDRESSES})
+        for topic in topics:
+            self.topics[topic].add(subscriber)
+        for topic in removed_topics:
+            self.topics[topic].discard(subscriber)
+        for address in addresses:
+            self.subscribe_address(subscriber, address)
+        for address in removed_addresses:
+            self.unsubscribe_address(subscriber, address)
+        subscribed_addresses = [address.hex() for address, subscribers in self.address_subscribers.items()
+                                if subscriber in subscribers]
+        subscriber.send_event(Event(Event.SUBSCRIBED, {
+            'topics': [topic for topic, subscribers in self.topics.items() if subscriber in subscribers],
+            'addresses': subscribed_addresses
+        }))
+
+    def subscribe_address(self, subscriber, address):
+        if address not in self.address_subscribers:
+            self.address_subscribers[address] = set()
+            self.load_address(address)
+        self.address_subscribers[address].add(subscriber)
+
+    def unsubscribe_address(self, subscriber, address):
+        subscribers = self.address_subscribers.get(address)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self.address_subscribers[address]
+            for outpoint in self.address_outputs.pop(address):
+                del self.owners[outpoint]
+
+    def load_address(self, address):
+        for outpoint in self.address_outputs.get(address, {}):
+            del self.owners[outpoint]
+        self.address_outputs[address] = {(uTxO.tx_out_id, uTxO.tx_out_index): uTxO
+                                         for uTxO in self.blockchain.unspent_tx_outs_for_address(address)}
+        for outpoint in self.address_outputs[address]:
+            self.owners[outpoint] = address
+
+    def balance(self, address):
+        return sum((uTxO.amount for uTxO in self.address_outputs[address].values()), Decimal(0))
+
+    def publish(self, event, subscribers):
+        ''' Sends an event to the given subscribers, serializing and framing it only once. '''
+        if not subscribers:
+            return
+        payload = event.to_bin()
+        prepared_messages = {}
+        for subscriber in subscribers:
+            if subscriber.factory not in prepared_messages:
+                prepared_messages[subscriber.factory] = subscriber.factory.prepareMessage(payload)
+            # an error sending to a subscriber must not prevent the others nor the caller
+            # from going on
+            try:
+                subscriber.send_prepared_event(prepared_messages[subscriber.factory], event, len(payload))
+            except Exception as ex:
+                print(format_exception(ex))
+
+    def stats(self):
+        return {
+            'subscribers': len(self.subscribers),
+            'topics': {topic: len(subscribers) for topic, subscribers in self.topics.items()},
+            'addresses': len(self.address_subscribers)
+        }
+
+    # IBlockchainListener impl
+
+    def block_added(self, blockchain, block):
+        self.publish(Event(Event.BLOCK, Event.block_header(block)), self.topics['blocks'])
+        if not self.address_subscribers:
+            return
+        changes = {}
+        for tx in block.data:
+            for tx_in in tx.tx_ins:
+                outpoint = (tx_in.tx_out_id, tx_in.tx_out_index)
+                address = self.owners.pop(outpoint, None)
+                if address is not None:
+                    self.address_outputs[address].pop(outpoint)
+                    changes.setdefault(address, ([], []))[1].append(
+                        {'txOutId': tx_in.tx_out_id.hex(), 'txOutIndex': tx_in.tx_out_index, 'txId': tx.id.hex()})
+            for index, tx_out in enumerate(tx.tx_outs):
+                if tx_out.address in self.address_outputs:
+                    uTxO = UnspentTxOut(tx.id, index, tx_out.address, tx_out.amount)
+                    self.address_outputs[tx_out.address][(tx.id, index)] = uTxO
+                    self.owners[(tx.id, index)] = tx_out.address
+                    changes.setdefault(tx_out.address, ([], []))[0].append(uTxO)
+        for address, (received, spent) in changes.items():
+            self.publish(Event(Event.ADDRESS, {
+                'address': address.hex(),
+                'blockHash': block.hash.hex(),
+                'index': block.index,
+                'received': UnspentTxOut.to_raw_list(received),
+                'spent': spent,
+                'balance': self.balance(address)
+            }), self.address_subscribers[address])
+
+    def chain_replaced(self, blockchain):
+        for address in self.address_subscribers:
+            self.load_address(address)
+        subscribers = self.topics['blocks'].union(*self.address_subscribers.values())
+        self.publish(Event(Event.CHAIN_REPLACED, Event.block_header(blockchain.get_latest())), subscribers)
+
+    def transactions_added(self, transactions):
+        self.publish(Event(Event.TRANSACTIONS, Transaction.to_raw_list(transactions)), self.topics['transactions'])
+
+class SubscriberProtocol(WebSocketServerProtocol):
+    ''' The connection with a subscribed client. '''
+
+    def onOpen(self):
+        self.outbound_queue = PeerQueue(self)
+        self.transport.registerProducer(self.outbound_queue, True)
+        # pylint: disable=maybe-no-member
+        self.factory.hub.add(self)
+
+    def onMessage(self, payload, isBinary):
+        try:
+            command = json.loads(payload.decode('utf-8'))
+            # pylint: disable=maybe-no-member
+            self.factory.hub.handle_command(self, command)
+        except HttpError as ex:
+            self.send_event(Event(Event.ERROR, ex.to_raw()))
+        except ValueError:
+            self.send_event(Event(Event.ERROR, BadRequestError('invalid json').to_raw()))
+        except Exception as ex:
+            print(format_exception(ex))
+
+    def onClose(self, wasClean, code, reason):
+        # pylint: disable=maybe-no-member
+        self.factory.hub.remove(self)
+        if getattr(self, 'outbound_queue', None) is not None:
+            self.outbound_queue.clear()
+
+    def send_event(self, event):
+        payload = event.to_bin()
+        self.outbound_queue.enqueue(payload, event, len(payload))
+
+    def send_prepared_event(self, prepared_message, event, size):
+        self.outbound_queue.enqueue(prepared_message, event, size)
+
+    # used by PeerQueue
+
+    def write_payload(self, payload):
+        if isinstance(payload, bytes):
+            self.sendMessage(payload)
+        else:
+            self.sendPreparedMessage(payload)
+
+    def drop(self):
+        self.dropConnection(abort=True)
+
+class SubscriptionFactory(WebSocketServerFactory):
+
+    protocol = SubscriberProtocol
+
+    def __init__(self, url, hub):
+        WebSocketServerFactory.__init__(self, url)
+        self.hub = hub
+
+def start_subscription_server(url, hub):
+    ''' Starts accepting the connections of the subscribers at the given websocket url. '''
+    listenWS(SubscriptionFactory(url, hub))
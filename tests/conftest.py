@@ -0,0 +1,8 @@
+# pyncoin/tests/conftest.py
+
+''' Makes the modules of the node importable by the tests. '''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,35 @@
+# pyncoin/tests/test_blockchain.py
+
+import os
+
+from blockchain import Blockchain
+from transaction_pool import TransactionPool
+from wallet import Wallet
+
+class Application:
+
+    def broadcast_latest(self, blockchain):
+        pass
+
+    def broadcast_transactions(self, transactions):
+        pass
+
+def test_consolidation_of_an_abandoned_block_keeps_its_inputs_reserved(tmp_path):
+    blockchain = Blockchain(TransactionPool())
+    blockchain.p2p_application = Application()
+    wallet = Wallet(os.path.join(str(tmp_path), 'node.pem'))
+    wallet.track(blockchain)
+    for _ in range(3):
+        blockchain.generate_next_block(wallet)
+    wallet.consolidation_threshold = 2
+
+    block_data = blockchain.next_block_data(wallet)
+
+    consolidation_tx = block_data[-1]
+    assert blockchain.tx_pool.transactions == [consolidation_tx]
+    swept = {(tx_in.tx_out_id, tx_in.tx_out_index) for tx_in in consolidation_tx.tx_ins}
+    spendable = wallet.spendable_unspent_tx_outs(blockchain.my_unspent_tx_outs(wallet), blockchain.tx_pool)
+    assert swept.isdisjoint((uTxO.tx_out_id, uTxO.tx_out_index) for uTxO in spendable)
+    assert blockchain.next_block_data(wallet)[1:] == [consolidation_tx]
+    assert blockchain.generate_next_block(wallet) is not None
+    assert blockchain.tx_pool.transactions == []
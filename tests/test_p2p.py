@@ -0,0 +1,170 @@
+# pyncoin/tests/test_p2p.py
+
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+from blockchain import Block, Blockchain
+from p2p import Engine, IChannel, Message
+from transaction import Transaction
+from transaction_pool import TransactionPool
+from wallet import Wallet
+
+class Channel(IChannel):
+    ''' A peer connection recording the messages sent to the peer. '''
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.sent = []
+        self.dropped = False
+
+    def send_message(self, message):
+        self.sent.append(message)
+
+    def relay(self, message):
+        pass
+
+    def broadcast(self, message):
+        pass
+
+    def drop(self):
+        self.dropped = True
+
+class Application:
+
+    def broadcast_latest(self, blockchain):
+        pass
+
+    def broadcast_transactions(self, transactions):
+        pass
+
+def new_node(tmp_path, name):
+    blockchain = Blockchain(TransactionPool())
+    blockchain.p2p_application = Application()
+    return (blockchain, Wallet(os.path.join(str(tmp_path), name + '.pem')))
+
+def send(engine, channel, message):
+    engine.handle_payload(channel, message.to_bin())
+
+def block_with_payment(tmp_path):
+    ''' Returns (Blockchain, Block): A blockchain and its latest block, which contains a signed
+    transaction, and the block is not connected to a new node yet. '''
+    (miner, wallet) = new_node(tmp_path, 'miner')
+    miner.generate_next_block(wallet)
+    miner.send_transaction(wallet, wallet.get_public_key(), 5)
+    miner.generate_next_block(wallet)
+    return (miner, miner.get_latest())
+
+def forge_signature(tx):
+    ''' Returns (dict): A transaction in raw format with the first byte of a signature flipped. '''
+    forged = json.loads(tx.to_json())
+    signature = forged['txIns'][0]['signature']
+    forged['txIns'][0]['signature'] = '{:02x}'.format(int(signature[:2], 16) ^ 0xff) + signature[2:]
+    return forged
+
+def test_forged_signatures_do_not_reject_the_real_block(tmp_path):
+    (miner, block) = block_with_payment(tmp_path)
+    (victim, _) = new_node(tmp_path, 'victim')
+    victim.add_block(miner.blocks[1])
+    engine = Engine(victim)
+    (honest, evil) = (Channel('honest'), Channel('evil'))
+    forged = json.loads(block.to_json())
+    forged['data'][1] = forge_signature(block.data[1])
+    assert Block.from_raw(forged).calculate_hash_for_block() == block.hash
+
+    send(engine, evil, Message(Message.RESPONSE_BLOCKCHAIN, [forged]))
+    assert victim.get_latest().index == 1
+    send(engine, honest, Message(Message.RESPONSE_BLOCKCHAIN, [block.to_raw()]))
+
+    assert victim.get_latest().hash == block.hash
+    assert engine.misbehavior_score(honest) == 0
+
+def test_forged_missing_transactions_do_not_reject_the_real_block(tmp_path):
+    (miner, block) = block_with_payment(tmp_path)
+    (victim, _) = new_node(tmp_path, 'victim')
+    victim.add_block(miner.blocks[1])
+    engine = Engine(victim)
+    (honest, evil) = (Channel('honest'), Channel('evil'))
+    announcement = Message.compact_latest_message(miner, None)
+
+    send(engine, evil, announcement)
+    assert evil.sent[-1].message_type == Message.QUERY_BLOCK_TRANSACTIONS
+    forged_tx = forge_signature(block.data[1])
+    send(engine, evil, Message(Message.RESPONSE_BLOCK_TRANSACTIONS, 
+                               {'hash': block.hash.hex(), 'transactions': [forged_tx]}))
+    assert victim.get_latest().index == 1
+
+    send(engine, honest, announcement)
+    send(engine, honest, Message.response_block_transactions_message(block.hash, block.data[1:]))
+
+    assert victim.get_latest().hash == block.hash
+    assert engine.misbehavior_score(honest) == 0
+
+def test_blocks_from_the_future_are_skipped_without_penalty(tmp_path):
+    (node, wallet) = new_node(tmp_path, 'node')
+    timestamp = datetime.now(tz=timezone.utc) + timedelta(hours=1)
+    block = Block.find(1, node.get_latest().hash, timestamp, [Transaction.coinbase(wallet.get_public_key(), 1)], 0)
+    engine = Engine(node)
+    channel = Channel('peer')
+
+    for _ in range(2):
+        send(engine, channel, Message(Message.RESPONSE_BLOCKCHAIN, [block.to_raw()]))
+
+    assert node.get_latest().index == 0
+    assert engine.misbehavior_score(channel) == 0
+    assert len(engine.rejected_blocks) == 1
+
+def pruning_node(tmp_path, name, blocks):
+    ''' Returns (Blockchain, Wallet): A node keeping the transactions of its last 3 blocks, which
+    connected the given blocks. '''
+    (node, wallet) = new_node(tmp_path, name)
+    node.prune_blocks = 3
+    for block in blocks:
+        assert node.add_block(block)
+    return (node, wallet)
+
+def test_pruned_node_catches_up_from_the_blocks_kept_by_a_pruned_peer(tmp_path):
+    (miner, wallet) = new_node(tmp_path, 'miner')
+    for _ in range(8):
+        miner.generate_next_block(wallet)
+    (node, _) = pruning_node(tmp_path, 'node', miner.blocks[1:])
+    assert node.pruned_height == 5
+    for _ in range(28):
+        miner.generate_next_block(wallet)
+    engine = Engine(node)
+
+    send(engine, Channel('peer'), Message(Message.RESPONSE_BLOCKCHAIN, Block.to_raw_list(miner.blocks[7:])))
+
+    assert node.get_latest().hash == miner.get_latest().hash
+
+def test_pruned_node_switches_to_a_fork_of_its_kept_blocks(tmp_path):
+    (miner, wallet) = new_node(tmp_path, 'miner')
+    for _ in range(6):
+        miner.generate_next_block(wallet)
+    (node, node_wallet) = pruning_node(tmp_path, 'node', miner.blocks[1:])
+    node.generate_next_block(node_wallet)
+    node.generate_next_block(node_wallet)
+    for _ in range(3):
+        miner.generate_next_block(wallet)
+    engine = Engine(node)
+
+    send(engine, Channel('peer'), Message(Message.RESPONSE_BLOCKCHAIN, Block.to_raw_list(miner.blocks[7:])))
+
+    assert node.get_latest().hash == miner.get_latest().hash
+    assert sorted(node.unspent_by_outpoint) == sorted(miner.unspent_by_outpoint)
+
+def test_pruned_node_refuses_a_fork_below_its_pruned_height(tmp_path):
+    (miner, wallet) = new_node(tmp_path, 'miner')
+    for _ in range(3):
+        miner.generate_next_block(wallet)
+    (node, node_wallet) = pruning_node(tmp_path, 'node', miner.blocks[1:])
+    for _ in range(5):
+        node.generate_next_block(node_wallet)
+    for _ in range(8):
+        miner.generate_next_block(wallet)
+    latest = node.get_latest()
+    engine = Engine(node)
+
+    send(engine, Channel('peer'), Message(Message.RESPONSE_BLOCKCHAIN, Block.to_raw_list(miner.blocks[4:])))
+
+    assert node.get_latest() is latest
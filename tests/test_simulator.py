@@ -0,0 +1,10 @@
+# pyncoin/tests/test_simulator.py
+
+from simulator import Scenario
+
+def test_network_converges_after_forks_deeper_than_one_block():
+    # the ancestors of these forks were once dropped as not longer than the chain of the node
+    report = Scenario(nodes=8, degree=3, duration=300, seed=1, tx_rate=0.2).run()
+
+    assert report['converged']
+    assert report['height'] > 1
@@ -0,0 +1,34 @@
+# pyncoin/tests/test_tracing.py
+
+import itertools
+import os
+
+import tracing
+from blockchain import Blockchain
+from tracing import BlockTracer
+from transaction_pool import TransactionPool
+from wallet import Wallet
+
+class Application:
+
+    def broadcast_latest(self, blockchain):
+        pass
+
+    def broadcast_transactions(self, transactions):
+        pass
+
+def test_mined_block_originates_when_its_proof_of_work_is_found(tmp_path, monkeypatch):
+    blockchain = Blockchain(TransactionPool())
+    blockchain.p2p_application = Application()
+    wallet = Wallet(os.path.join(str(tmp_path), 'node.pem'))
+    tracer = BlockTracer()
+    tracer.track(blockchain)
+    clock = itertools.count(1000)
+    monkeypatch.setattr(tracing.time, 'time', lambda: next(clock))
+
+    block = blockchain.generate_next_block(wallet)
+
+    trace = tracer.get_trace(block.hash.hex())
+    assert (trace['origin'], trace['hops']) == (1000, 0)
+    assert trace['origin'] < trace['validated'] < trace['connected']
+    assert tracer.outgoing_trace(block) == {'origin': 1000, 'hops': 0}
@@ -0,0 +1,114 @@
+# pyncoin/tests/test_webserver.py
+
+import json
+import os
+from io import BytesIO
+
+import pytest
+from twisted.internet.address import IPv4Address
+from twisted.web.test.requesthelper import DummyRequest
+
+from blockchain import Blockchain
+from transaction_pool import TransactionPool
+from wallet import Wallet
+from web_resource import ReactorResource
+from webserver import app
+
+class Application:
+
+    def broadcast_latest(self, blockchain):
+        pass
+
+    def broadcast_transactions(self, transactions):
+        pass
+
+@pytest.fixture
+def node(tmp_path):
+    blockchain = Blockchain(TransactionPool())
+    blockchain.p2p_application = Application()
+    wallet = Wallet(os.path.join(str(tmp_path), 'node.pem'))
+    wallet.track(blockchain)
+    (app.blockchain, app.wallet) = (blockchain, wallet)
+    yield (blockchain, wallet)
+    (app.blockchain, app.wallet) = (None, None)
+
+def call(method, path, params=None):
+    ''' Returns ((int, any)): The status code and the decoded json body of the response of the
+    node to a request, answered without running the reactor. '''
+    request = DummyRequest([path.encode('utf-8')])
+    request.method = method
+    request.uri = path.encode('utf-8')
+    request.content = BytesIO()
+    request.client = IPv4Address('TCP', '127.0.0.1', 12345)
+    # read by ReactorResource like on a twisted.web.server.Request
+    request._disconnected = False
+    if params is not None:
+        request.requestHeaders.setRawHeaders(b'Content-Type', [b'application/json'])
+        request.content.write(json.dumps(params).encode('utf-8'))
+    result = ReactorResource(app).render(request)
+    if isinstance(result, bytes):
+        request.write(result)
+        request.finish()
+    assert request.finished
+    return (request.responseCode or 200, json.loads(b''.join(request.written).decode('utf-8')))
+
+def test_submit_transaction(node, tmp_path):
+    (blockchain, wallet) = node
+    blockchain.generate_next_block(wallet)
+    receiver = Wallet(os.path.join(str(tmp_path), 'receiver.pem'))
+    tx = wallet.create_transaction(receiver.get_public_key(), 10, blockchain.unspent_tx_outs, blockchain.tx_pool)
+
+    (status, body) = call(b'POST', '/submitTransaction', {'transaction': json.loads(tx.to_json())})
+
+    assert status == 200
+    assert body == {'accepted': [tx.id.hex()], 'rejected': []}
+    assert blockchain.tx_pool.transactions == [tx]
+
+def test_submit_transaction_rejects_unknown_outputs(node, tmp_path):
+    (blockchain, wallet) = node
+    blockchain.generate_next_block(wallet)
+    tx = wallet.create_transaction(wallet.get_public_key(), 10, blockchain.unspent_tx_outs, blockchain.tx_pool)
+    raw_tx = json.loads(tx.to_json())
+    raw_tx['txIns'][0]['txOutIndex'] = 7
+
+    (status, body) = call(b'POST', '/submitTransaction', {'transactions': [raw_tx]})
+
+    assert status == 200
+    assert body['accepted'] == []
+    assert len(body['rejected']) == 1
+
+def test_send_payment(node, tmp_path):
+    (blockchain, wallet) = node
+    blockchain.generate_next_block(wallet)
+    receivers = [Wallet(os.path.join(str(tmp_path), 'receiver{}.pem'.format(i))).get_public_key() for i in range(2)]
+
+    (status, body) = call(b'POST', '/sendPayment', {'payments': [{'address': receivers[0].hex(), 'amount': 5},
+                                                                 {'address': receivers[1].hex(), 'amount': 7}]})
+
+    assert status == 200
+    assert body['id'] == blockchain.tx_pool.transactions[0].id.hex()
+    assert [(tx_out['address'], tx_out['amount']) for tx_out in body['txOuts'][:2]] == [
+        (receivers[0].hex(), 5), (receivers[1].hex(), 7)]
+
+def test_consolidate(node):
+    (blockchain, wallet) = node
+    for _ in range(3):
+        blockchain.generate_next_block(wallet)
+
+    (status, body) = call(b'POST', '/consolidate', {})
+
+    assert status == 200
+    assert len(body['txIns']) == 3
+    assert blockchain.tx_pool.transactions[0].id.hex() == body['id']
+
+def test_loadtest_endpoints(node, tmp_path):
+    (blockchain, wallet) = node
+    blockchain.generate_next_block(wallet)
+    receiver = Wallet(os.path.join(str(tmp_path), 'receiver.pem'))
+
+    assert call(b'GET', '/address') == (200, {'address': wallet.get_public_key().hex()})
+    (status, body) = call(b'POST', '/sendTransaction', {'address': receiver.get_public_key().hex(), 'amount': 10})
+    assert status == 200
+    assert body['id'] == blockchain.tx_pool.transactions[0].id.hex()
+    coinbase_tx = blockchain.get_latest().data[0]
+    assert call(b'GET', '/transaction/' + coinbase_tx.id.hex()) == (200, json.loads(coinbase_tx.to_json()))
@@ -0,0 +1,203 @@
+# pyncoin/tracing.py
+
+''' Implements the tracing of the propagation of the blocks through the network.
+
+The node that mines a block announces it with a trace, its origin time (the time at which the
+proof of work was found) and a hop count of 0, and every node relaying it forwards the trace with its own hop count, the number of hops from
+the origin. Each node records the time at which it received the message announcing a block,
+decoded it, validated the block and connected it, and derives the duration of each stage:
+
+    - `network`: from the origin time to the reception of the message. The clocks of the nodes
+        must be synchronized, for example with NTP, for this duration to be meaningful.
+    - `decode`: the parsing of the message.
+    - `validate`: the rest of the message handling up to the validation of the block, including
+        the rebuilding of compact blocks and the deserialization of the transactions.
+    - `connect`: the connection of the block to the blockchain and the updates of the indexes.
+    - `total`: from the origin time to the connection of the block.
+
+The durations of all the traced blocks are counted in histograms with fixed buckets.
+'''
+
+import collections
+import math
+import time
+
+from blockchain import IBlockchainListener
+from p2p import Message
+from utils import NotFoundError, hex_to_bytes, percentile
+
+class BlockTrace:
+    ''' The timestamps of the propagation of a block to this node, in seconds since the epoch. '''
+
+    def __init__(self, block_hash, index):
+        self.block_hash = block_hash
+        self.index = index
+        self.peer = None
+        self.origin = None
+        self.hops = None
+        self.received = None
+        self.decoded = None
+        self.validated = None
+        self.connected = None
+
+    def durations(self):
+        ''' Returns (dict<str, float>): The duration of each stage in seconds, None if unknown. '''
+        stages = (('network', self.origin, self.received), ('decode', self.received, self.decoded),
+                  ('validate', self.decoded, self.validated), ('connect', self.validated, self.connected),
+                  ('total', self.origin, self.connected))
+        return {stage: end - start if start is not None and end is not None else None
+                for (stage, start, end) in stages}
+
+    def to_raw(self):
+        return {
+            'hash': self.block_hash.hex(),
+            'index': self.index,
+            'peer': self.peer,
+            'origin': self.origin,
+            'hops': self.hops,
+            'received': self.received,
+            'decoded': self.decoded,
+            'validated': self.validated,
+            'connected': self.connected,
+            'durations': self.durations()
+        }
+
+class BlockTracer(IBlockchainListener):
+    ''' Records the traces of the last `MAX_TRACES` blocks connected to the blockchain, and the
+    histograms of the durations of all of them. '''
+
+    MAX_TRACES = 1000
+    BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+    STAGES = ('network', 'decode', 'validate', 'connect', 'total')
+
+    def __init__(self):
+        self.traces = collections.OrderedDict()
+        self.histograms = {stage: [0] * (len(BlockTracer.BUCKETS_MS) + 1) for stage in BlockTracer.STAGES}
+        self.context = None
+        # (hash, time) of the last block mined by this node
+        self.mined = None
+
+    def track(self, blockchain):
+        blockchain.add_listener(self)
+
+    # called by p2p.Engine
+
+    def message_received(self, channel, message, received, decoded):
+        ''' Remembers the timestamps of a message announcing blocks while it is handled. '''
+        if message.message_type == Message.COMPACT_BLOCK and isinstance(message.data, dict):
+            raw_hashes = [message.data.get('hash')]
+        elif message.message_type == Message.RESPONSE_BLOCKCHAIN and isinstance(message.data, list):
+            raw_hashes = [raw_block.get('hash') for raw_block in message.data if isinstance(raw_block, dict)]
+        else:
+            return
+        self.context = {
+            'peer': channel.peer,
+            'trace': message.trace,
+            'received': received,
+            'decoded': decoded,
+            'hashes': set(raw_hashes)
+        }
+
+    def message_handled(self):
+        self.context = None
+
+    def message_resumed(self, context):
+        ''' Restores the context of a message whose blocks are connected while handling a later
+        message, like a compact block rebuilt with the transactions received from the peer.
+        Params:
+            - context (dict): The value of `context` while the first message was handled.
+        '''
+        if context is not None:
+            self.context = context
+
+    def outgoing_trace(self, block):
+        ''' Returns (dict): The trace of the announcement of a block to the peers, or None if the
+        block was received without a trace. '''
+        trace = self.traces.get(block.hash)
+        if trace is None or trace.origin is None:
+            return None
+        return {'origin': trace.origin, 'hops': trace.hops}
+
+    # IBlockchainListener impl
+
+    def block_mined(self, blockchain, block):
+        # the proof of work of the block was just found
+        self.mined = (block.hash, time.time())
+
+    def block_validated(self, blockchain, block):
+        trace = BlockTrace(block.hash, block.index)
+        trace.validated = time.time()
+        context = self.context
+        if self.mined is not None and block.hash == self.mined[0]:
+            # this node is the origin of the blocks it mined
+            trace.origin = self.mined[1]
+            trace.hops = 0
+        elif context is not None:
+            trace.peer = context['peer']
+            if block.hash.hex() in context['hashes']:
+                trace.received = context['received']
+                trace.decoded = context['decoded']
+                (trace.origin, trace.hops) = BlockTracer.parse_trace(context['trace'])
+        self.traces[block.hash] = trace
+        self.traces.move_to_end(block.hash)
+        if len(self.traces) > BlockTracer.MAX_TRACES:
+            self.traces.popitem(last=False)
+
+    @staticmethod
+    def parse_trace(message_trace):
+        ''' Returns ((float, int)): The origin time of a received trace and the number of hops
+        from the origin to this node, (None, None) if the trace is missing or invalid. '''
+        if not isinstance(message_trace, dict) or not isinstance(message_trace.get('hops'), int):
+            return (None, None)
+        try:
+            origin = float(message_trace.get('origin'))
+        except (TypeError, ValueError):
+            return (None, None)
+        if not math.isfinite(origin) or message_trace['hops'] < 0:
+            return (None, None)
+        return (origin, message_trace['hops'] + 1)
+
+    def block_added(self, blockchain, block):
+        trace = self.traces.get(block.hash)
+        if trace is None or trace.connected is not None:
+            return
+        trace.connected = time.time()
+        for stage, duration in trace.durations().items():
+            if duration is not None:
+                self.histograms[stage][BlockTracer.bucket(duration)] += 1
+
+    @staticmethod
+    def bucket(duration):
+        milliseconds = duration * 1000
+        return next((i for i, bound in enumerate(BlockTracer.BUCKETS_MS) if milliseconds < bound),
+                    len(BlockTracer.BUCKETS_MS))
+
+    # queries
+
+    def get_trace(self, raw_hash):
+        trace = self.traces.get(hex_to_bytes(raw_hash))
+        if trace is None:
+            raise NotFoundError('block not traced', {'hash': raw_hash})
+        return trace.to_raw()
+
+    def get_histograms(self):
+        ''' Returns (dict): The histograms of the durations of each stage in milliseconds, with
+        the percentiles of the last traced blocks. Bucket `i` counts the durations lower than
+        `bucketsMs[i]`, the last bucket the longer ones. '''
+        durations = {stage: [] for stage in BlockTracer.STAGES}
+        for trace in self.traces.values():
+            if trace.connected is None:
+                continue
+            for stage, duration in trace.durations().items():
+                if duration is not None:
+                    durations[stage].append(duration * 1000)
+        return {
+            'bucketsMs': list(BlockTracer.BUCKETS_MS),
+            'stages': {stage: {
+                'counts': counts,
+                'count': sum(counts),
+                'p50': percentile(durations[stage], 0.5),
+                'p90': percentile(durations[stage], 0.9),
+                'p99': percentile(durations[stage], 0.99)
+            } for stage, counts in self.histograms.items()}
+        }
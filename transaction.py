@@ -100,24 +100,53 @@ class TxIn(RawSerializable):
             and isinstance(self.tx_out_index, int)
         )
 
-    def validate(self, transaction, unspent_tx_outs):
-        condition = lambda uTxO: uTxO.tx_out_id == self.tx_out_id and uTxO.tx_out_index == self.tx_out_index
-        referenced_uTxO = next((uTxO for uTxO in unspent_tx_outs if condition(uTxO)), None)
+    def validate(self, transaction, unspent_tx_outs, verify_signature=True):
+        ''' Validates this transaction input.
+        Params:
+            - transaction (Transaction): The transaction containing this input.
+            - unspent_tx_outs (list<UnspentTxOut> or dict): The unspent transaction outputs,
+                see `UnspentTxOut.find`.
+            - verify_signature (bool): If False, only the existence of the referenced output is
+                checked. Use it only if the signature has already been verified.
+        '''
+        referenced_uTxO = UnspentTxOut.find(self.tx_out_id, self.tx_out_index, unspent_tx_outs)
         if not referenced_uTxO:
             print('referenced tx_out not found: {}'.format(self.__dict__))
             return False
-        address = referenced_uTxO.address
+        if not verify_signature:
+            return True
+        return TxIn.verify_signature(referenced_uTxO.address, self.signature, transaction.id)
+
+    @staticmethod
+    def verify_signature(address, signature, data):
+        ''' Verifies an ECDSA signature.
+        Params:
+            - address (bytes): The public key of the signer.
+            - signature (bytes): The signature.
+            - data (bytes): The signed data, the id of the transaction.
+        Returns (bool): True if the signature is valid.
+        '''
         vk = ecdsa.VerifyingKey.from_string(address)
         result = False
         print('validating tx_in signature: {}\naddress: {}\ndata: {}'
-            .format(bytes_to_hex(self.signature), bytes_to_hex(address), bytes_to_hex(transaction.id)))
+            .format(bytes_to_hex(signature), bytes_to_hex(address), bytes_to_hex(data)))
         try:
-            if self.signature:
-                result = vk.verify(self.signature, transaction.id)
+            if signature:
+                result = vk.verify(signature, data)
         except ecdsa.BadSignatureError:
-            print('bad signature for tx_in: {}'.format(self))
+            print('bad signature: {}'.format(bytes_to_hex(signature)))
             pass
         return result
+
+    @staticmethod
+    def verify_signatures(signature_checks):
+        ''' Verifies a batch of signatures. Suitable to be run in a worker process.
+        Params:
+            - signature_checks (list<(bytes, bytes, bytes)>): The (address, signature, data) 
+                triples to be verified.
+        Returns (list<bool>): The result of `verify_signature` for each triple.
+        '''
+        return [TxIn.verify_signature(*check) for check in signature_checks]
     
     def get_amount(self, unspent_tx_outs):
         return UnspentTxOut.find(self.tx_out_id, self.tx_out_index, unspent_tx_outs).amount
@@ -155,6 +184,16 @@ class UnspentTxOut(RawSerializable):
 
     @staticmethod
     def find(transaction_id, index, unspent_tx_outs):
+        ''' Finds an unspent transaction output.
+        Params:
+            - transaction_id (bytes): The id of the transaction of the output.
+            - index (int): The index of the output in the transaction.
+            - unspent_tx_outs (list<UnspentTxOut> or dict): The unspent transaction outputs
+                to search in, or a dict of them keyed by (tx_out_id, tx_out_index).
+        Returns (UnspentTxOut): The unspent output or None if it was not found.
+        '''
+        if isinstance(unspent_tx_outs, dict):
+            return unspent_tx_outs.get((transaction_id, index))
         condition = lambda uTxO: uTxO.tx_out_id == transaction_id and uTxO.tx_out_index == index
         return next((uTxO for uTxO in unspent_tx_outs if condition(uTxO)), None)
 
@@ -262,11 +301,27 @@ class Transaction(RawSerializable):
             and all([tx_out.has_valid_structure() for tx_out in self.tx_outs])
         )
 
-    def validate(self, unspent_tx_outs):
+    def signature_checks(self, unspent_tx_outs):
+        ''' Collects the signatures to be verified for this transaction.
+
+        Returns (list<(bytes, bytes, bytes)>): The (address, signature, data) triple of each input
+            to be passed to `TxIn.verify_signatures`, or None if some of the referenced outputs 
+            are not found.
+        '''
+        checks = []
+        for tx_in in self.tx_ins:
+            referenced_uTxO = UnspentTxOut.find(tx_in.tx_out_id, tx_in.tx_out_index, unspent_tx_outs)
+            if not referenced_uTxO:
+                print('referenced tx_out not found: {}'.format(tx_in.__dict__))
+                return None
+            checks.append((referenced_uTxO.address, tx_in.signature, self.id))
+        return checks
+
+    def validate(self, unspent_tx_outs, verify_signatures=True):
         if self.id != self.get_id():
             print('invalid tx id: {}'.format(self))
             return False
-        has_valid_tx_ins = all([tx_in.validate(self, unspent_tx_outs) for tx_in in self.tx_ins])
+        has_valid_tx_ins = all([tx_in.validate(self, unspent_tx_outs, verify_signatures) for tx_in in self.tx_ins])
         if not has_valid_tx_ins:
             print('some of tx_ins are invalid in tx: {}'.format(self))
             return False
@@ -296,7 +351,18 @@ class Transaction(RawSerializable):
         return True
 
     @staticmethod
-    def validate_block_transactions(transactions, unspent_tx_outs, block_index):
+    def validate_block_transactions(transactions, unspent_tx_outs, block_index, verified_tx_ids=None,
+                                    verify_signatures=True):
+        ''' Validates the transactions of a block.
+        Params:
+            - transactions (list<Transaction>): The transactions of the block.
+            - unspent_tx_outs (list<UnspentTxOut> or dict): The unspent outputs before the block.
+            - block_index (int): The height of the block.
+            - verified_tx_ids (set<bytes>): The ids of the transactions whose signatures were already
+                verified, for example the ones taken from the transaction pool.
+            - verify_signatures (bool): False to skip the verification of all the signatures, for
+                blocks assumed to be valid.
+        '''
         if len(transactions) == 0:
             return True
         coinbase_tx = transactions[0]
@@ -307,14 +373,18 @@ class Transaction(RawSerializable):
         if TxIn.has_duplicates(tx_ins):
             return False
         normal_transactions = transactions[1:]
-        return all([tx.validate(unspent_tx_outs) for tx in normal_transactions])
+        verified_tx_ids = verified_tx_ids or set()
+        return all([tx.validate(unspent_tx_outs, verify_signatures and tx.id not in verified_tx_ids) 
+                    for tx in normal_transactions])
 
     @staticmethod
-    def process_transactions(transactions, unspent_tx_outs, block_index):
+    def process_transactions(transactions, unspent_tx_outs, block_index, verified_tx_ids=None, 
+                             verify_signatures=True):
         if not all([tx.has_valid_structure() for tx in transactions]):
             print('some of the transactions has invalid structure')
             return None
-        if not Transaction.validate_block_transactions(transactions, unspent_tx_outs, block_index):
+        if not Transaction.validate_block_transactions(transactions, unspent_tx_outs, block_index, 
+                                                       verified_tx_ids, verify_signatures):
             print('invalid block transactions')
             return None
         return UnspentTxOut.update_unspent_tx_outs(transactions, unspent_tx_outs)
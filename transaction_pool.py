@@ -5,16 +5,66 @@ from utils import RawSerializable, BadRequestError
 
 class TransactionPool(RawSerializable):
 
+    # Reasons returned by `rejection_reason`:
+    REJECTED_DUPLICATE = 'transaction is already in the pool'
+    REJECTED_CONFLICT = 'transaction conflicts with a transaction of the pool'
+    REJECTED_MISSING_INPUTS = 'referenced tx_out not found'
+    REJECTED_INVALID = 'invalid transaction'
+
     def __init__(self):
         self.transactions = []
+        self.spent_outpoints = set()
+        self.listeners = []
 
-    def add_transaction(self, transaction, unspent_tx_outs):
-        if not transaction.validate(unspent_tx_outs) or not self.is_valid_transaction(transaction):
+    def add_transaction(self, transaction, unspent_tx_outs, verify_signatures=True):
+        if (not self.is_valid_transaction(transaction) 
+                or not transaction.validate(unspent_tx_outs, verify_signatures)):
             return False
         print('adding to tx_pool: {}'.format(transaction))
         self.transactions.append(transaction)
+        self.spent_outpoints.update(TransactionPool.outpoints(transaction))
+        for listener in self.listeners:
+            listener.transactions_added([transaction])
         return True
 
+    def add_transactions(self, transactions, unspent_tx_outs):
+        ''' Validates and adds a batch of transactions to the pool.
+
+        The transactions are checked against each other as well: a transaction spending
+        an output already spent by an earlier transaction of the batch is rejected.
+
+        Params:
+            - transactions (list<Transaction>): The transactions to be added.
+            - unspent_tx_outs (list<UnspentTxOut> or dict): The unspent transaction outputs
+                of the blockchain, see `UnspentTxOut.find`.
+
+        Returns (list<Transaction>): The transactions that were added to the pool.
+        '''
+        accepted = [tx for tx in transactions if self.add_transaction(tx, unspent_tx_outs)]
+        if len(accepted) != len(transactions):
+            print('{} of {} transactions were rejected'.format(len(transactions) - len(accepted), len(transactions)))
+        return accepted
+
+    def rejection_reason(self, transaction, unspent_tx_outs):
+        ''' Tells why `add_transaction` rejected a transaction.
+
+        Returns (str): One of the `REJECTED_*` constants. Only `REJECTED_INVALID` means that the
+            transaction can never become valid.
+        '''
+        if not transaction.has_valid_structure():
+            return TransactionPool.REJECTED_INVALID
+        if any(tx.id == transaction.id for tx in self.transactions):
+            return TransactionPool.REJECTED_DUPLICATE
+        if not self.is_valid_transaction(transaction):
+            return TransactionPool.REJECTED_CONFLICT
+        if transaction.signature_checks(unspent_tx_outs) is None:
+            return TransactionPool.REJECTED_MISSING_INPUTS
+        return TransactionPool.REJECTED_INVALID
+
+    @staticmethod
+    def outpoints(transaction):
+        return [(tx_in.tx_out_id, tx_in.tx_out_index) for tx_in in transaction.tx_ins]
+
     def ins(self):
         ''' Returns the transaction inputs in this pool. '''
         return [tx_in for tx in self.transactions for tx_in in tx.tx_ins]
@@ -24,36 +74,33 @@ class TransactionPool(RawSerializable):
         return next((uTxO for uTxO in unspent_tx_outs if uTxO.matches_tx_in(tx_in)), None) is not None
 
     def is_valid_transaction(self, transaction):
-        pool_ins = self.ins()
-        for tx_in in transaction.tx_ins:
-            if tx_in in pool_ins:
+        for outpoint in TransactionPool.outpoints(transaction):
+            if outpoint in self.spent_outpoints:
                 print('tx_in already found in the tx_pool')
                 return False
         return True
 
     def update(self, unspent_tx_outs):
+        outpoints = {(uTxO.tx_out_id, uTxO.tx_out_index) for uTxO in unspent_tx_outs}
         invalid_txs = []
         for tx in self.transactions:
-            for tx_in in tx.tx_ins:
-                if not TransactionPool.has_tx_in(tx_in, unspent_tx_outs):
+            for outpoint in TransactionPool.outpoints(tx):
+                if outpoint not in outpoints:
                     invalid_txs.append(tx)
                     break
         if invalid_txs:
             print('removing the following transactions from tx_pool: {}'.format(invalid_txs))
             self.transactions = [tx for tx in self.transactions if tx not in invalid_txs]
+            self.spent_outpoints = {outpoint for tx in self.transactions for outpoint in TransactionPool.outpoints(tx)}
+            for listener in self.listeners:
+                listener.transactions_removed(invalid_txs)
 
     def to_raw(self):
         return Transaction.to_raw_list(self.transactions)
 
     def filtered_unspent_tx_outs(self, unspent_tx_outs):
-        tx_ins = [tx_in for tx in self.transactions for tx_in in tx.tx_ins]
-        removable = []
-        for unspent_tx_out in unspent_tx_outs:
-            tx_in = next((tx_in for tx_in in tx_ins if unspent_tx_out.matches_tx_in(tx_in)), None)
-            if tx_in is not None:
-                removable.append(unspent_tx_out)
-        remaining = [uTxO for uTxO in unspent_tx_outs if uTxO not in removable]
-        return remaining
+        return [uTxO for uTxO in unspent_tx_outs 
+                if (uTxO.tx_out_id, uTxO.tx_out_index) not in self.spent_outpoints]
 
     @classmethod
     def from_raw(cls, raw_obj):
@@ -1,7 +1,10 @@
 # pyncoin/utils.py
 
 import binascii
+import collections
 import decimal
+import math
+import time
 import traceback
 
 try:
@@ -237,10 +240,121 @@ class NotFoundError(HttpError):
     def __init__(self, message, payload=None):
         HttpError.__init__(self, message, NotFoundError.status_code, payload)
 
+class ConflictError(HttpError):
+    status_code = 409
+    def __init__(self, message, payload=None):
+        HttpError.__init__(self, message, ConflictError.status_code, payload)
+
+class PrunedError(HttpError):
+    status_code = 410
+    def __init__(self, message, payload=None):
+        HttpError.__init__(self, message, PrunedError.status_code, payload)
+
+class RecentlySeen:
+    ''' A bounded set remembering the most recently added keys. When the set is full, adding a 
+    new key evicts the least recently added or refreshed one. '''
+
+    def __init__(self, max_size):
+        ''' Initializes the set.
+        Params:
+            - max_size (int): The maximum number of keys remembered.
+        '''
+        self.max_size = max_size
+        self.keys = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        ''' Adds or refreshes a key.
+        Returns (bool): True if the key was not in the set.
+        '''
+        if key in self.keys:
+            self.keys.move_to_end(key)
+            return False
+        self.keys[key] = None
+        if len(self.keys) > self.max_size:
+            self.keys.popitem(last=False)
+        return True
+
+class ExpiringCache:
+    ''' A bounded mapping whose entries expire after a number of seconds. When the cache is full,
+    setting a new key evicts the oldest entry. '''
+
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        ''' Initializes the cache.
+        Params:
+            - max_size (int): The maximum number of entries.
+            - ttl (float): The default number of seconds after which an entry expires.
+            - clock (function): Returns the current time in seconds.
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        ''' Returns the value of a key, or None if the key is not in the cache or it expired. '''
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        (expires_at, value) = entry
+        if expires_at <= self.clock():
+            del self.entries[key]
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        ''' Sets the value of a key.
+        Params:
+            - key (hashable): The key.
+            - value (any): The value, must not be None.
+            - ttl (float): The number of seconds after which the entry expires, defaults to `ttl`
+                of the cache.
+        '''
+        self.entries.pop(key, None)
+        self.entries[key] = (self.clock() + (ttl if ttl is not None else self.ttl), value)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+def percentile(values, fraction):
+    ''' Returns the nearest-rank percentile of a list of numbers.
+        Params:
+            - values (list<float>): The numbers, in any order.
+            - fraction (float): The percentile as a fraction, e.g. 0.99 for the 99th percentile.
+        Returns (float): The percentile, or None if there are no values.
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
 def format_exception(ex):
     fmt = traceback.format_exception(ex.__class__, ex, ex.__traceback__)
     return ''.join(fmt)
 
+def parse_json(json_bin):
+    ''' Parses a json document, reading the floating point numbers as Decimals.
+        Params:
+            - json_bin (bytes or str): The json document
+        Returns (any): The parsed raw object
+    '''
+    if isinstance(json_bin, bytes):
+        json_bin = json_bin.decode('utf-8')
+    try:
+        return json.loads(json_bin, parse_float=decimal.Decimal)
+    except ValueError as e:
+        raise BadRequestError('invalid json', {'cause': str(e)})
+
 def get_param(params, param_name):
     MISSING_PARAM_PLACEHOLDER = '$$$missing_param$$$'
     data = params.get(param_name, MISSING_PARAM_PLACEHOLDER)
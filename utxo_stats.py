@@ -0,0 +1,232 @@
+# pyncoin/utxo_stats.py
+
+''' Implements the statistics of the unspent transaction outputs on a columnar copy of them.
+
+The unspent outputs are copied once to NumPy arrays (address ids, integer amounts and creation
+heights), which are then updated with the outputs spent and created by each connected block, and
+the statistics are computed on the arrays without iterating over the outputs in Python. NumPy is
+optional: without it the node runs, but the statistics are not available.
+'''
+
+from decimal import Decimal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from blockchain import IBlockchainListener
+from utils import BadRequestError, NotFoundError
+
+class UtxoColumns:
+    ''' The unspent transaction outputs in columnar format.
+
+    Amounts are stored as integers in units of `1 / AMOUNT_UNITS` coins, finer fractions are
+    rounded down. The creation height of an output is -1 if it is not known, for example
+    because the transactions of its block are pruned. The rows of the spent outputs are
+    marked with the address id -1 and dropped once they make up half of the rows.
+    '''
+
+    AMOUNT_UNITS = 10 ** 8
+
+    def __init__(self, height):
+        ''' Initializes empty columns.
+        Params:
+            - height (int): The index of the latest block included.
+        '''
+        self.addresses = []
+        self.address_index = {}
+        self.outpoints = []
+        self.rows = {}
+        self.address_ids = numpy.zeros(0, dtype=numpy.int32)
+        self.amounts = numpy.zeros(0, dtype=numpy.int64)
+        self.heights = numpy.zeros(0, dtype=numpy.int32)
+        self.spent_rows = 0
+        self.height = height
+
+    @classmethod
+    def from_blockchain(cls, blockchain):
+        def height_of(uTxO):
+            block_hash = blockchain.tx_block_hashes.get(uTxO.tx_out_id)
+            return blockchain.blocks_by_hash[block_hash].index if block_hash is not None else -1
+        columns = cls(blockchain.get_latest().index)
+        columns.add([(outpoint, uTxO.address, uTxO.amount, height_of(uTxO))
+                     for outputs in blockchain.unspent_by_address.values()
+                     for outpoint, uTxO in outputs.items()])
+        return columns
+
+    def add(self, outputs):
+        ''' Appends unspent outputs.
+        Params:
+            - outputs (list<((str, int), bytes, number, int)>): The outpoint, address, amount and
+                creation height of each output.
+        '''
+        address_ids = []
+        for (outpoint, address, _, _) in outputs:
+            address_id = self.address_index.get(address)
+            if address_id is None:
+                address_id = self.address_index[address] = len(self.addresses)
+                self.addresses.append(address)
+            self.rows[outpoint] = len(self.outpoints)
+            self.outpoints.append(outpoint)
+            address_ids.append(address_id)
+        amounts = [int(amount * UtxoColumns.AMOUNT_UNITS) for (_, _, amount, _) in outputs]
+        heights = [height for (_, _, _, height) in outputs]
+        self.address_ids = numpy.concatenate((self.address_ids, numpy.array(address_ids, dtype=numpy.int32)))
+        self.amounts = numpy.concatenate((self.amounts, numpy.array(amounts, dtype=numpy.int64)))
+        self.heights = numpy.concatenate((self.heights, numpy.array(heights, dtype=numpy.int32)))
+
+    def remove(self, outpoints):
+        ''' Marks the rows of spent outputs, the unknown outpoints are ignored. '''
+        rows = [self.rows.pop(outpoint) for outpoint in outpoints if outpoint in self.rows]
+        self.address_ids[rows] = -1
+        self.spent_rows += len(rows)
+        if self.spent_rows * 2 > len(self.outpoints):
+            self.compact()
+
+    def compact(self):
+        ''' Drops the rows of the spent outputs. '''
+        live = self.address_ids >= 0
+        self.outpoints = [outpoint for outpoint, is_live in zip(self.outpoints, live.tolist()) if is_live]
+        self.rows = {outpoint: row for row, outpoint in enumerate(self.outpoints)}
+        self.address_ids = self.address_ids[live]
+        self.amounts = self.amounts[live]
+        self.heights = self.heights[live]
+        self.spent_rows = 0
+
+    def connect_block(self, block):
+        ''' Spends the outputs consumed by the transactions of a block and adds the new ones. '''
+        spent = []
+        created = {}
+        for tx in block.data:
+            for tx_in in tx.tx_ins:
+                outpoint = (tx_in.tx_out_id, tx_in.tx_out_index)
+                if created.pop(outpoint, None) is None:
+                    spent.append(outpoint)
+            for index, tx_out in enumerate(tx.tx_outs):
+                created[(tx.id, index)] = ((tx.id, index), tx_out.address, tx_out.amount, block.index)
+        self.remove(spent)
+        self.add(list(created.values()))
+        self.height = block.index
+
+    def live_columns(self):
+        ''' Returns ((numpy.ndarray<int32>, numpy.ndarray<int64>, numpy.ndarray<int32>)): The
+        address ids, amounts and heights of the unspent outputs. '''
+        live = self.address_ids >= 0
+        return (self.address_ids[live], self.amounts[live], self.heights[live])
+
+    def balances(self):
+        ''' Returns ((numpy.ndarray<int64>, numpy.ndarray<int64>)): The ids of the addresses owning
+        unspent outputs and their balances. '''
+        (address_ids, amounts, _) = self.live_columns()
+        holders = numpy.flatnonzero(numpy.bincount(address_ids, minlength=len(self.addresses)))
+        balances = numpy.zeros(len(self.addresses), dtype=numpy.int64)
+        numpy.add.at(balances, address_ids, amounts)
+        return (holders, balances[holders])
+
+    @staticmethod
+    def to_coins(units):
+        return Decimal(int(units)) / UtxoColumns.AMOUNT_UNITS
+
+    def supply(self):
+        (_, amounts, _) = self.live_columns()
+        return {
+            'height': self.height,
+            'supply': UtxoColumns.to_coins(amounts.sum()),
+            'unspentTxOuts': len(amounts),
+            'addresses': len(self.balances()[0])
+        }
+
+    def rich_list(self, n):
+        ''' Returns (list<dict>): The `n` addresses with the highest balance, the richest first. '''
+        (holders, balances) = self.balances()
+        n = min(n, len(balances))
+        if n == 0:
+            return []
+        richest = numpy.argpartition(-balances, n - 1)[:n]
+        richest = richest[numpy.argsort(-balances[richest], kind='stable')]
+        total = max(int(balances.sum()), 1)
+        return [{
+            'address': self.addresses[holders[i]].hex(),
+            'balance': UtxoColumns.to_coins(balances[i]),
+            'share': int(balances[i]) / total
+        } for i in richest]
+
+    def distribution(self, by):
+        ''' Returns the number of addresses and the amount in ranges of balance, or the number of
+        outputs and the amount in ranges of age.
+        Params:
+            - by (str): `balance` for powers of ten of the balance of the addresses, `age` for
+                powers of two of the number of blocks since the outputs were created.
+        Returns (list<dict>): The non-empty ranges.
+        '''
+        if by == 'balance':
+            values = amounts = self.balances()[1]
+            edges = [0] + [10 ** exponent for exponent in range(19)]
+            to_raw = UtxoColumns.to_coins
+            label = 'addresses'
+        elif by == 'age':
+            (_, amounts, heights) = self.live_columns()
+            known = heights >= 0
+            values = self.height - heights[known].astype(numpy.int64)
+            amounts = amounts[known]
+            edges = [0] + [2 ** exponent for exponent in range(32)]
+            to_raw = int
+            label = 'unspentTxOuts'
+        else:
+            raise BadRequestError('invalid distribution', {'by': by, 'valid': ['balance', 'age']})
+        edges = numpy.array(edges, dtype=numpy.int64)
+        buckets = numpy.searchsorted(edges, values, side='right') - 1
+        counts = numpy.bincount(buckets, minlength=len(edges))
+        ranges = []
+        for bucket in numpy.flatnonzero(counts):
+            ranges.append({
+                'min': to_raw(edges[bucket]),
+                'max': to_raw(edges[bucket + 1]) if bucket + 1 < len(edges) else None,
+                label: int(counts[bucket]),
+                'amount': UtxoColumns.to_coins(amounts[buckets == bucket].sum())
+            })
+        return ranges
+
+class UtxoStats(IBlockchainListener):
+    ''' Keeps the columnar copy of the unspent outputs of the blockchain. It is built on the
+    first query and after the blockchain is replaced, and updated with each connected block. '''
+
+    MAX_RICH_LIST = 1000
+
+    def __init__(self):
+        self.blockchain = None
+        self.columns = None
+
+    def track(self, blockchain):
+        self.blockchain = blockchain
+        blockchain.add_listener(self)
+
+    def get_columns(self):
+        if numpy is None:
+            raise NotFoundError('the statistics require numpy, which is not installed')
+        if self.columns is None:
+            self.columns = UtxoColumns.from_blockchain(self.blockchain)
+        return self.columns
+
+    def supply(self):
+        return self.get_columns().supply()
+
+    def rich_list(self, n):
+        if not 1 <= n <= UtxoStats.MAX_RICH_LIST:
+            raise BadRequestError('invalid n', {'n': n, 'max': UtxoStats.MAX_RICH_LIST})
+        columns = self.get_columns()
+        return {'height': columns.height, 'addresses': columns.rich_list(n)}
+
+    def distribution(self, by):
+        columns = self.get_columns()
+        return {'height': columns.height, 'by': by, 'ranges': columns.distribution(by)}
+
+    # IBlockchainListener impl
+
+    def block_added(self, blockchain, block):
+        if self.columns is not None:
+            self.columns.connect_block(block)
+
+    def chain_replaced(self, blockchain):
+        self.columns = None
@@ -5,8 +5,55 @@ import os
 from decimal import Decimal
 
 import ecdsa
-from transaction import Transaction, TxIn, TxOut
-from utils import UnauthorizedError
+from blockchain import IBlockchainListener
+from coin_selection import LargestFirstSelector
+from transaction import Transaction, TxIn, TxOut, UnspentTxOut
+from utils import BadRequestError, UnauthorizedError
+
+class SpendableIndex(IBlockchainListener):
+    ''' Keeps track of the unspent outputs of an address that are not spent by the transactions
+    of the transaction pool, updating them from the events of the blockchain. '''
+
+    def __init__(self, address, blockchain):
+        ''' Initializes the index and registers it as a listener of the blockchain.
+        Params:
+            - address (bytes): The address whose outputs are tracked.
+            - blockchain (Blockchain): The blockchain.
+        '''
+        self.address = address
+        self.chain_replaced(blockchain)
+        blockchain.add_listener(self)
+
+    def spendable(self):
+        ''' Returns (list<transaction.UnspentTxOut>): The spendable outputs of the address. '''
+        return [uTxO for outpoint, uTxO in self.unspent.items() if outpoint not in self.reserved]
+
+    def block_added(self, blockchain, block):
+        for tx in block.data:
+            for tx_in in tx.tx_ins:
+                outpoint = (tx_in.tx_out_id, tx_in.tx_out_index)
+                self.unspent.pop(outpoint, None)
+                self.reserved.discard(outpoint)
+            for index, tx_out in enumerate(tx.tx_outs):
+                if tx_out.address == self.address:
+                    self.unspent[(tx.id, index)] = UnspentTxOut(tx.id, index, tx_out.address, tx_out.amount)
+
+    def chain_replaced(self, blockchain):
+        self.unspent = {(uTxO.tx_out_id, uTxO.tx_out_index): uTxO
+                        for uTxO in blockchain.unspent_tx_outs_for_address(self.address)}
+        self.reserved = {outpoint for outpoint in blockchain.tx_pool.spent_outpoints if outpoint in self.unspent}
+
+    def transactions_added(self, transactions):
+        for tx in transactions:
+            for tx_in in tx.tx_ins:
+                outpoint = (tx_in.tx_out_id, tx_in.tx_out_index)
+                if outpoint in self.unspent:
+                    self.reserved.add(outpoint)
+
+    def transactions_removed(self, transactions):
+        for tx in transactions:
+            for tx_in in tx.tx_ins:
+                self.reserved.discard((tx_in.tx_out_id, tx_in.tx_out_index))
 
 class Wallet:
 
@@ -35,6 +82,14 @@ class Wallet:
                 os.makedirs(dir_name)
             with open(private_key_location, 'wb') as pk_file:
                 pk_file.write(pk_bin)
+        self.coin_selector = LargestFirstSelector()
+        self.consolidation_threshold = None
+        self.spendable_index = None
+
+    def track(self, blockchain):
+        ''' Maintains an index of the spendable outputs of this wallet from the events of the
+        blockchain, so that creating transactions does not need to scan the unspent outputs. '''
+        self.spendable_index = SpendableIndex(self.get_public_key(), blockchain)
 
     def get_public_key(self):
         ''' Returns the public key of this wallet.
@@ -59,41 +114,125 @@ class Wallet:
         '''
         return sum([uTxO.amount for uTxO in unspent_tx_outs if uTxO.address == self.get_public_key()])
 
-    @staticmethod
-    def find_tx_outs_for_amount(amount, my_unspent_tx_outs):
-        amount = Decimal(amount)
-        current_amount = Decimal(0)
-        included_unspent_tx_outs = []
-        for my_unspent_tx_out in my_unspent_tx_outs:
-            included_unspent_tx_outs.append(my_unspent_tx_out)
-            current_amount += my_unspent_tx_out.amount
-            if current_amount > amount:
-                left_over_amount = current_amount - amount
-                return (included_unspent_tx_outs, left_over_amount)
-        raise UnauthorizedError('not enough coins to send transaction ' + 
-                                'or there are pending transactions from this address')
-
     def create_tx_outs(self, receiver_address, amount, left_over_amount):
-        amount = Decimal(amount)
-        tx_out_1 = TxOut(receiver_address, amount)
-        tx_outs = [tx_out_1]
+        return self.create_payment_tx_outs([(receiver_address, amount)], left_over_amount)
+
+    def create_payment_tx_outs(self, payments, left_over_amount):
+        ''' Creates an output for each payment and a change output for the left over amount. '''
+        tx_outs = [TxOut(receiver_address, Decimal(amount)) for receiver_address, amount in payments]
         if left_over_amount > 0:
             my_address = self.get_public_key()
             left_over_tx_out = TxOut(my_address, left_over_amount)
             tx_outs.append(left_over_tx_out)
         return tx_outs
 
-    def create_transaction(self, receiver_address, amount, unspent_tx_outs, tx_pool):
-        amount = Decimal(amount)
+    def spendable_unspent_tx_outs(self, unspent_tx_outs, tx_pool):
+        ''' Returns the unspent outputs of this wallet that are not spent by the transactions
+        of the pool. If the wallet tracks a blockchain, its index is used instead of the parameters. '''
+        if self.spendable_index is not None:
+            return self.spendable_index.spendable()
         my_address = self.get_public_key()
-        private_key = self.get_private_key()
         my_uTxOs = [uTxO for uTxO in unspent_tx_outs if uTxO.address == my_address]
-        filtered_my_uTxOs = tx_pool.filtered_unspent_tx_outs(my_uTxOs)
-        (included_uTxOs, left_over_amount) = Wallet.find_tx_outs_for_amount(amount, filtered_my_uTxOs)
+        return tx_pool.filtered_unspent_tx_outs(my_uTxOs)
+
+    def create_transaction(self, receiver_address, amount, unspent_tx_outs, tx_pool, coin_selector=None):
+        spendable_uTxOs = self.spendable_unspent_tx_outs(unspent_tx_outs, tx_pool)
+        return self.create_transaction_from(receiver_address, amount, spendable_uTxOs, coin_selector)
+
+    def create_transaction_from(self, receiver_address, amount, spendable_uTxOs, coin_selector=None):
+        return self.create_payment_from([(receiver_address, amount)], spendable_uTxOs, coin_selector)
+
+    def create_payment_transaction(self, payments, unspent_tx_outs, tx_pool, coin_selector=None):
+        ''' Creates and signs a single transaction paying all the payments. '''
+        spendable_uTxOs = self.spendable_unspent_tx_outs(unspent_tx_outs, tx_pool)
+        return self.create_payment_from(payments, spendable_uTxOs, coin_selector)
+
+    def create_payment_from(self, payments, spendable_uTxOs, coin_selector=None):
+        ''' Creates and signs a transaction with an output for each payment, spending some of
+        the given unspent outputs.
+
+        Params:
+            - payments (list<(bytes, Decimal)>): The receiver address and amount of each payment.
+            - spendable_uTxOs (list<transaction.UnspentTxOut>): The outputs of this wallet
+                that can be spent. The outputs included in the transaction are removed 
+                from this list.
+            - coin_selector (coin_selection.CoinSelector): The strategy selecting the outputs
+                to be spent. Defaults to the `coin_selector` of the wallet.
+
+        Returns (Transaction): The signed transaction.
+        '''
+        for _, amount in payments:
+            if not Decimal(amount).is_finite() or Decimal(amount) <= 0:
+                raise BadRequestError('invalid amount, it must be positive', {'amount': str(amount)})
+        amount = sum((Decimal(amount) for _, amount in payments), Decimal(0))
+        coin_selector = coin_selector or self.coin_selector
+        (included_uTxOs, left_over_amount) = coin_selector.select(amount, spendable_uTxOs)
+        tx_outs = self.create_payment_tx_outs(payments, left_over_amount)
+        return self.create_signed_transaction(included_uTxOs, tx_outs, spendable_uTxOs)
+
+    def create_consolidation_transaction(self, unspent_tx_outs, tx_pool, max_inputs=None):
+        ''' Creates and signs a transaction sweeping the smallest spendable outputs of this wallet
+        into a single output to itself.
+
+        Params:
+            - unspent_tx_outs (list<transaction.UnspentTxOut>): The current unspent 
+                transaction outputs of the blockchain
+            - tx_pool (TransactionPool): The transaction pool of the node.
+            - max_inputs (int): The maximum number of outputs swept. Defaults to the maximum 
+                number of inputs of the coin selector of the wallet.
+
+        Returns (Transaction): The signed transaction or None if there are less than two 
+            spendable outputs.
+        '''
+        max_inputs = max_inputs or self.coin_selector.max_inputs
+        spendable_uTxOs = self.spendable_unspent_tx_outs(unspent_tx_outs, tx_pool)
+        included_uTxOs = sorted(spendable_uTxOs, key=lambda uTxO: uTxO.amount)[:max_inputs]
+        if len(included_uTxOs) < 2:
+            return None
+        total = sum((uTxO.amount for uTxO in included_uTxOs), Decimal(0))
+        tx_outs = [TxOut(self.get_public_key(), total)]
+        return self.create_signed_transaction(included_uTxOs, tx_outs, spendable_uTxOs)
+
+    def needs_consolidation(self, unspent_tx_outs, tx_pool):
+        ''' Returns True if the wallet has more spendable outputs than `consolidation_threshold`. '''
+        if self.consolidation_threshold is None:
+            return False
+        return len(self.spendable_unspent_tx_outs(unspent_tx_outs, tx_pool)) > self.consolidation_threshold
+
+    def create_signed_transaction(self, included_uTxOs, tx_outs, spendable_uTxOs):
+        included_ids = {id(uTxO) for uTxO in included_uTxOs}
+        spendable_uTxOs[:] = [uTxO for uTxO in spendable_uTxOs if id(uTxO) not in included_ids]
         unsigned_tx_ins = [TxIn(uTxO.tx_out_id, uTxO.tx_out_index) for uTxO in included_uTxOs]
-        tx_outs = self.create_tx_outs(receiver_address, amount, left_over_amount)
-        tx = Transaction(unsigned_tx_ins, tx_outs)
+        return self.sign_transaction(Transaction(unsigned_tx_ins, tx_outs), included_uTxOs)
+
+    def sign_transaction(self, tx, included_uTxOs):
+        private_key = self.get_private_key()
         for index, tx_in in enumerate(tx.tx_ins):
-            tx_in.signature = tx.sign_input(index, private_key, unspent_tx_outs)
+            tx_in.signature = tx.sign_input(index, private_key, included_uTxOs)
         return tx
 
+    def create_transactions(self, payments, unspent_tx_outs, tx_pool, coin_selector=None):
+        ''' Creates and signs a transaction for each payment. The unspent outputs of the wallet
+        are collected only once and each of them is spent by at most one of the transactions.
+
+        Params:
+            - payments (list<(bytes, Decimal)>): The receiver address and amount of each payment.
+            - unspent_tx_outs (list<transaction.UnspentTxOut>): The current unspent 
+                transaction outputs of the blockchain
+            - tx_pool (TransactionPool): The transaction pool of the node.
+            - coin_selector (coin_selection.CoinSelector): The strategy selecting the outputs
+                to be spent. Defaults to the `coin_selector` of the wallet.
+
+        Returns (list<Transaction>): The signed transactions in the order of the payments.
+        '''
+        spendable_uTxOs = self.spendable_unspent_tx_outs(unspent_tx_outs, tx_pool)
+        transactions = []
+        for index, (receiver_address, amount) in enumerate(payments):
+            try:
+                transactions.append(self.create_transaction_from(receiver_address, amount, spendable_uTxOs, 
+                                                                 coin_selector))
+            except (BadRequestError, UnauthorizedError) as ex:
+                ex.payload = dict(ex.payload or {}, payment=index)
+                raise
+        return transactions
+
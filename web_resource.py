@@ -0,0 +1,162 @@
+# pyncoin/web_resource.py
+
+''' Serves the Flask application natively on the Twisted reactor. '''
+
+from flask import Response, jsonify
+from twisted.internet.defer import Deferred
+from twisted.internet.interfaces import IPullProducer
+from twisted.python.failure import Failure
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+from werkzeug.test import EnvironBuilder
+from zope.interface import implementer
+
+class StreamedResponse:
+    ''' The result of a view whose body is written piece by piece as the client reads it, 
+    instead of being built in memory. '''
+
+    def __init__(self, chunks, mimetype='application/octet-stream'):
+        ''' Initializes the response.
+        Params:
+            - chunks (iterator<bytes>): The pieces of the body, produced lazily.
+            - mimetype (str): The content type of the body.
+        '''
+        self.chunks = chunks
+        self.mimetype = mimetype
+
+@implementer(IPullProducer)
+class ChunkProducer:
+    ''' Writes the chunks of a `StreamedResponse` to a request whenever its transport asks for
+    more data, grouping small chunks in writes of about `WRITE_SIZE` bytes. '''
+
+    WRITE_SIZE = 64 * 1024
+
+    def __init__(self, request, chunks):
+        self.request = request
+        self.chunks = chunks
+
+    def resumeProducing(self):
+        data = []
+        size = 0
+        try:
+            while size < ChunkProducer.WRITE_SIZE:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                data.append(chunk)
+                size += len(chunk)
+        except Exception as ex:
+            # the status is already sent, closing the connection tells the client the body is incomplete
+            print('Streamed response failed: {!r}'.format(ex))
+            self.request.unregisterProducer()
+            self.request.loseConnection()
+            return
+        if data:
+            self.request.write(b''.join(data))
+        if size < ChunkProducer.WRITE_SIZE:
+            self.request.unregisterProducer()
+            self.request.finish()
+
+    def stopProducing(self):
+        self.chunks = iter(())
+
+class ReactorResource(Resource):
+    ''' A twisted web resource dispatching requests to the routes of a Flask application.
+
+    Unlike `twisted.web.wsgi.WSGIResource` the views are called directly on the reactor
+    thread, so they must not block: they should answer from in-memory data or return a
+    `Deferred` (for example one returned by `workers.WorkerPool.submit`). The result of
+    the Deferred is converted to a response just like the return value of a normal view.
+    Large bodies are returned as a `StreamedResponse` and produced as the client reads them.
+    '''
+
+    isLeaf = True
+
+    def __init__(self, app):
+        ''' Initializes the resource.
+        Params:
+            - app (flask.Flask): The application whose routes are served.
+        '''
+        Resource.__init__(self)
+        self.app = app
+
+    def render(self, request):
+        environ = ReactorResource.build_environ(request)
+        with self.app.request_context(environ):
+            try:
+                result = self.app.preprocess_request()
+                if result is None:
+                    result = self.app.dispatch_request()
+            except Exception as ex:
+                result = ex
+            if isinstance(result, StreamedResponse):
+                return self.stream_response(request, result)
+            if not isinstance(result, Deferred):
+                return ReactorResource.write_response(request, self.make_response(result))
+        result.addBoth(self.finish_deferred, request, environ)
+        return NOT_DONE_YET
+
+    def stream_response(self, request, result):
+        ''' Sends the headers of a `StreamedResponse` and starts producing its body. Must be
+        called in the request context. '''
+        response = self.make_response(Response(mimetype=result.mimetype))
+        # the length of the body is unknown, it is sent with the chunked transfer encoding
+        response.headers.remove('Content-Length')
+        ReactorResource.write_response(request, response)
+        request.registerProducer(ChunkProducer(request, result.chunks), False)
+        return NOT_DONE_YET
+
+    def make_response(self, result):
+        ''' Converts the result of a view, or the exception raised by it, to a Flask response.
+        Must be called in the request context. '''
+        if isinstance(result, Failure):
+            result = result.value
+        try:
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                if not isinstance(result, Response):
+                    result = jsonify(result)
+            except Exception as ex:
+                result = self.app.handle_user_exception(ex)
+            return self.app.finalize_request(result)
+        except Exception as ex:
+            return self.app.handle_exception(ex)
+
+    def finish_deferred(self, result, request, environ):
+        with self.app.request_context(environ):
+            if isinstance(result, StreamedResponse):
+                if not request.finished and not request._disconnected:
+                    self.stream_response(request, result)
+                return
+            response = self.make_response(result)
+        if not request.finished and not request._disconnected:
+            request.write(ReactorResource.write_response(request, response))
+            request.finish()
+
+    @staticmethod
+    def write_response(request, response):
+        ''' Copies the status and the headers of a Flask response to the twisted request.
+
+        Returns (bytes): The body of the response.
+        '''
+        request.setResponseCode(response.status_code)
+        for name, value in response.headers.items():
+            request.setHeader(name, value)
+        return response.get_data()
+
+    @staticmethod
+    def build_environ(request):
+        ''' Builds a WSGI environment from a twisted request. '''
+        path, _, query_string = request.uri.decode('utf-8').partition('?')
+        headers = [(name.decode('latin-1'), value.decode('latin-1'))
+                   for name, values in request.requestHeaders.getAllRawHeaders() for value in values]
+        request.content.seek(0)
+        builder = EnvironBuilder(path=path, method=request.method.decode('ascii'),
+                                 query_string=query_string, headers=headers,
+                                 data=request.content.read(),
+                                 environ_overrides={'REMOTE_ADDR': request.getClientAddress().host})
+        try:
+            return builder.get_environ()
+        finally:
+            builder.close()
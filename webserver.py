@@ -5,18 +5,41 @@
 from decimal import Decimal
 import pprint
 
-from flask import Flask, request, jsonify, abort
+from flask import Flask, Response, request, jsonify, abort
 from blockchain import Block, Blockchain
+from address_history import AddressHistoryIndex
+from bootstrap import encode_record
+from coin_selection import get_coin_selector
+from mining import WorkServer
 from transaction import Transaction, UnspentTxOut
-from utils import hex_to_bytes, bytes_to_hex, HttpError, get_param
+from utils import hex_to_bytes, HttpError, BadRequestError, ForbiddenError, NotFoundError
+from utils import get_param, parse_json
+from web_resource import StreamedResponse
 
 class BlockchainFlask(Flask):
+    ''' The Flask application of the node.
+
+    The routes are served on the reactor thread by `web_resource.ReactorResource`, so they
+    must not block: long running work is offloaded to the worker processes of the blockchain
+    and returned as a Deferred.
+    '''
 
     def __init__(self, *args):
         super().__init__(*args)
         self.blockchain = None
         self.p2p_application = None
         self.wallet = None
+        self.subscription_hub = None
+        self.address_history = None
+        self.utxo_stats = None
+        self.block_filters = None
+        self.work_server = None
+        self.profiler = None
+        self.block_tracer = None
+
+def json_response(data):
+    ''' Returns a response with an already serialized json body. '''
+    return Response(data, mimetype='application/json')
 
 app = BlockchainFlask(__name__)
 
@@ -24,34 +47,67 @@ app = BlockchainFlask(__name__)
 
 @app.route('/blocks')
 def blocks():
-    return jsonify(app.blockchain.to_raw())
+    return json_response(app.blockchain.get_encoded_blocks())
 
 @app.route('/block/<hash>')
 def get_block(hash):
     block = app.blockchain.get_block_with_hash(hex_to_bytes(hash))
-    return jsonify(block.to_raw())
+    app.blockchain.check_not_pruned(block.index)
+    return json_response(app.blockchain.get_encoded_block_with_hash(block.hash))
 
 @app.route('/unspentTransactionOutputs')
 def get_unspent_transaction_outputs():
     uTxOs = app.blockchain.unspent_tx_outs
-    return jsonify(UnspentTxOut.to_raw_list(uTxOs))
+    return json_response(UnspentTxOut.to_json_any(uTxOs))
 
 @app.route('/transaction/<id>')
 def get_transaction(id):
     transaction = app.blockchain.get_transaction_with_id(hex_to_bytes(id))
-    return jsonify(transaction.to_raw())
+    return json_response(transaction.to_bin())
 
 @app.route('/address/<address>')
 def get_address_info(address):
     uTxOs = app.blockchain.unspent_tx_outs_for_address(hex_to_bytes(address))
-    return jsonify({'unspentTxOuts': UnspentTxOut.to_raw_list(uTxOs)})
+    return json_response(UnspentTxOut.to_json_any({'unspentTxOuts': UnspentTxOut.to_raw_list(uTxOs)}))
+
+@app.route('/address/<address>/history')
+def get_address_history(address):
+    if app.address_history is None:
+        raise NotFoundError('the address history index is disabled, start the node with --address-history')
+    cursor = request.args.get('cursor', None, type=int)
+    limit = request.args.get('limit', AddressHistoryIndex.DEFAULT_LIMIT, type=int)
+    return jsonify(app.address_history.get_history(hex_to_bytes(address), app.blockchain.get_latest().index,
+                                                   cursor, limit))
+
+@app.route('/filters')
+def get_filters():
+    if app.block_filters is None:
+        raise NotFoundError('the block filters are disabled, start the node with --block-filters')
+    start = request.args.get('from', 0, type=int)
+    end = request.args.get('to', None, type=int)
+    filters = app.block_filters.get_filters(start, end)
+    return jsonify({'filters': [block_filter.to_raw() for block_filter in filters]})
+
+# statistics
+
+@app.route('/stats/supply')
+def get_supply():
+    return jsonify(app.utxo_stats.supply())
+
+@app.route('/stats/richlist')
+def get_rich_list():
+    return jsonify(app.utxo_stats.rich_list(request.args.get('n', 10, type=int)))
+
+@app.route('/stats/distribution')
+def get_distribution():
+    return jsonify(app.utxo_stats.distribution(request.args.get('by', 'balance')))
 
 # wallet
 
 @app.route('/myUnspentTransactionOutputs')
 def get_my_unspent_transaction_outputs():
     uTxOs = app.blockchain.my_unspent_tx_outs(app.wallet)
-    return jsonify(UnspentTxOut.to_raw_list(uTxOs))
+    return json_response(UnspentTxOut.to_json_any(uTxOs))
 
 @app.route('/balance')
 def get_balance():
@@ -60,14 +116,19 @@ def get_balance():
 
 @app.route('/address')
 def get_address():
-    address = bytes_to_hex(app.wallet.get_public_key())
-    return jsonify({'address': address})
+    return jsonify({'address': app.wallet.get_public_key().hex()})
 
 # p2p
 
 @app.route('/peers')
 def get_peers():
-    return jsonify({'peers': app.p2p_application.peers()})
+    return jsonify({'peers': app.p2p_application.peers(), 'queues': app.p2p_application.peer_stats()})
+
+@app.route('/subscriptions')
+def get_subscriptions():
+    if app.subscription_hub is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(app.subscription_hub.stats(), enabled=True))
 
 @app.route('/addPeer', methods=['POST'])
 def add_peer():
@@ -79,25 +140,51 @@ def add_peer():
 
 # transactions
 
+def mine(block_data):
+    deferred = app.blockchain.generate_raw_next_block_async(block_data)
+    deferred.addCallback(lambda block: json_response(block.to_bin()) if block else None)
+    return deferred
+
 @app.route('/mineRawBlock', methods=['POST'])
 def mine_raw_block():
     data = request.get_json()
     block_data = get_param(data, 'data')
-    block = app.blockchain.generate_raw_next_block(block_data)
-    return jsonify(block.to_raw() if block else None)
+    return mine(block_data)
 
 @app.route('/mineBlock', methods=['POST'])
 def mine_block():
-    block = app.blockchain.generate_next_block(app.wallet)
-    return jsonify(block.to_raw() if block else None)
+    return mine(app.blockchain.next_block_data(app.wallet))
 
 @app.route('/mineTransaction', methods=['POST'])
 def mine_transaction():
     data = request.get_json()
     address = hex_to_bytes(get_param(data, 'address'))
     amount = Decimal(get_param(data, 'amount'))
-    block = app.blockchain.generate_next_with_transaction(app.wallet, address, amount)
-    return jsonify(block.to_raw() if block else None)
+    return mine(app.blockchain.next_block_data_with_transaction(app.wallet, address, amount))
+
+@app.route('/getWork', methods=['POST'])
+def get_work():
+    data = request.get_json(silent=True) or {}
+    return jsonify(app.work_server.get_work(data.get('nonceRange', WorkServer.NONCE_RANGE)))
+
+@app.route('/submitWork', methods=['POST'])
+def submit_work():
+    data = request.get_json()
+    block = app.work_server.submit(get_param(data, 'workId'), get_param(data, 'nonce'))
+    return jsonify({'index': block.index, 'hash': block.hash.hex()})
+
+@app.route('/work')
+def get_work_stats():
+    return jsonify(app.work_server.stats)
+
+def request_coin_selector(data):
+    ''' Returns the coin selector requested with the optional `coinSelection` and `maxInputs`
+    parameters, or None to use the default of the wallet. '''
+    if 'coinSelection' not in data and 'maxInputs' not in data:
+        return None
+    strategy = data.get('coinSelection', app.wallet.coin_selector.NAME)
+    max_inputs = int(data.get('maxInputs', app.wallet.coin_selector.max_inputs))
+    return get_coin_selector(strategy, max_inputs)
 
 @app.route('/sendTransaction', methods=['POST'])
 def send_transaction():
@@ -106,13 +193,134 @@ def send_transaction():
     address = hex_to_bytes(get_param(data, 'address'))
     amount = Decimal(get_param(data, 'amount'))
     print('address: {}, amount: {}'.format(address, amount))
-    tx = app.blockchain.send_transaction(app.wallet, address, amount)
-    return jsonify(tx.to_raw() if tx else None)
+    tx = app.blockchain.send_transaction(app.wallet, address, amount, request_coin_selector(data))
+    return json_response(tx.to_bin()) if tx else jsonify(None)
+
+@app.route('/sendTransactions', methods=['POST'])
+def send_transactions():
+    data = request.get_json()
+    payments = [(hex_to_bytes(get_param(payment, 'address')), Decimal(get_param(payment, 'amount')))
+                for payment in get_param(data, 'transactions')]
+    (accepted, rejected) = app.blockchain.send_transactions(app.wallet, payments, request_coin_selector(data))
+    return json_response(Transaction.to_json_any({
+        'accepted': Transaction.to_raw_list(accepted),
+        'rejected': [{'id': tx.id.hex(), 'reason': reason} for tx, reason in rejected]
+    }))
+
+@app.route('/sendPayment', methods=['POST'])
+def send_payment():
+    data = request.get_json()
+    payments = [(hex_to_bytes(get_param(payment, 'address')), Decimal(get_param(payment, 'amount')))
+                for payment in get_param(data, 'payments')]
+    tx = app.blockchain.send_payment(app.wallet, payments, request_coin_selector(data))
+    return json_response(tx.to_bin())
+
+@app.route('/consolidate', methods=['POST'])
+def consolidate():
+    data = request.get_json(silent=True) or {}
+    max_inputs = int(data['maxInputs']) if 'maxInputs' in data else None
+    tx = app.blockchain.send_consolidation(app.wallet, max_inputs)
+    return json_response(tx.to_bin()) if tx else jsonify(None)
+
+@app.route('/submitTransaction', methods=['POST'])
+def submit_transaction():
+    ''' Admits transactions signed offline. The body is either a json object with a 
+    `transaction` or a `transactions` parameter, or an `application/octet-stream` payload 
+    in the binary format of `Transaction.to_bin` containing a transaction or a list of them. '''
+    raw = parse_json(request.get_data())
+    if request.mimetype != 'application/octet-stream' and isinstance(raw, dict):
+        raw = get_param(raw, 'transactions') if 'transactions' in raw else get_param(raw, 'transaction')
+    if not isinstance(raw, list):
+        raw = [raw]
+    try:
+        transactions = Transaction.from_raw_list(raw)
+    except (KeyError, TypeError, ValueError, ArithmeticError) as ex:
+        raise BadRequestError('invalid transaction', {'cause': repr(ex)})
+    deferred = app.blockchain.submit_transactions(transactions)
+    deferred.addCallback(lambda result: {
+        'accepted': [tx.id.hex() for tx in result[0]],
+        'rejected': [{'id': tx.id.hex(), 'reason': reason} for tx, reason in result[1]]
+    })
+    return deferred
+
+@app.route('/validationStats')
+def get_validation_stats():
+    stats = app.blockchain.validation_stats.to_raw()
+    assume_valid = app.blockchain.assume_valid
+    stats['assumeValid'] = assume_valid.hex() if assume_valid is not None else None
+    stats['snapshot'] = app.blockchain.snapshot_info()
+    return jsonify(stats)
+
+@app.route('/bootstrap')
+def get_bootstrap():
+    start = max(request.args.get('from', 0, type=int), 0)
+    app.blockchain.check_not_pruned(start)
+    # the blocks connected while the records are sent are not included
+    blocks = app.blockchain.blocks[start:]
+    return StreamedResponse(encode_record(app.blockchain.get_encoded_block_with_hash(block.hash))
+                            for block in blocks)
+
+@app.route('/utxoSnapshot')
+def get_utxo_snapshot():
+    height = request.args.get('height', None, type=int)
+    deferred = app.blockchain.get_snapshot(height)
+    deferred.addCallback(lambda snapshot: Response(snapshot.to_bin(), mimetype='application/octet-stream'))
+    return deferred
 
 @app.route('/transactionPool')
 def get_transaction_pool():
     txs = app.blockchain.tx_pool.transactions
-    return jsonify(Transaction.to_raw_list(txs))
+    return json_response(Transaction.to_json_any(txs))
+
+# tracing
+
+def check_tracing():
+    if app.block_tracer is None:
+        raise NotFoundError('block tracing is disabled, start the node with --trace-blocks')
+
+@app.route('/trace/block/<hash>')
+def get_block_trace(hash):
+    check_tracing()
+    return jsonify(app.block_tracer.get_trace(hash))
+
+@app.route('/trace/histograms')
+def get_trace_histograms():
+    check_tracing()
+    return jsonify(app.block_tracer.get_histograms())
+
+# debug
+
+def check_debug():
+    ''' Raises an error unless the debug endpoints are enabled and called from this machine. '''
+    if app.profiler is None:
+        raise NotFoundError('the debug endpoints are disabled, start the node with --debug-endpoints')
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        raise ForbiddenError('the debug endpoints can only be called from this machine')
+
+def text_response(text):
+    return Response(text, mimetype='text/plain')
+
+@app.route('/debug/sample')
+def debug_sample():
+    check_debug()
+    deferred = app.profiler.sample(request.args.get('seconds', 10, type=float),
+                                   request.args.get('interval', 0.005, type=float))
+    deferred.addCallback(text_response)
+    return deferred
+
+@app.route('/debug/profile')
+def debug_profile():
+    check_debug()
+    deferred = app.profiler.profile(request.args.get('seconds', 10, type=float), request.args.get('sort', 'cumulative'),
+                                    request.args.get('limit', 50, type=int))
+    deferred.addCallback(text_response)
+    return deferred
+
+@app.route('/debug/memory')
+def debug_memory():
+    check_debug()
+    return app.profiler.memory(request.args.get('seconds', 10, type=float), request.args.get('groupBy', 'lineno'),
+                               request.args.get('limit', 25, type=int))
 
 @app.errorhandler(HttpError)
 def handle_http_error(error):
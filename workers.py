@@ -0,0 +1,86 @@
+# pyncoin/workers.py
+
+''' Offloads CPU-heavy work (mining, validation) from the reactor thread. '''
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, gatherResults, succeed
+
+from profiling import run_profiled
+
+class WorkerPool:
+    ''' A pool of worker processes whose results are delivered as Deferreds on the
+    reactor thread.
+
+    The submitted callables and their arguments must be picklable. The callables
+    should be pure functions: they run in a separate process and can not see or
+    modify the state of the node.
+    '''
+
+    def __init__(self, processes=None):
+        ''' Initializes the worker pool.
+        Params:
+            - processes (int): The number of worker processes. Defaults to the number
+                of CPUs of the machine.
+        '''
+        self.processes = processes or multiprocessing.cpu_count()
+        context = multiprocessing.get_context('spawn')
+        self.executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=context)
+        self.profiles = None
+
+    def submit(self, fn, *args):
+        ''' Runs `fn(*args)` in a worker process.
+
+        Returns (Deferred): Fires on the reactor thread with the result of the call,
+            or errbacks with the exception raised by it.
+        '''
+        deferred = Deferred()
+        if self.profiles is not None:
+            deferred.addCallback(self.collect_profile)
+            (fn, args) = (run_profiled, (fn,) + args)
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda f: reactor.callFromThread(WorkerPool._fire, deferred, f))
+        return deferred
+
+    def map(self, fn, items):
+        ''' Splits `items` into one chunk per worker process and runs `fn(chunk)` on each of
+        them in parallel. `fn` must return a list with one result per item of the chunk.
+
+        Returns (Deferred): Fires with the list of the results in the order of `items`.
+        '''
+        if not items:
+            return succeed([])
+        chunk_size = -(-len(items) // self.processes)
+        chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+        deferred = gatherResults([self.submit(fn, chunk) for chunk in chunks], consumeErrors=True)
+        deferred.addCallback(lambda results: [result for chunk in results for result in chunk])
+        return deferred
+
+    def start_profiling(self):
+        ''' Runs the calls submitted from now on under a profiler, see `profiling.NodeProfiler`. '''
+        self.profiles = []
+
+    def stop_profiling(self):
+        ''' Returns (list<profiling.ProfileData>): The profiles of the calls completed since
+        `start_profiling`. '''
+        (profiles, self.profiles) = (self.profiles or [], None)
+        return profiles
+
+    def collect_profile(self, result):
+        (value, profile) = result
+        if self.profiles is not None:
+            self.profiles.append(profile)
+        return value
+
+    @staticmethod
+    def _fire(deferred, future):
+        exception = future.exception()
+        if exception is not None:
+            deferred.errback(exception)
+        else:
+            deferred.callback(future.result())
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)